@@ -0,0 +1,338 @@
+#!/usr/bin/python
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+
+"""
+Random-access index of the tar archives in the install cache, with which an
+install selecting only some of an archive's files (see the 'only' and
+'exclude' patterns of autobuild install) reads just those files.
+
+Indexes are only of use when installing without the unpacked store (see
+install_cache.UNPACKED_STORE_ENV), which otherwise holds every member of an
+archive ready to link. Then, while an archive in the install cache is
+extracted for the first time, an IndexBuilder collects each member's name, type, size, mode and link target,
+and where its header and data lie in the uncompressed tar data. save() writes
+them to a sidecar file beside the archive (install_cache.TAR_INDEX_SUFFIX),
+along with -- for a .tar.bz2 decompressed by parallel_bzip2 -- where each
+compressed block starts in both the compressed and the decompressed data.
+
+get_index() then returns an ArchiveIndex that names the members without
+decompressing anything. If the archive is an uncompressed tar, or a .tar.bz2
+whose blocks were recorded, the index can also produce a tar stream of just
+some of them, decompressing only the blocks that hold them.
+"""
+
+import os
+import mmap
+import bisect
+import thread
+import logging
+import tarfile
+
+import common
+import install_cache
+import parallel_bzip2
+from llbase import llsd
+
+logger = logging.getLogger('autobuild.archive_index')
+
+# Indexes written in any other format version are ignored.
+INDEX_VERSION = 1
+
+
+class ArchiveIndexError(common.AutobuildError):
+    pass
+
+
+class IndexBuilder(object):
+    """
+    Collects the index of an archive as it is read from start to end: pass
+    it as common.extract_package()'s index argument, then save() it.
+    """
+    def __init__(self):
+        self._members = dict(names=[], types=[], sizes=[], modes=[], linknames=[],
+                             offsets=[], data_offsets=[])
+        self._random_access = True
+
+    def add(self, tarinfo):
+        members = self._members
+        members['names'].append(tarinfo.name)
+        members['types'].append(tarinfo.type)
+        members['sizes'].append(tarinfo.size)
+        members['modes'].append(tarinfo.mode)
+        members['linknames'].append(tarinfo.linkname)
+        members['offsets'].append(tarinfo.offset)
+        members['data_offsets'].append(tarinfo.offset_data)
+        if tarinfo.issparse() or tarinfo.type == tarfile.XGLTYPE:
+            # Sparse files' data isn't stored as their size says, and global
+            # headers apply to every later member: neither can be read alone.
+            self._random_access = False
+
+    def save(self, cachefile, blocks=None, block_offsets=None):
+        """
+        Write the index of the archive cached as cachefile beside it. blocks
+        and block_offsets, if given, are a parallel_bzip2.BlockStream's
+        blocks and offsets.
+        """
+        info = os.stat(cachefile)
+        index = dict(version=INDEX_VERSION, size=float(info.st_size),
+                     mtime=float(int(info.st_mtime)), compression=_get_compression(cachefile),
+                     random_access=self._random_access)
+        # llsd integers are only 32 bits: keep offsets and sizes as reals.
+        for key, values in self._members.iteritems():
+            if key in ('sizes', 'offsets', 'data_offsets'):
+                values = [float(value) for value in values]
+            index[key] = values
+        if blocks and block_offsets:
+            index['block_starts'] = [float(start) for start, end in blocks]
+            index['block_ends'] = [float(end) for start, end in blocks]
+            index['block_offsets'] = [float(offset) for offset in block_offsets]
+        indexname = cachefile + install_cache.TAR_INDEX_SUFFIX
+        tmpname = "%s.%s-%s.tmp" % (indexname, os.getpid(), thread.get_ident())
+        try:
+            out = open(tmpname, 'wb')
+            try:
+                out.write(llsd.format_binary(index))
+            finally:
+                out.close()
+            common.rename_into_place(tmpname, indexname)
+        except EnvironmentError, err:
+            # only an optimization
+            logger.warning("unable to save index of %s: %s" % (cachefile, err))
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            return
+        install_cache.share(indexname)
+
+
+class ArchiveIndex(object):
+    """
+    The saved index of the archive cached as cachefile: see get_index().
+    """
+    def __init__(self, cachefile, index):
+        self.cachefile = cachefile
+        self.names = index['names']
+        self._types = index['types']
+        self._sizes = [int(size) for size in index['sizes']]
+        self._modes = index['modes']
+        self._linknames = index['linknames']
+        self._offsets = [int(offset) for offset in index['offsets']]
+        self._data_offsets = [int(offset) for offset in index['data_offsets']]
+        self._compression = index['compression']
+        self._blocks = zip([int(start) for start in index.get('block_starts', [])],
+                           [int(end) for end in index.get('block_ends', [])])
+        self._block_offsets = [int(offset) for offset in index.get('block_offsets', [])]
+        self.random_access = index['random_access'] and \
+                             (self._compression == 'none' or
+                              (self._compression == 'bz2' and bool(self._block_offsets)))
+        self._positions = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def find(self, name):
+        """
+        Return the position of the member called name (compared as a
+        normalized path), or None if there is none.
+        """
+        if self._positions is None:
+            self._positions = dict((os.path.normpath(member), position)
+                                   for position, member in enumerate(self.names))
+        return self._positions.get(os.path.normpath(name))
+
+    def isdir(self, position):
+        return self._types[position] == tarfile.DIRTYPE
+
+    def open_stream(self, names):
+        """
+        Return a file-like object reading an uncompressed tar archive of just
+        the members called names, in archive order, for extraction with
+        common.extract_package()'s stream argument. Hard links bring along
+        the members they link to.
+        """
+        positions = set()
+        for name in names:
+            position = self._find(name)
+            positions.add(position)
+            if self._types[position] == tarfile.LNKTYPE:
+                target = self.find(self._linknames[position])
+                if target is not None:
+                    positions.add(target)
+        ranges = []
+        for position in sorted(positions):
+            start, end = self._offsets[position], self._data_offsets[position]
+            if self._types[position] in tarfile.REGULAR_TYPES or \
+               self._types[position] not in tarfile.SUPPORTED_TYPES:
+                # data padded to whole blocks, as tarfile reads it
+                end += -(-self._sizes[position] // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            if ranges and ranges[-1][1] == start:
+                # contiguous with the previous member: read them together
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return _ChunkStream(self._read_ranges(ranges))
+
+    def _find(self, name):
+        position = self.find(name)
+        if position is None:
+            raise ArchiveIndexError("%s has no member %s" % (self.cachefile, name))
+        return position
+
+    def _read_ranges(self, ranges):
+        """
+        Generator: yield the uncompressed tar data in each of the (start,
+        end) ranges, which must be in increasing order, in pieces.
+        """
+        if not self.random_access:
+            raise ArchiveIndexError("%s can't be read at random" % self.cachefile)
+        archive = open(self.cachefile, 'rb')
+        try:
+            if self._compression == 'none':
+                for start, end in ranges:
+                    archive.seek(start)
+                    while start < end:
+                        piece = archive.read(min(end - start, common.DOWNLOAD_CHUNK_SIZE))
+                        if not piece:
+                            raise ArchiveIndexError("%s is truncated" % self.cachefile)
+                        start += len(piece)
+                        yield piece
+                return
+            data = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # the block decompressed last: (position, offset, data)
+                block = None
+                for start, end in ranges:
+                    while start < end:
+                        if block is None or not block[1] <= start < block[1] + len(block[2]):
+                            block = self._load_block(data, start, block)
+                        position, offset, chunk = block
+                        piece = chunk[start - offset:end - offset]
+                        start += len(piece)
+                        yield piece
+            finally:
+                data.close()
+        finally:
+            archive.close()
+
+    def _load_block(self, data, start, block):
+        """
+        Decompress and return the (position, offset, data) of the bzip2
+        block holding uncompressed offset start, given the one decompressed
+        last, if any.
+        """
+        if block is not None and start >= block[1] + len(block[2]):
+            # Usually it's the next one. Offsets are only known for blocks
+            # that parallel_bzip2 had read when indexing stopped, so after
+            # those, we can only move forward a block at a time.
+            position, offset = block[0] + 1, block[1] + len(block[2])
+        else:
+            position = bisect.bisect_right(self._block_offsets, start) - 1
+            offset = self._block_offsets[position]
+        while True:
+            if position >= len(self._blocks):
+                raise ArchiveIndexError("%s is truncated" % self.cachefile)
+            chunk = parallel_bzip2.decompress_block(data, *self._blocks[position])
+            if start < offset + len(chunk):
+                return position, offset, chunk
+            position += 1
+            offset += len(chunk)
+
+
+def get_index(cachefile):
+    """
+    Return the ArchiveIndex saved for the archive cached as cachefile, or
+    None if there is none that is up to date.
+    """
+    indexname = cachefile + install_cache.TAR_INDEX_SUFFIX
+    try:
+        data = open(indexname, 'rb').read()
+        info = os.stat(cachefile)
+    except EnvironmentError:
+        return None
+    if not install_cache.is_trusted(indexname):
+        logger.debug("ignoring index of %s saved by another user" % cachefile)
+        return None
+    try:
+        index = llsd.parse(data)
+        if index.get('version') != INDEX_VERSION or \
+           index['size'] != info.st_size or index['mtime'] != int(info.st_mtime):
+            return None
+        return ArchiveIndex(cachefile, index)
+    except (llsd.LLSDParseError, KeyError, TypeError, ValueError, AttributeError), err:
+        logger.debug("ignoring unreadable index of %s: %s" % (cachefile, err))
+        return None
+
+
+#
+# Private module classes and functions below here.
+#
+class _ChunkStream(object):
+    """
+    Read-only file-like object over the strings yielded by chunks, followed
+    by the two empty blocks that end a tar archive.
+    """
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = ""
+        self._offset = 0
+        self._ended = False
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                self._offset = 0
+                self._chunk = next(self._chunks, None)
+                if self._chunk is None:
+                    if self._ended:
+                        self._chunk = ""
+                        break
+                    self._ended = True
+                    self._chunk = "\0" * (tarfile.BLOCKSIZE * 2)
+            if size < 0:
+                piece = self._chunk[self._offset:]
+            else:
+                piece = self._chunk[self._offset:self._offset + size]
+                size -= len(piece)
+            self._offset += len(piece)
+            pieces.append(piece)
+        return "".join(pieces)
+
+    def close(self):
+        self._chunks.close()
+
+def _get_compression(cachefile):
+    """
+    Return 'bz2', 'gzip', 'none' (an uncompressed tar) or 'other'.
+    """
+    archive = open(cachefile, 'rb')
+    try:
+        header = archive.read(tarfile.BLOCKSIZE)
+    finally:
+        archive.close()
+    if header.startswith("BZh"):
+        return 'bz2'
+    if header.startswith("\x1f\x8b"):
+        return 'gzip'
+    if header[257:262] == "ustar" or tarfile.is_tarfile(cachefile):
+        return 'none'
+    return 'other'
@@ -42,14 +42,24 @@ Date   : 2010-04-19
 
 import os
 import sys
+import time
+import stat
 import errno
+import shutil
+import filecmp
+import tempfile
 import pprint
 import logging
+import threading
+import collections
 import common
 import configfile
 import autobuild_base
 from llbase import llsd
 import subprocess
+import install_cache
+import archive_index
+import parallel_bzip2
 import hash_algorithms
 
 logger = logging.getLogger('autobuild.install')
@@ -58,6 +68,10 @@ logger = logging.getLogger('autobuild.install')
 # with --quiet if need be.
 dry_run_msg = logger.warning
 
+# Number of threads removing the files of an uninstalled package. More than
+# one helps on network filesystems, where each removal is a round trip.
+UNINSTALL_THREADS = common.get_env_count('AUTOBUILD_UNINSTALL_THREADS', 1)
+
 class InstallError(common.AutobuildError):
     pass
 
@@ -67,12 +81,39 @@ This autobuild command fetches and installs package archives.
 The command will read an autobuild.xml file and install any new or
 updated packages defined in that file to the install directory. An
 installed-packages.xml manifest file is also maintained in the install
-directory to specify all the files that have been installed.
+directory to specify all the files that have been installed: it indexes the
+installed-packages.d directory, which records each installed package in a
+file of its own, so that installs of different packages don't contend.
 
 Downloaded package archives are cached on the local machine so that
 they can be shared across multiple repositories and to avoid unnecessary
 downloads. A new package will be downloaded if the autobuild.xml files is
-updated with a new package URL or MD5 sum.
+updated with a new package URL or MD5 sum. To keep the cache from growing
+without bound, set AUTOBUILD_CACHE_MAX_BYTES: each install then evicts the
+least recently used archives beyond that size, never touching the archives
+it is installing.
+
+Set AUTOBUILD_INSTALL_CACHE to a directory to use it as the cache instead.
+Several users may share such a cache, given a common group: its directories
+are made writable by the group, and concurrent installs take turns fetching
+each archive rather than downloading it more than once. Only its owner can
+change a cached archive, and other users hash it again rather than trust
+that it is unchanged.
+
+Each archive is also kept unpacked in the cache, and installed by hard
+linking its files into the install directory (copying them where that's on
+another filesystem), so installing the same archive into several build
+directories only decompresses it once. Since the linked files are shared,
+don't modify them in place. Set AUTOBUILD_UNPACKED_STORE=0 to extract a
+separate copy for every install instead.
+
+A package description in autobuild.xml may list glob patterns of installed
+paths under 'only' and 'exclude' to install just part of the package, e.g.
+its headers and release libraries; the --only and --exclude options
+override them. A pattern matching a directory selects everything in it.
+Without the unpacked store, an archive's members are indexed the first time
+it is extracted, and a later install of part of an uncompressed or .tar.bz2
+archive reads only the blocks holding the selected files.
 
 If an MD5 checksum is provided for a package in the autobuild.xml file,
 this will be used to validate the downloaded package. The package will
@@ -87,6 +128,24 @@ If no packages are specified on the command line, then the defaut
 behavior is to install all known archives appropriate for the platform
 specified. You can specify more than one package on the command line.
 
+Package archives are downloaded and verified in the background, ahead of
+their extraction, so that one package can be extracted while the next ones
+are being fetched. With --jobs N, up to N archives are fetched and up to N
+extracted concurrently, and a failure of any one package is reported by name
+without preventing the others from being installed. A package replacing an
+installed version is upgraded once the packages before it are extracted,
+and alone. The installed-packages.xml manifest is always updated in the
+order the packages were requested. Large .tar.bz2 archives
+are decompressed using one process per CPU; set
+AUTOBUILD_DECOMPRESS_PROCESSES to use a different number, or 1 to decompress
+in a single process. Extracted files are written by 4 threads, which helps
+on network filesystems; set AUTOBUILD_EXTRACT_THREADS to change that, and
+AUTOBUILD_EXTRACT_RESTORE_ATTRIBUTES=0 to skip setting each file's
+modification time and owner from the archive. Packages may also be zip
+archives, whose files are decompressed by those same threads. Directories
+installed by just one package are removed whole when it is uninstalled; set
+AUTOBUILD_UNINSTALL_THREADS to remove files on several threads.
+
 Supported platforms include: windows, darwin, linux, and a common platform
 to represent a platform-independent package.
 """
@@ -153,6 +212,31 @@ def add_arguments(parser):
         dest='as_source',
         default=[],
         help="Get the source for this package instead of prebuilt binary.")
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        dest='jobs',
+        help="Number of package archives to download, verify and extract concurrently "
+             "(default 1).")
+    parser.add_argument(
+        '--only',
+        action='append',
+        dest='only',
+        default=[],
+        metavar='PATTERN',
+        help="Extract only the files matching this glob pattern (or within directories "
+             "matching it), overriding any 'only' patterns in the package description. "
+             "May be repeated.")
+    parser.add_argument(
+        '--exclude',
+        action='append',
+        dest='exclude',
+        default=[],
+        metavar='PATTERN',
+        help="Don't extract the files matching this glob pattern (or within directories "
+             "matching it), overriding any 'exclude' patterns in the package description. "
+             "May be repeated.")
 
 def print_list(label, array):
     """
@@ -227,16 +311,21 @@ def post_install_license_check(packages, config_file, installed_file):
             raise InstallError("nonexistent license_file for %s: %s "
                                "(you can use --skip-license-check)" % (pname, license_file))
 
-def do_install(packages, config_file, installed_file, platform, install_dir, dry_run, as_source=[]):
+def do_install(packages, config_file, installed_file, platform, install_dir, dry_run, as_source=[], jobs=1,
+               only=None, exclude=None):
     """
     Install the specified list of packages. By default this will download the
     packages to the local cache, extract the contents of those
     archives to the install dir, and update the installed_file config.  For packages
     listed in the optional 'as_source' list, the source will be downloaded in place
-    of the prebuilt binary.
+    of the prebuilt binary. Archives are fetched, ahead of their extraction,
+    and extracted by up to 'jobs' background threads each. The glob patterns 'only' and
+    'exclude', if given, override those of each package to select which of
+    its files to extract.
     """
     # Decide whether to check out (or update) source, or download a tarball
     installed_pkgs = []
+    binary_pkgs = []
     for pname in packages:
         try:
             package = config_file.installables[pname]
@@ -272,9 +361,11 @@ def do_install(packages, config_file, installed_file, platform, install_dir, dry
             if _install_source(package, installed_file, config_file, dry_run):
                 installed_pkgs.append(pname)
         else:
-            logger.warn("installing %s from archive" % pname)
-            if _install_binary(package, platform, config_file, install_dir, installed_file, dry_run):
-                installed_pkgs.append(pname)
+            # defer to the pipeline below
+            binary_pkgs.append(package)
+    if binary_pkgs:
+        installed_pkgs.extend(_install_binaries(binary_pkgs, platform, install_dir,
+                                                installed_file, dry_run, jobs, only, exclude))
     return installed_pkgs
 
 def _install_source(package, installed_config, config_file, dry_run):
@@ -330,13 +421,19 @@ def _install_source(package, installed_config, config_file, dry_run):
     inst_pkg.platforms.clear()
     return True
 
-def _install_binary(package, platform, config_file, install_dir, installed_file, dry_run):
+def _get_binary_platform(package, platform, installed_file, selection):
+    """
+    Return the PlatformDescription to install for package on platform, or
+    None if there is nothing to do: either the package has no installation
+    information for this platform or the requested archive is already
+    installed, with the same selection of files (see _get_selection()).
+    """
     # Check that we have a platform-specific or common url to use.
     req_plat = package.get_platform(platform)
     package_name = getattr(package, 'name', '(undefined)')
     if not req_plat:
         logger.warning("package %s has no installation information configured for platform %s" % (package_name, platform))
-        return False
+        return None
     archive = req_plat.archive
     if not archive:
         raise InstallError("no archive specified for package %s for platform %s" %
@@ -351,56 +448,312 @@ def _install_binary(package, platform, config_file, install_dir, installed_file,
     # whether the installed ArchiveDescription matches the requested one. This
     # test also handles the case when inst_plat.archive is None (not yet
     # installed).
-    if archive == inst_archive:
+    if archive == inst_archive and _get_selection(installed) == selection:
         logger.info("%s up to date" % package.name)
-        return False
+        return None
+    return req_plat
 
-    cachefile = common.get_package_in_cache(archive.url)
+def _get_selection(package, only=None, exclude=None):
+    """
+    Return (only, exclude): the lists of glob patterns selecting which files
+    of package to extract. Patterns given here override the package's own.
+    """
+    return (list(only or getattr(package, 'only', None) or []),
+            list(exclude or getattr(package, 'exclude', None) or []))
+
+def _fetch_archive(package, archive):
+    """
+    Ensure that a verified copy of archive is present in the install cache,
+    downloading it if need be, and return the pathname of the cached copy.
+    Safe to call from a worker thread.
+    """
+    # An archive with a known hash is cached under that hash; the file named
+    # for its URL is only an alias. Without a hash, the alias is all we have.
+    aliasfile = common.get_package_in_cache(archive.url)
+    cachefile = install_cache.get_content_path(archive.hash_algorithm, archive.hash) or aliasfile
+
+    # If another install is already fetching this archive, wait for it
+    # rather than downloading it again.
+    lock = install_cache.EntryLock(cachefile)
+    if not lock.acquire(blocking=False):
+        logger.warn("waiting for another install to fetch %s" % archive.url)
+        lock.acquire()
+    try:
+        return _fetch_locked_archive(package, archive, cachefile, aliasfile)
+    finally:
+        lock.release()
 
+def _fetch_locked_archive(package, archive, cachefile, aliasfile):
     # download the package, if it's not already in our cache
-    download_required = False
     if os.path.exists(cachefile):
-        if hash_algorithms.verify_hash(archive.hash_algorithm, cachefile, archive.hash):
+        # Only re-hash a cached archive if it has changed since it was last
+        # verified.
+        if install_cache.verify_hash(archive.hash_algorithm, cachefile, archive.hash):
             logger.debug("found in cache: " + cachefile)
-        else:
-            download_required = True
-            common.remove_package(archive.url)
-    else:
-        download_required = True
-    
-    if download_required:
-        # download the package to the cache
-        logger.warn("downloading %s archive from %s" % (package.name, archive.url))
-        if not common.download_package(archive.url):
-            # Download failure has been observed to leave a zero-length file.
-            common.remove_package(archive.url)
-            raise InstallError("failed to download %s" % archive.url)
-    
-        # error out if MD5 doesn't match
-        if not hash_algorithms.verify_hash(archive.hash_algorithm, cachefile, archive.hash):
-            common.remove_package(archive.url)
-            raise InstallError("download error--%s mismatch for %s" % ((archive.hash_algorithm or "md5"), cachefile))
-
-    # dry run mode = download but don't install packages
-    if dry_run:
-        dry_run_msg("Dry run mode: not installing %s" % package.name)
-        return False
+            install_cache.touch(cachefile)
+            install_cache.link_entry(cachefile, aliasfile)
+            return cachefile
+        install_cache.remove_entry(cachefile)
+    if cachefile != aliasfile and os.path.exists(aliasfile) and \
+       install_cache.verify_hash(archive.hash_algorithm, aliasfile, archive.hash):
+        # cached by name only, e.g. by an older autobuild or by hand
+        logger.debug("found in cache: " + aliasfile)
+        install_cache.touch(aliasfile)
+        if install_cache.link_entry(aliasfile, cachefile):
+            return cachefile
+        return aliasfile
+
+    # download the package to the cache, hashing it on the way in
+    logger.warn("downloading %s archive from %s" % (package.name, archive.url))
+    hasher = None
+    if archive.hash:
+        hasher = hash_algorithms.new_hasher(archive.hash_algorithm, cachefile)
+    install_cache.make_directory(os.path.dirname(cachefile))
+    if not common.download_package(archive.url, hasher, cachefile):
+        # Download failure has been observed to leave a zero-length file.
+        install_cache.remove_entry(cachefile)
+        raise InstallError("failed to download %s" % archive.url)
 
-    # If this package has already been installed, first uninstall the older
-    # version.
-    uninstall(package.name, installed_file)
+    # error out if MD5 doesn't match
+    if not hash_algorithms.verify_digest(hasher, cachefile, archive.hash):
+        install_cache.remove_entry(cachefile)
+        raise InstallError("download error--%s mismatch for %s" % ((archive.hash_algorithm or "md5"), archive.url))
+    install_cache.share(cachefile)
+    if hasher is not None:
+        # save the next install from having to hash it again
+        install_cache.get_hash_index().record(cachefile, archive.hash_algorithm,
+                                              hasher.hexdigest())
+    install_cache.link_entry(cachefile, aliasfile)
+    return cachefile
 
+def _extract_archive(package, archive, selection, cachefile, install_dir):
+    """
+    Extract the files of archive, cached as cachefile, chosen by selection
+    (see _get_selection()) into install_dir and return the list of installed
+    files. Safe to call from a worker thread.
+    """
     # check that the install dir exists...
     if not os.path.exists(install_dir):
         logger.debug("creating " + install_dir)
-        os.makedirs(install_dir)
+        try:
+            os.makedirs(install_dir)
+        except OSError, err:
+            # another worker may have beaten us to it
+            if err.errno != errno.EEXIST:
+                raise
+
+    unpacked = install_cache.get_unpacked_path(archive.hash_algorithm, archive.hash)
+    if unpacked is None:
+        logger.warn("extracting %s" % (package.name))
+        files = _unpack_archive(archive, cachefile, install_dir, archive.dir_structure, selection,
+                                index_archive=True)
+    else:
+        # Unpack the archive just once, into the install cache, and link its
+        # files from there into each install_dir.
+        lock = install_cache.EntryLock(unpacked)
+        lock.acquire()
+        try:
+            names = install_cache.get_unpacked_names(unpacked)
+            if names is None:
+                logger.warn("extracting %s" % (package.name))
+                names = install_cache.add_unpacked(
+                    unpacked, lambda dest: _unpack_archive(archive, cachefile, dest))
+            else:
+                logger.warn("linking %s from the install cache" % package.name)
+            # The unpacked store holds the whole archive, whatever the
+            # selection: choose the files to install while linking.
+            files = install_cache.link_tree(unpacked, names, install_dir,
+                                            common.get_member_map(archive.dir_structure,
+                                                                  *selection))
+        finally:
+            lock.release()
 
-    # extract the files from the package, convert dir structure if necessary
-    logger.warn("extracting %s" % (package.name))
-    files = common.extract_and_convert_package(archive.url, install_dir, archive.dir_structure)
+    files = common.add_missing_symlinks(archive.url, install_dir, files)
     for f in files:
         logger.debug("extracted: " + f)
+    return files
+
+def _upgrade_archive(package, archive, selection, cachefile, install_dir, installed_file):
+    """
+    If package is already installed in install_dir from another archive, or
+    with another selection of files, upgrade it in place to the files of
+    archive, cached as cachefile, chosen by selection: remove, add or replace
+    only the files that differ between the two, leaving the rest -- and
+    their modification times -- alone. Return the list of installed files,
+    or None if the package must be installed afresh.
+    """
+    installed = installed_file.installables.get(package.name)
+    if installed is None or installed.as_source or len(installed.platforms) != 1:
+        return None
+    if not installed.install_dir or \
+       os.path.realpath(installed.install_dir) != os.path.realpath(install_dir):
+        return None
+    manifest = installed.platforms.values()[0].manifest or []
+    member_map = common.get_member_map(archive.dir_structure, *selection)
+
+    # From here on, as after uninstall(), the old version is no longer
+    # recorded as installed.
+    del installed_file.installables[package.name]
+    logger.warn("upgrading %s" % package.name)
+    unpacked = install_cache.get_unpacked_path(archive.hash_algorithm, archive.hash)
+    if unpacked is not None:
+        lock = install_cache.EntryLock(unpacked)
+        lock.acquire()
+        try:
+            names = install_cache.get_unpacked_names(unpacked)
+            if names is None:
+                names = install_cache.add_unpacked(
+                    unpacked, lambda dest: _unpack_archive(archive, cachefile, dest))
+            files, changed = _apply_upgrade(unpacked, names, member_map, manifest, install_dir,
+                                            installed_file)
+            install_cache.link_tree(unpacked, [source for source, target in changed],
+                                    install_dir, member_map)
+        finally:
+            lock.release()
+    else:
+        # Unpack beside the installed files, so they can be moved into place.
+        staging = tempfile.mkdtemp(prefix=".%s-upgrade-" % package.name, dir=install_dir)
+        try:
+            names = _unpack_archive(archive, cachefile, staging, index_archive=True)
+            files, changed = _apply_upgrade(staging, names, member_map, manifest, install_dir,
+                                            installed_file)
+            for source, target in changed:
+                source = os.path.join(staging, source)
+                target = os.path.join(install_dir, target)
+                if os.path.isdir(source) and not os.path.islink(source):
+                    common.ensure_directory(target)
+                    continue
+                common.ensure_directory(os.path.dirname(target))
+                if os.path.lexists(target) and not os.path.isdir(target):
+                    os.remove(target)
+                os.rename(source, target)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    return common.add_missing_symlinks(archive.url, install_dir, files)
+
+def _apply_upgrade(tree, names, member_map, manifest, install_dir, installed_config):
+    """
+    Given the new archive's member names, unpacked in directory tree, the
+    common.get_member_map() placing and selecting them (or None) and the
+    manifest of the version installed in install_dir: remove the installed
+    files the new version doesn't have, unless another package in
+    installed_config owns them, and return (files, changed), where files lists the names the new
+    version installs and changed the (member name, installed name) pairs
+    that must be placed in install_dir because they are new or differ from
+    what's installed.
+    """
+    placed = []
+    for name in names:
+        target = name
+        if member_map is not None:
+            source = os.path.join(tree, name)
+            target = member_map.remap(name, os.path.isdir(source) and not os.path.islink(source))
+            if target is None:
+                continue
+        placed.append((name, target))
+    new_names = set(os.path.normpath(target) for source, target in placed)
+    _remove_files(install_dir, [f for f in manifest if os.path.normpath(f) not in new_names],
+                  _get_owned_paths(installed_config, install_dir) | _owned_paths(new_names))
+    changed = [(source, target) for source, target in placed
+               if _differs(os.path.join(tree, source), os.path.join(install_dir, target))]
+    logger.info("%s of %s files changed" % (len(changed), len(placed)))
+    files = []
+    seen = set()
+    for source, target in placed:
+        if target not in seen:
+            seen.add(target)
+            files.append(target)
+    return files, changed
 
+def _differs(source, target):
+    """
+    Return True unless target is the same file, directory or symlink as
+    source, with the same contents and permissions.
+    """
+    if os.path.islink(source):
+        return not os.path.islink(target) or os.readlink(source) != os.readlink(target)
+    if os.path.isdir(source):
+        return os.path.islink(target) or not os.path.isdir(target)
+    if os.path.islink(target):
+        # linked to the source if hard links weren't possible
+        return os.path.realpath(target) != os.path.realpath(source)
+    if not os.path.isfile(target):
+        return True
+    source_info, target_info = os.stat(source), os.stat(target)
+    if (source_info.st_dev, source_info.st_ino) == (target_info.st_dev, target_info.st_ino) and \
+       source_info.st_ino:
+        # already linked to it
+        return False
+    if stat.S_IMODE(source_info.st_mode) != stat.S_IMODE(target_info.st_mode):
+        return True
+    return not filecmp.cmp(source, target, shallow=False)
+
+def _unpack_archive(archive, cachefile, dest, structure=None, selection=((), ()),
+                    index_archive=False):
+    """
+    Extract the archive cached as cachefile into the directory dest -- as
+    is, or placing members according to the dir_structure structure, and
+    extracting only those chosen by selection (see _get_selection()) -- and
+    return the list of names extracted.
+
+    If index_archive, as when there's no unpacked store to extract from
+    instead, the archive is indexed the first time through, so that later
+    selective installs can read just the members they choose.
+    """
+    # keep the archive from being evicted while we read it
+    lock = install_cache.EntryLock(cachefile)
+    lock.acquire(shared=True)
+    try:
+        if common.is_zip_archive(cachefile):
+            # The central directory already indexes a zip archive's
+            # members, which are decompressed in parallel as they are.
+            return common.extract_package(archive.url, dest, cachefile, structure=structure,
+                                          only=selection[0], exclude=selection[1])
+        index = None
+        if index_archive:
+            index = archive_index.get_index(cachefile)
+        if index is not None and index.random_access and (selection[0] or selection[1]):
+            # Read just the selected members, decompressing only what holds
+            # them.
+            member_map = common.get_member_map(structure, *selection)
+            names = [name for position, name in enumerate(index.names)
+                     if member_map.remap(name, index.isdir(position)) is not None]
+            logger.info("reading %s of %s members of %s" % (len(names), len(index), cachefile))
+            stream = index.open_stream(names)
+            try:
+                return common.extract_package(archive.url, dest, cachefile, stream, structure,
+                                              only=selection[0], exclude=selection[1])
+            finally:
+                stream.close()
+        # The first time through, index the archive as we go.
+        builder = index_archive and index is None and archive_index.IndexBuilder() or None
+        # Decompress on several processors if we can.
+        stream = parallel_bzip2.open_tar_stream(cachefile)
+        if stream is not None:
+            try:
+                try:
+                    files = common.extract_package(archive.url, dest, cachefile, stream,
+                                                   structure, only=selection[0],
+                                                   exclude=selection[1], index=builder)
+                    if builder is not None:
+                        builder.save(cachefile, stream.blocks, stream.offsets)
+                    return files
+                except parallel_bzip2.DecompressionError, err:
+                    # Extracting again from the start overwrites whatever
+                    # was extracted so far.
+                    logger.warning("%s; extracting serially" % err)
+                    builder = index_archive and index is None and archive_index.IndexBuilder() or None
+            finally:
+                stream.close()
+        files = common.extract_package(archive.url, dest, cachefile, structure=structure,
+                                       only=selection[0], exclude=selection[1], index=builder)
+        if files is not False and builder is not None:
+            builder.save(cachefile)
+        return files
+    finally:
+        lock.release()
+
+def _record_install(package, platform, req_plat, selection, install_dir, installed_file, files):
     # Update the installed-packages.xml file. The above uninstall() call
     # should have removed any existing entry in installed_file. Copy
     # PackageDescription metadata from the autobuild.xml entry.
@@ -412,6 +765,13 @@ def _install_binary(package, platform, config_file, install_dir, installed_file,
     # different --install-dir on a later run, we can still successfully
     # uninstall this package.
     inst_pkg.install_dir = install_dir
+    # Record the file selection actually used, which may have come from the
+    # command line.
+    for attr, patterns in zip(("only", "exclude"), selection):
+        if patterns:
+            inst_pkg[attr] = patterns
+        else:
+            inst_pkg.pop(attr, None)
     # Clear platforms: there should be exactly one.
     inst_pkg.platforms.clear()
 
@@ -421,7 +781,220 @@ def _install_binary(package, platform, config_file, install_dir, installed_file,
     inst_plat = req_plat.copy()
     inst_pkg.platforms[platform] = inst_plat
     inst_plat.manifest = files
-    return True
+
+def _install_binaries(packages, platform, install_dir, installed_file, dry_run, jobs,
+                      only=None, exclude=None):
+    """
+    Install the archives for the specified PackageDescriptions, returning the
+    names of the packages installed.
+
+    The install is a two-stage pipeline. Up to 'jobs' background threads
+    download and verify archives into the cache, in the order of 'packages',
+    and each archive is extracted as soon as it has been fetched -- so
+    extracting one package overlaps fetching the next ones. With jobs == 1,
+    the calling thread extracts each archive in turn; otherwise up to 'jobs'
+    more background threads extract them concurrently. Everything that
+    touches installed_file (deciding what needs installing, uninstalling
+    previous versions and recording the new manifests) happens on the
+    calling thread in the order of 'packages'. Removing an installed
+    package's files mustn't race with extracting others', so a package that
+    is already installed is upgraded or reinstalled on the calling thread,
+    once all the extractions started before it have finished.
+
+    With jobs == 1, the first failure stops the install, as if the packages
+    were installed one at a time. Otherwise a failure is reported per
+    package; the remaining packages are still installed before an
+    InstallError naming all the failures is raised.
+
+    The glob patterns 'only' and 'exclude', if given, override those of each
+    package to select which of its files to extract.
+    """
+    failures = []
+    def failed(package, err):
+        # Anything at all can go wrong with one package -- a corrupt archive
+        # raises whatever tarfile or bz2 does -- without stopping the rest.
+        log = isinstance(err, common.AutobuildError) and logger.debug or logger.warning
+        log("failed to install %s" % package.name, exc_info=True)
+        failures.append((package.name, err))
+
+    pending = []
+    for package in packages:
+        selection = _get_selection(package, only, exclude)
+        try:
+            req_plat = _get_binary_platform(package, platform, installed_file, selection)
+        except Exception, err:
+            if jobs == 1:
+                raise
+            failed(package, err)
+            continue
+        if req_plat:
+            pending.append((package, req_plat, selection))
+
+    installed_pkgs = []
+    fetcher = _BackgroundMap(lambda (package, req_plat, selection):
+                             _fetch_archive(package, req_plat.archive),
+                             pending, jobs)
+    extractor = None
+    if jobs > 1:
+        extractor = _BackgroundMap(lambda (package, req_plat, selection, cachefile):
+                                   _extract_archive(package, req_plat.archive, selection,
+                                                    cachefile, install_dir),
+                                   [], jobs)
+    # (package, req_plat, selection, extractor index) of the packages being
+    # extracted in the background, in order
+    extracting = []
+    def record_extracted():
+        # wait for every background extraction, recording each in order
+        for package, req_plat, selection, index in extracting:
+            try:
+                files = extractor.result(index)
+            except Exception, err:
+                failed(package, err)
+                continue
+            _record_install(package, platform, req_plat, selection, install_dir,
+                            installed_file, files)
+            installed_pkgs.append(package.name)
+        del extracting[:]
+    try:
+        for index, (package, req_plat, selection) in enumerate(pending):
+            logger.warn("installing %s from archive" % package.name)
+            try:
+                cachefile = fetcher.result(index)
+                # dry run mode = download but don't install packages
+                if dry_run:
+                    dry_run_msg("Dry run mode: not installing %s" % package.name)
+                    continue
+                if extractor is not None and package.name not in installed_file.installables:
+                    extracting.append((package, req_plat, selection,
+                                       extractor.add((package, req_plat, selection, cachefile))))
+                    continue
+                record_extracted()
+                # If this package has already been installed, change only
+                # what differs from the older version if we can; otherwise
+                # first uninstall the older version.
+                files = _upgrade_archive(package, req_plat.archive, selection, cachefile,
+                                         install_dir, installed_file)
+                if files is None:
+                    uninstall(package.name, installed_file)
+                    files = _extract_archive(package, req_plat.archive, selection, cachefile,
+                                             install_dir)
+            except Exception, err:
+                if jobs == 1:
+                    raise
+                failed(package, err)
+                continue
+            _record_install(package, platform, req_plat, selection, install_dir, installed_file,
+                            files)
+            installed_pkgs.append(package.name)
+        record_extracted()
+    finally:
+        # stop fetching and extracting anything we're no longer going to install
+        fetcher.cancel()
+        if extractor is not None:
+            extractor.cancel()
+
+    if failures:
+        for pname, err in failures:
+            logger.error("failed to install %s: %s" % (pname, err))
+        raise InstallError("failed to install %s" %
+                           "; ".join("%s (%s)" % (pname, err) for pname, err in failures))
+    return installed_pkgs
+
+class _BackgroundMap(object):
+    """
+    Call func(item) for each of items, and of any more passed to add(), in
+    order, on up to 'jobs' background threads, letting the caller collect
+    each result with result() as soon as that one is ready.
+    """
+    def __init__(self, func, items, jobs):
+        self._func = func
+        self._jobs = jobs
+        self._items = []
+        self._results = []
+        self._done = []
+        self._work = collections.deque()
+        # guards _work and _workers
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._cancelled = False
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        """
+        Queue func(item) as well, and return the index with which to collect
+        its result.
+        """
+        index = len(self._items)
+        self._items.append(item)
+        self._results.append(None)
+        self._done.append(threading.Event())
+        self._lock.acquire()
+        try:
+            self._work.append(index)
+            if self._workers >= self._jobs:
+                return index
+            self._workers += 1
+            name = "install-%s" % self._workers
+        finally:
+            self._lock.release()
+        thread = threading.Thread(target=self._worker, name=name)
+        # Don't let a hung download keep the process alive after Ctrl-C.
+        thread.setDaemon(True)
+        thread.start()
+        return index
+
+    def result(self, index):
+        """
+        Wait for func(items[index]) and return its result, or raise the
+        exception it raised.
+        """
+        done = self._done[index]
+        # wait() with a timeout so the main thread still sees KeyboardInterrupt
+        while not done.isSet():
+            done.wait(0.5)
+        result, err = self._results[index]
+        if err is not None:
+            raise err
+        return result
+
+    def cancel(self):
+        """
+        Don't start work on any more items; work in progress still finishes.
+        """
+        self._cancelled = True
+
+    def _worker(self):
+        while True:
+            self._lock.acquire()
+            try:
+                if self._cancelled or not self._work:
+                    # add() starts another worker for anything queued later
+                    self._workers -= 1
+                    return
+                index = self._work.popleft()
+            finally:
+                self._lock.release()
+            try:
+                self._results[index] = (self._func(self._items[index]), None)
+            except Exception, err:
+                logger.debug("worker %s failed" % threading.currentThread().getName(), exc_info=True)
+                self._results[index] = (None, err)
+            self._done[index].set()
+
+def _get_archive_paths(packages, config_file, platform):
+    """
+    Return the install cache pathnames of the archives for the named packages
+    on platform.
+    """
+    paths = []
+    for pname in packages:
+        package = config_file.installables.get(pname)
+        req_plat = package and package.get_platform(platform)
+        archive = req_plat and req_plat.archive
+        if archive and archive.url:
+            paths.extend(install_cache.get_archive_paths(archive))
+    return paths
 
 def uninstall(package_name, installed_config):
     """
@@ -452,54 +1025,173 @@ def uninstall(package_name, installed_config):
     # The platforms attribute should contain exactly one PlatformDescription.
     # We don't especially care about its key name.
     _, platform = package.platforms.popitem()
-    # Tarballs that name directories name them before the files they contain,
-    # so the unpacker will create the directory before creating files in it.
-    # For exactly that reason, we must remove things in reverse order.
-    for f in reversed(platform.manifest):
-        # Some tarballs contain funky directory name entries (".//"). Use
-        # realpath() to dewackify them.
-        fn = os.path.normpath(os.path.join(package.install_dir, f))
+    _remove_files(package.install_dir, platform.manifest,
+                  _get_owned_paths(installed_config, package.install_dir))
+
+def _get_owned_paths(installed_config, install_dir):
+    """
+    Return the set of paths, relative to install_dir, that the packages
+    installed there according to installed_config own: see _owned_paths().
+    """
+    install_dir = os.path.normcase(os.path.realpath(install_dir))
+    owned = set()
+    for package in installed_config.installables.itervalues():
+        if package.as_source or not package.install_dir or \
+           os.path.normcase(os.path.realpath(package.install_dir)) != install_dir:
+            continue
+        for platform in package.platforms.itervalues():
+            owned.update(_owned_paths(platform.manifest or []))
+    return owned
+
+def _owned_paths(manifest):
+    """
+    Return the set of the normalized paths in manifest and of every
+    directory that contains one of them.
+    """
+    owned = set()
+    for f in manifest:
+        f = os.path.normpath(f)
+        while f and f not in owned:
+            owned.add(f)
+            f = os.path.dirname(f)
+    return owned
+
+def _remove_files(install_dir, manifest, shared=frozenset(), threads=None):
+    """
+    Remove the files and directories named in manifest, relative to
+    install_dir, except those in shared: the paths, as from _owned_paths(),
+    that other packages still own.
+
+    A directory that holds files named in manifest but nothing of another
+    package's is removed whole, without considering the files within it one
+    at a time -- provided that it still holds nothing manifest doesn't name,
+    such as a file the user added or another install has just extracted.
+    Otherwise each file is removed, and each directory only if it is then
+    empty. Up to 'threads' (default UNINSTALL_THREADS) threads
+    remove files and directories at once.
+    """
+    names = [os.path.normpath(f) for f in manifest]
+    containers = _owned_paths(os.path.dirname(f) for f in names if os.path.dirname(f))
+    containers.add(os.curdir)
+    # Named directories of our files that no other package's files share:
+    # remove the outermost of them whole. Never remove the install directory
+    # itself that way, or anything outside it.
+    exclusive = set(f for f in names if f in containers and f not in shared
+                    and f != os.curdir and not f.startswith(os.pardir) and not os.path.isabs(f))
+    trees = [f for f in exclusive if not _has_ancestor(f, exclusive)]
+    # Anything else of ours not within those -- in reverse order, since
+    # archives name directories before the files they contain.
+    singles = [f for f in reversed(names) if f not in shared and f not in containers
+               and not _has_ancestor(f, exclusive)]
+    leftovers = [f for f in reversed(names) if f not in shared and f in containers
+                 and f not in exclusive]
+    ours = set(names)
+    work = [(_remove_tree, (f, ours)) for f in trees] + [(_remove_path, (f,)) for f in singles]
+    if threads is None:
+        threads = UNINSTALL_THREADS
+    if threads > 1 and len(work) > 1:
+        removals = _BackgroundMap(lambda (remove, args): remove(install_dir, *args), work, threads)
         try:
-            os.remove(fn)
-            # We used to print "removing f" before the call above, the
-            # assumption being that we'd either succeed or produce a
-            # traceback. But there are a couple different ways we could get
-            # through this logic without actually deleting. So produce a
-            # message only when we're sure we've actually deleted something.
-            logger.debug("    removed " + f)
-        except OSError, err:
-            if err.errno == errno.ENOENT:
-                # this file has already been deleted for some reason -- fine
-                pass
-            elif err.errno == dict(win32=errno.EACCES,
-                                   darwin=errno.EPERM,
-                                   linux2=errno.EISDIR).get(sys.platform):
-                # This can happen if we're trying to remove a directory.
-                # Obnoxiously, the specific errno for this error varies by
-                # platform. While we could call isdir(fn) beforehand, we
-                # expect directory names to pop up only a small fraction of
-                # the time, and doing it reactively improves usual-case
-                # performance.
-                if not os.path.isdir(fn):
-                    # whoops, permission error trying to remove a file?!
-                    raise
-                # Okay, it's a directory, remove it with rmdir().
-                try:
-                    os.rmdir(fn)
-                    logger.debug("    removed " + f)
-                except OSError, err:
-                    # We try to remove directories named in the install
-                    # archive in case these directories were created solely
-                    # for this package. But the package can't know whether a
-                    # given target directory is shared with other packages, so
-                    # the attempt to remove the dir may fail because it still
-                    # contains files.
-                    if err.errno != errno.ENOTEMPTY:
-                        raise
-                    logger.debug("    leaving " + f)
-            else:
-                # no idea what this exception is, better let it propagate
+            for index in xrange(len(work)):
+                removals.result(index)
+        finally:
+            removals.cancel()
+    else:
+        for remove, args in work:
+            remove(install_dir, *args)
+    # e.g. the install directory, once the rest is gone
+    for f in leftovers:
+        _remove_path(install_dir, f)
+
+def _has_ancestor(path, directories):
+    """
+    Return True if any of the set of paths directories contains path.
+    """
+    path = os.path.dirname(path)
+    while path:
+        if path in directories:
+            return True
+        path = os.path.dirname(path)
+    return False
+
+def _remove_tree(install_dir, f, names):
+    """
+    Remove the directory f, relative to install_dir, and everything in it,
+    if everything in it is among the set of normalized paths names. If it
+    holds anything else, remove just what names lists, and f only if it is
+    then empty.
+    """
+    fn = os.path.join(install_dir, f)
+    if os.path.islink(fn) or not os.path.isdir(fn):
+        # not the directory its files made it out to be
+        _remove_path(install_dir, f)
+        return
+    # What the directory holds now, not what it held when the manifests
+    # were read: someone may have added to it since.
+    present = []
+    for dirpath, dirnames, filenames in os.walk(fn):
+        relative = os.path.relpath(dirpath, install_dir)
+        present.extend(os.path.normpath(os.path.join(relative, name))
+                       for name in dirnames + filenames)
+    others = [path for path in present if path not in names]
+    if not others:
+        shutil.rmtree(fn)
+        logger.debug("    removed " + f + os.sep)
+        return
+    logger.debug("    %s holds %s unlisted files, such as %s" % (f, len(others), others[0]))
+    # deepest first, so that each directory is emptied before its removal
+    for path in sorted((path for path in present if path in names), reverse=True):
+        _remove_path(install_dir, path)
+    _remove_path(install_dir, f)
+
+def _remove_path(install_dir, f):
+    """
+    Remove the file, or the empty directory, f relative to install_dir.
+    """
+    # Some tarballs contain funky directory name entries (".//"). Use
+    # realpath() to dewackify them.
+    fn = os.path.normpath(os.path.join(install_dir, f))
+    try:
+        os.remove(fn)
+        # We used to print "removing f" before the call above, the
+        # assumption being that we'd either succeed or produce a
+        # traceback. But there are a couple different ways we could get
+        # through this logic without actually deleting. So produce a
+        # message only when we're sure we've actually deleted something.
+        logger.debug("    removed " + f)
+    except OSError, err:
+        if err.errno == errno.ENOENT:
+            # this file has already been deleted for some reason -- fine
+            pass
+        elif err.errno == dict(win32=errno.EACCES,
+                               darwin=errno.EPERM,
+                               linux2=errno.EISDIR).get(sys.platform):
+            # This can happen if we're trying to remove a directory.
+            # Obnoxiously, the specific errno for this error varies by
+            # platform. While we could call isdir(fn) beforehand, we
+            # expect directory names to pop up only a small fraction of
+            # the time, and doing it reactively improves usual-case
+            # performance.
+            if not os.path.isdir(fn):
+                # whoops, permission error trying to remove a file?!
                 raise
+            # Okay, it's a directory, remove it with rmdir().
+            try:
+                os.rmdir(fn)
+                logger.debug("    removed " + f)
+            except OSError, err:
+                # We try to remove directories named in the install
+                # archive in case these directories were created solely
+                # for this package. But a directory no other package owns
+                # may still hold files that no manifest names, so the
+                # attempt to remove the dir may fail because it still
+                # contains files.
+                if err.errno != errno.ENOTEMPTY:
+                    raise
+                logger.debug("    leaving " + f)
+        else:
+            # no idea what this exception is, better let it propagate
+            raise
 
 def install_packages(options, args):
     # load the list of packages to install
@@ -521,7 +1213,8 @@ def install_packages(options, args):
 
     # load the list of already installed packages
     logger.debug("loading " + installed_filename)
-    installed_file = configfile.ConfigurationDescription(installed_filename)
+    installed_file = configfile.ConfigurationDescription(installed_filename,
+                                                         shard_installables=True)
 
     # handle any arguments to query for information
     if handle_query_args(options, config_file, installed_file):
@@ -534,15 +1227,35 @@ def install_packages(options, args):
     if options.check_license:
         pre_install_license_check(packages, config_file)
 
+    # If the install cache is size-limited, trim it in the background while
+    # we work -- sparing any archive this run may need.
+    evictor = None
+    max_bytes = install_cache.get_cache_max_bytes()
+    if max_bytes is not None and not options.dry_run:
+        evictor = install_cache.CacheEvictor(
+            max_bytes, _get_archive_paths(packages, config_file, options.platform),
+            since=time.time())
+        evictor.start()
+
     # do the actual install of the new/updated packages
-    packages = do_install(packages, config_file, installed_file, options.platform, install_dir,
-                          options.dry_run, as_source=options.as_source)
+    try:
+        packages = do_install(packages, config_file, installed_file, options.platform, install_dir,
+                              options.dry_run, as_source=options.as_source, jobs=options.jobs,
+                              only=options.only, exclude=options.exclude)
+    finally:
+        if evictor is not None:
+            evictor.wait()
+        # Update the installed-packages.xml file even if some package failed:
+        # those that were installed (or uninstalled to be upgraded) must be
+        # recorded, or nothing could uninstall them.
+        _save_installed(installed_file)
 
     # check the license_file properties for actually-installed packages
     if options.check_license and not options.dry_run:
         post_install_license_check(packages, config_file, installed_file)
+    return 0
 
-    # update the installed-packages.xml file
+def _save_installed(installed_file):
     try:
         # in case we got this far without ever having created installed_file's
         # parent directory
@@ -551,7 +1264,6 @@ def install_packages(options, args):
         if err.errno != errno.EEXIST:
             raise
     installed_file.save()
-    return 0
 
 # define the entry point to this autobuild tool
 class AutobuildTool(autobuild_base.AutobuildBase):
@@ -35,6 +35,7 @@ import pprint
 import argparse
 import configfile
 import autobuild_base
+import hash_algorithms
 import re
 from common import AutobuildError
 import logging
@@ -208,7 +209,7 @@ def _do_add(config, installable_name, arguments, archive_path):
             installable_name = archive_installable_name
         absolute_path = config.absolute_path(archive_path)
         try:
-            installable_data['hash'] = common.compute_md5(absolute_path)
+            installable_data['hash'] = hash_algorithms.compute_hash('md5', absolute_path)
             installable_data['hash_algorithm'] = 'md5'
         except:
             pass
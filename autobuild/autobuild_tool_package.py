@@ -203,13 +203,6 @@ def _create_tarfile(tarfilename, build_directory, filelist):
     # Not using logging, since this output should be produced unconditionally on stdout
     # Downstream build tools utilize this output
     print "wrote  %s" % tarfilename
-    import hashlib
-    fp = open(tarfilename, 'rb')
-    m = hashlib.md5()
-    while True:
-        d = fp.read(65536)
-        if not d: break
-        m.update(d)
     # Not using logging, since this output should be produced unconditionally on stdout
     # Downstream build tools utilize this output
-    print "md5    %s" % m.hexdigest()
+    print "md5    %s" % common.compute_md5(tarfilename)
@@ -107,7 +107,8 @@ def uninstall_packages(options, args):
 
     # load the list of already installed packages
     logger.debug("loading " + installed_filename)
-    installed_file = configfile.ConfigurationDescription(installed_filename)
+    installed_file = configfile.ConfigurationDescription(installed_filename,
+                                                         shard_installables=True)
 
     for package in args:
         uninstall(package, installed_file)
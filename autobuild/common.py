@@ -38,20 +38,72 @@ Date   : 2010-04-13
 import re
 import os
 import sys
+import copy
 import glob
+import fnmatch
+import mmap
+import errno
 import itertools
 import logging
 import shutil
+import stat
+import struct
+import Queue
 import subprocess
+import thread
+import threading
 import tarfile
 import tempfile
+import time
 import urllib2
+import zipfile
 
 
 logger = logging.getLogger('autobuild.common')
 
 AUTOBUILD_VERSION_STRING = "0.8"
 
+# Downloads are copied to the install cache in chunks of this many bytes.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def get_env_count(name, default):
+    """
+    Return the positive whole number given by the environment variable name,
+    or default if it isn't set. A value that isn't a number is ignored, with
+    a warning, and one less than 1 taken as 1.
+    """
+    value = os.environ.get(name, "").strip()
+    if not value:
+        return default
+    try:
+        return max(int(value), 1)
+    except ValueError:
+        logger.warning("ignoring %s=%r: not a number" % (name, value))
+        return default
+
+# Files are hashed in chunks of this many bytes; override with the
+# AUTOBUILD_HASH_BUFFER_SIZE environment variable.
+HASH_BUFFER_SIZE = get_env_count('AUTOBUILD_HASH_BUFFER_SIZE', 1024 * 1024)
+
+# Set this environment variable to a directory to use it as the install cache
+# instead of the per-user default. Several users (e.g. the service accounts of
+# build agents) may share it, given a common group; see install_cache.
+INSTALL_CACHE_ENV = 'AUTOBUILD_INSTALL_CACHE'
+
+# Extracted files are written by this many threads, which helps most on
+# network filesystems; override with the AUTOBUILD_EXTRACT_THREADS
+# environment variable. 1 writes each file as it is read from the archive.
+EXTRACT_THREADS = get_env_count('AUTOBUILD_EXTRACT_THREADS', 4)
+
+# Files of at most this many bytes are handed to the writer threads; larger
+# ones are copied straight from the archive, without holding them in memory.
+EXTRACT_THREAD_MAX_SIZE = 1024 * 1024
+
+# Set the AUTOBUILD_EXTRACT_RESTORE_ATTRIBUTES environment variable to 0 to
+# leave extracted files with the modification time and owner that writing
+# them gives them, rather than setting those recorded in the archive.
+EXTRACT_RESTORE_ATTRIBUTES = os.environ.get('AUTOBUILD_EXTRACT_RESTORE_ATTRIBUTES', '1') != '0'
+
 
 class AutobuildError(RuntimeError):
     pass
@@ -117,9 +169,21 @@ def get_autobuild_environment():
 def get_default_install_cache_dir():
     """
     In general, the package archives do not change much, so find a 
-    host/user specific location to cache files.
+    host/user specific location to cache files -- unless INSTALL_CACHE_ENV
+    names a shared one.
     """
-    return get_temp_dir("install.cache")
+    shared = os.environ.get(INSTALL_CACHE_ENV)
+    if not shared:
+        return get_temp_dir("install.cache")
+    if not os.path.isdir(shared):
+        ensure_directory(shared)
+        try:
+            # group-writable, and setgid so that everything created in it
+            # belongs to the same group
+            os.chmod(shared, 02775)
+        except OSError, err:
+            logger.warning("unable to share install cache %s: %s" % (shared, err))
+    return shared
 
 def get_s3_url():
     """
@@ -214,13 +278,45 @@ def compute_md5(path):
         from hashlib import md5      # Python 2.6
     except ImportError:
         from md5 import new as md5   # Python 2.5 and earlier
-    stream = open(path, 'rb')
     try:
-        hasher = md5(stream.read())
+        hasher = hash_file(md5(), path)
     except:
         raise AutobuildError('error computing hash')
     return hasher.hexdigest()
 
+def hash_file(hasher, path, buffer_size=None):
+    """
+    Feed the contents of the file at path to hasher (any object with the
+    hashlib update() method) buffer_size bytes at a time, HASH_BUFFER_SIZE by
+    default, so memory use stays flat however large the file. Where
+    possible the file is memory-mapped and handed to hasher in slices without
+    copying; otherwise it is read normally. Returns hasher.
+    """
+    buffer_size = buffer_size or HASH_BUFFER_SIZE
+    stream = open(path, 'rb')
+    try:
+        try:
+            mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OverflowError, EnvironmentError):
+            # Empty files can't be mapped, nor can files too big for the
+            # address space.
+            mapped = None
+        if mapped is None:
+            while True:
+                chunk = stream.read(buffer_size)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+        else:
+            try:
+                for offset in xrange(0, len(mapped), buffer_size):
+                    hasher.update(buffer(mapped, offset, buffer_size))
+            finally:
+                mapped.close()
+    finally:
+        stream.close()
+    return hasher
+
 def does_package_match_md5(package, md5sum):
     """
     Returns True if the MD5 sum of the downloaded package archive
@@ -228,30 +324,44 @@ def does_package_match_md5(package, md5sum):
     """
     return compute_md5(get_package_in_cache(package)) == md5sum
 
-def download_package(package):
+def download_package(package, hasher=None, cachename=None):
     """
-    Download a package, specified as a URL, to the install cache.
+    Download a package, specified as a URL, to the install cache, or to
+    cachename if given.
     If the package already exists in the cache then this is a no-op.
     Returns False if there was a problem downloading the file.
+
+    If a hasher object (with the hashlib update() interface) is passed, it
+    is fed the contents of the cached file: as each chunk arrives when
+    downloading, or read from the cache otherwise.
     """
 
     # have we already downloaded this file to the cache?
-    cachename = get_package_in_cache(package)
+    if cachename is None:
+        cachename = get_package_in_cache(package)
     if os.path.exists(cachename):
         logger.info("package already in cache: %s" % cachename)
+        if hasher is not None:
+            hash_file(hasher, cachename)
         return True
 
-    # Set up the 'scp' handler
+    # Set up the 'scp' handler. Use this opener directly rather than
+    # installing it with urllib2.install_opener(): that would replace a
+    # process-wide global that other threads may be downloading through.
     opener = urllib2.build_opener()
     scp_or_http = __SCPOrHTTPHandler(get_default_scp_command())
     opener.add_handler(scp_or_http)
-    urllib2.install_opener(opener)
 
     # Attempt to download the remote file 
     logger.info("downloading %s to %s" % (package, cachename))
     result = True
     try:
-        file(cachename, 'wb').write(urllib2.urlopen(package).read())
+        ensure_directory(os.path.dirname(cachename))
+        source = opener.open(package)
+        try:
+            _stream_to_file(source, cachename, hasher)
+        finally:
+            source.close()
     except Exception, e:
         logger.exception("unable to download file: %s" % e)
         result = False
@@ -260,7 +370,41 @@ def download_package(package):
     scp_or_http.cleanup()
     return result
 
+def rename_into_place(tmpname, pathname):
+    """
+    Rename tmpname to pathname, replacing any existing pathname. This is
+    atomic on POSIX; Windows refuses to rename over an existing file, so
+    there we have to remove it first.
+    """
+    try:
+        os.rename(tmpname, pathname)
+    except OSError:
+        if get_current_platform() != PLATFORM_WINDOWS or not os.path.exists(pathname):
+            raise
+        os.remove(pathname)
+        os.rename(tmpname, pathname)
+
+def ensure_directory(path):
+    """
+    Create directory path (and any missing parents) unless it already exists.
+    Unlike a bare os.makedirs() call, this tolerates another thread or
+    process creating the same directory concurrently.
+    """
+    if os.path.isdir(path):
+        return
+    try:
+        os.makedirs(path)
+    except OSError, err:
+        if err.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
 def sanitize_symlinks(files, install_dir, package):
+    """
+    Add the unversioned libfoo.so symlink for each libfoo.so.N shared
+    library among files (relative to install_dir) that lacks one, pointing
+    at the library's SONAME where that exists. Return files plus the
+    symlinks added.
+    """
 
     # fixme: no dry_run 
     dry_run = False
@@ -277,10 +421,7 @@ def sanitize_symlinks(files, install_dir, package):
                     first = 0
                     print "Adding missing symlink(s) for package %s:" % package
                 target = os.path.basename(tfile)
-                soname = os.popen("readelf -d \"%(install_dir)s/%(tfile)s\" %(stderr_redirect)s"
-                    " | grep SONAME | sed -e 's/.*\[//;s/\].*//'" %
-                                                    {"install_dir": install_dir, "tfile": tfile, "stderr_redirect": ("2>/dev/null" if dry_run else "")}).read()
-                soname = soname.strip()
+                soname = _read_elf_soname(install_dir + "/" + tfile)
                 if soname:  # not empty
                     tmpfname = os.path.dirname(LINK) + "/" + soname
                     if os.path.exists(install_dir + "/" + tmpfname):
@@ -289,18 +430,20 @@ def sanitize_symlinks(files, install_dir, package):
                         print "WARNING: SONAME %s doesn't exist!" % tmpfname
                 if not dry_run:
                     os.symlink(target, link_name)
-                symlinks += [LINK]
+                symlinks.append(LINK)
                 print "    %s --> %s" % (LINK, target)
-                files += symlinks
-    return files
+    return files + symlinks
 
-def extract_and_convert_package(package, install_dir, structure):
+def extract_and_convert_package(package, install_dir, structure, cachename=None, stream=None):
     """
     Extract the contents of a downloaded package to the specified
     directory.  Returns the list of files that were successfully
     extracted.
-    If dir_structure is given, files will be moved according to the rules
-    defined in dir_structure, and the list of moved files is returned.
+    If dir_structure is given, files are placed according to the rules
+    defined in dir_structure as they are extracted, and the list of placed
+    files is returned. Each member is placed by the longest rule matching
+    (whole components of) its directory; members no rule matches are not
+    extracted.
     Example archive map that moves files from a legacy viewer package to the new locations:
                 <key>archive</key>
                 <map>
@@ -322,93 +465,207 @@ def extract_and_convert_package(package, install_dir, structure):
                 </map>
      Note that also directories that are not actually moved need to be included, that uninstall
      can remove them properly (e.g LICENSES).
+    cachename and stream, if given, say where to read the archive; see
+    extract_package().
     """
 
-    files = extract_package(package, install_dir)
-
-    # nothing to convert, just return files
-    if (structure == 'None') or not structure :
-       if get_current_platform() == 'linux' or get_current_platform() == 'linux64':
-         return sanitize_symlinks(files, install_dir, package)
-       else:
-         return files
-    # convert directory structure
-
-    moved_files = []
-
-    for f in files:
-        file_name =  os.path.basename(f)
-
-        src_dir = os.path.dirname(f)
-        src_full_path = os.path.join(install_dir,src_dir,file_name)
-
-        dst_dir = 'None'
-        for k in structure.keys():
-            if src_dir.startswith(k):
-               new_value = structure.get(k)
-               dst_dir = src_dir.replace(k, new_value, 1)
-               break
-
-        dst_full_path = 'skipped'
-        if dst_dir != "None":
-           dst_full_path = os.path.join(install_dir,dst_dir,file_name)
-           dst_rel_path = os.path.join(dst_dir,file_name)
-           dst_inst_dir = os.path.join(install_dir,dst_dir)
-           if os.path.lexists(src_full_path):
-              if os.path.isdir(src_full_path):
-                 if not os.path.lexists(dst_inst_dir):
-                    os.makedirs(dst_inst_dir, 0755)
-              elif  src_full_path != dst_full_path:
-                    if not os.path.lexists(dst_inst_dir):
-                       os.makedirs(dst_inst_dir, 0755)
-                    shutil.move(src_full_path, dst_full_path)
-                    print "Moving: {0}\n     -> {1}".format(src_full_path, dst_full_path)
-	   elif not os.path.lexists(dst_full_path):
-              print "oh noes, not moved - source doesn't exist: ", src_full_path
-           if os.path.lexists(dst_full_path):
-              if not os.path.isdir(src_full_path):
-                 moved_files.append(dst_rel_path)
-           elif not os.path.isdir(src_full_path):
-                print "oh noes, not moved: ", src_full_path
-
-    # remove empty directories - this needs more work
-    for f in files:
-        check_dir = os.path.join(install_dir,os.path.dirname(f))
-        #check_file = os.path.join(install_dir,f)
-        if os.path.exists(check_dir) and os.path.isdir(check_dir) and not os.listdir(check_dir):
-           os.removedirs(check_dir)
-        #elif os.path.exists(check_file) and not os.path.isdir(check_file):
-           #os.remove(check_file)
+    files = extract_package(package, install_dir, cachename, stream, structure)
+    return add_missing_symlinks(package, install_dir, files)
 
+def add_missing_symlinks(package, install_dir, files):
+    """
+    On Linux, add the missing unversioned symlinks to the shared libraries
+    among the specified files of a package already placed in install_dir;
+    see sanitize_symlinks(). Return the list of resulting files.
+    """
     if get_current_platform() == 'linux' or get_current_platform() == 'linux64':
-      return sanitize_symlinks(moved_files, install_dir, package)
+        return sanitize_symlinks(files, install_dir, package)
     else:
-      return moved_files
+        return files
+
 
-def extract_package(package, install_dir):
+class DirStructure(object):
+    """
+    An archive's dir_structure, as described for
+    extract_and_convert_package(), compiled into a trie of path components:
+    remap() finds the longest rule matching a member name in one walk down
+    its directories, however many rules there are.
+    """
+    def __init__(self, structure):
+        # Each node maps a path component to its child node; the None key of
+        # a node holds the destination components for the path ending there.
+        self._root = {}
+        for source, dest in structure.items():
+            node = self._root
+            for part in _path_parts(source):
+                node = node.setdefault(part, {})
+            node[None] = _path_parts(dest)
+
+    def remap(self, name, isdir=False):
+        """
+        Return the name at which to place the archive member name, or None
+        if no rule places it. A file is placed according to its directory,
+        a directory according to its own name.
+        """
+        parts = _path_parts(name)
+        node = self._root
+        match = (node[None], 0) if None in node else None
+        for depth, part in enumerate(parts if isdir else parts[:-1]):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node:
+                match = (node[None], depth + 1)
+        if match is None:
+            return None
+        dest, depth = match
+        return "/".join(dest + parts[depth:]) or "."
+
+def get_dir_structure(structure):
+    """
+    Return a DirStructure for an archive's dir_structure, or None if it
+    hasn't one.
+    """
+    if not structure or structure == 'None':
+        return None
+    return DirStructure(structure)
+
+
+class MemberFilter(object):
+    """
+    Selects which archive members to extract by glob patterns on the names
+    they are placed at: a member is extracted if it or a directory containing
+    it matches one of the 'only' patterns (if any are given) and neither it
+    nor a directory containing it matches one of the 'exclude' patterns.
+    Directories are also extracted if an 'only' pattern may match something
+    inside them. Like DirStructure, whose placement (if structure is given)
+    is applied first, it has a remap() method.
+    """
+    def __init__(self, only=None, exclude=None, structure=None):
+        only, exclude = _pattern_list(only), _pattern_list(exclude)
+        self._only = _compile_patterns(only)
+        self._only_parts = [pattern.split("/") for pattern in only]
+        self._exclude = _compile_patterns(exclude)
+        self._structure = structure
+
+    def remap(self, name, isdir=False):
+        """
+        Return the name at which to place the archive member name, or None
+        if it isn't to be extracted.
+        """
+        if self._structure is not None:
+            name = self._structure.remap(name, isdir)
+            if name is None:
+                return None
+        parts = _path_parts(name)
+        if self._exclude is not None and _matches_path(self._exclude, parts):
+            return None
+        if self._only is not None and not _matches_path(self._only, parts) and \
+           not (isdir and self._may_contain_match(parts)):
+            return None
+        return name
+
+    def _may_contain_match(self, parts):
+        # Might an 'only' pattern match something inside directory parts?
+        for pattern in self._only_parts:
+            if len(pattern) > len(parts) and \
+               all(fnmatch.fnmatch(part, pattern[index]) for index, part in enumerate(parts)):
+                return True
+        return False
+
+def get_member_map(structure=None, only=None, exclude=None):
+    """
+    Return an object whose remap() method places and selects archive
+    members according to an archive's dir_structure and 'only' and
+    'exclude' patterns (see MemberFilter), or None if all members are to be
+    extracted as they are.
+    """
+    if only or exclude:
+        return MemberFilter(only, exclude, get_dir_structure(structure))
+    return get_dir_structure(structure)
+
+def extract_package(package, install_dir, cachename=None, stream=None, structure=None,
+                    threads=None, restore_attributes=None, only=None, exclude=None, index=None):
     """
     Extract the contents of a downloaded package to the specified
     directory.  Returns the list of files that were successfully
     extracted.
+    The archive is read from cachename if given, otherwise from the package's
+    usual place in the install cache; it may be any tar archive tarfile can
+    read, or a zip archive. If stream is given, it is a file-like object from
+    which to read the archive's uncompressed tar data instead, e.g. as
+    decompressed by parallel_bzip2.
+    If structure, the archive's dir_structure, is given, each member is
+    extracted straight to the place it specifies; see
+    extract_and_convert_package().
+    threads and restore_attributes, if given, override EXTRACT_THREADS and
+    EXTRACT_RESTORE_ATTRIBUTES.
+    If only or exclude, lists of glob patterns, are given, members are
+    selected as described for MemberFilter; the rest are neither extracted
+    nor listed.
+    If index, an archive_index.IndexBuilder, is given, every member read
+    from a tar archive is added to it.
+    """
+    names = iter_extract_package(package, install_dir, cachename, stream, structure,
+                                 threads, restore_attributes, only, exclude, index)
+    if names is None:
+        return False
+    return list(names)
+
+def iter_extract_package(package, install_dir, cachename=None, stream=None, structure=None,
+                         threads=None, restore_attributes=None, only=None, exclude=None,
+                         index=None):
+    """
+    Like extract_package(), but return an iterator that extracts the archive
+    one member at a time as it is advanced, yielding the name of each,
+    or None if the package can't be extracted.
+
+    The archive is read once, front to back, and the tarfile is kept from
+    accumulating its TarInfo objects, so memory use doesn't grow with the
+    number of members. Decompression happens on the calling thread, but the
+    files read are written by a bounded pool of threads (see
+    EXTRACT_THREADS), so a file may still be being written when its name is
+    yielded; all have been written once the iterator is exhausted.
+
+    A zip archive's members are listed by its central directory and, being
+    compressed independently, are decompressed by those threads too.
     """
 
     # Find the name of the package in the install cache
-    cachename = get_package_in_cache(package)
+    if cachename is None:
+        cachename = get_package_in_cache(package)
     if not os.path.exists(cachename):
         logger.error("cannot extract non-existing package: %s" % cachename)
-        return False
+        return None
 
     # Attempt to extract the package from the install cache
     logger.debug("extracting from %s" % cachename)
-    tar = tarfile.open(cachename, 'r')
-    try:
-        # try to call extractall in python 2.5. Phoenix 2008-01-28
-        tar.extractall(path=install_dir)
-    except AttributeError:
-        # or fallback on pre-python 2.5 behavior
-        __extractall(tar, path=install_dir)
+    if threads is None:
+        threads = EXTRACT_THREADS
+    if restore_attributes is None:
+        restore_attributes = EXTRACT_RESTORE_ATTRIBUTES
+    member_map = get_member_map(structure, only, exclude)
+    if stream is None and is_zip_archive(cachename):
+        return _extract_zip(zipfile.ZipFile(cachename), install_dir, member_map,
+                            threads, restore_attributes)
+    if stream is not None:
+        tar = tarfile.open(fileobj=stream, mode='r|')
+    else:
+        tar = tarfile.open(cachename, 'r|*')
+    return _extract_tar_stream(tar, install_dir, member_map, threads, restore_attributes, index)
 
-    return tar.getnames()
+def is_zip_archive(pathname):
+    """
+    Return True if the file pathname is a zip archive rather than a tarball.
+    """
+    # Check the start of the file: zipfile.is_zipfile() looks for a central
+    # directory near the end, which an uncompressed tar ending with a zip
+    # member also has.
+    archive = open(pathname, 'rb')
+    try:
+        return archive.read(4) in ("PK\x03\x04", "PK\x05\x06")
+    finally:
+        archive.close()
 
 def remove_package(package):
     """
@@ -539,7 +796,8 @@ class __SCPOrHTTPHandler(urllib2.BaseHandler):
         url.insert(0, "http://")
         url = ''.join(url)
         logger.info("using HTTP: " + url)
-        return urllib2.urlopen(url)
+        # self.parent is the opener that owns this handler
+        return self.parent.open(url)
 
     def do_scp(self, remote):
         if not self._dir:
@@ -558,49 +816,463 @@ class __SCPOrHTTPHandler(urllib2.BaseHandler):
         if self._dir:
             shutil.rmtree(self._dir)
 
-#
-# *NOTE: PULLED FROM PYTHON 2.5 tarfile.py Phoenix 2008-01-28
-#
-def __extractall(tar, path=".", members=None):
-    """Extract all members from the archive to the current working
-       directory and set owner, modification time and permissions on
-       directories afterwards. `path' specifies a different directory
-       to extract to. `members' is optional and must be a subset of the
-       list returned by getmembers().
+# ELF identification, and the few header fields _read_elf_soname() needs
+_ELF_MAGIC = "\x7fELF"
+_ELF_CLASSES = {
+    # EI_CLASS: (header fields after e_ident, program header, indexes of
+    # p_type, p_offset, p_vaddr and p_filesz in it, dynamic entry)
+    1: ("HHIIIIIHHHHHH", "IIIIIIII", (0, 1, 2, 4), "iI"),
+    2: ("HHIQQQIHHHHHH", "IIQQQQQQ", (0, 2, 3, 5), "qQ"),
+    }
+_ELF_BYTE_ORDERS = {1: "<", 2: ">"}
+_PT_LOAD, _PT_DYNAMIC = 1, 2
+_DT_NULL, _DT_STRTAB, _DT_SONAME = 0, 5, 14
+
+def _read_elf_soname(pathname):
     """
-    directories = []
+    Return the SONAME recorded in the dynamic section of the ELF shared
+    library at pathname, or "" if it has none or isn't a readable ELF file:
+    what 'readelf -d' would report, reading only the ELF header, program
+    headers, dynamic section and the SONAME string itself.
+    """
+    try:
+        elf = open(pathname, 'rb')
+    except IOError:
+        return ""
+    try:
+        try:
+            ident = elf.read(16)
+            if len(ident) < 16 or not ident.startswith(_ELF_MAGIC) or \
+               ord(ident[4]) not in _ELF_CLASSES or ord(ident[5]) not in _ELF_BYTE_ORDERS:
+                return ""
+            header_format, phdr_format, phdr_fields, dyn_format = _ELF_CLASSES[ord(ident[4])]
+            order = _ELF_BYTE_ORDERS[ord(ident[5])]
+
+            def read_struct(format, offset):
+                format = order + format
+                elf.seek(offset)
+                return struct.unpack(format, elf.read(struct.calcsize(format)))
+
+            header = read_struct(header_format, 16)
+            phoff, phentsize, phnum = header[4], header[8], header[9]
+            # (p_type, p_offset, p_vaddr, p_filesz) of each program header
+            segments = []
+            for index in xrange(phnum):
+                phdr = read_struct(phdr_format, phoff + index * phentsize)
+                segments.append(tuple(phdr[field] for field in phdr_fields))
+            dynamic = [seg for seg in segments if seg[0] == _PT_DYNAMIC]
+            if not dynamic:
+                return ""
+            _, offset, _, size = dynamic[0]
+            entry_size = struct.calcsize(order + dyn_format)
+            strtab = soname = None
+            for entry in xrange(offset, offset + size - entry_size + 1, entry_size):
+                tag, value = read_struct(dyn_format, entry)
+                if tag == _DT_NULL:
+                    break
+                elif tag == _DT_STRTAB:
+                    strtab = value
+                elif tag == _DT_SONAME:
+                    soname = value
+            if strtab is None or soname is None:
+                return ""
+            # DT_STRTAB is a virtual address: find the file offset of the
+            # loaded segment containing it.
+            for p_type, p_offset, p_vaddr, p_filesz in segments:
+                if p_type == _PT_LOAD and p_vaddr <= strtab < p_vaddr + p_filesz:
+                    elf.seek(strtab - p_vaddr + p_offset + soname)
+                    break
+            else:
+                return ""
+            name = []
+            while True:
+                chunk = elf.read(64)
+                if not chunk:
+                    break
+                end = chunk.find("\0")
+                if end >= 0:
+                    name.append(chunk[:end])
+                    break
+                name.append(chunk)
+            return "".join(name)
+        except (IOError, struct.error), err:
+            logger.debug("unable to read SONAME of %s: %s" % (pathname, err))
+            return ""
+    finally:
+        elf.close()
+
+def _stream_to_file(source, pathname, hasher=None):
+    """
+    Copy the file-like object source to pathname DOWNLOAD_CHUNK_SIZE bytes at
+    a time, so memory use doesn't depend on the size of the download. The
+    data is written to a temporary file beside pathname, which is renamed
+    into place only once the whole stream has been written: an interrupted
+    transfer never leaves a partial file under the final name. Each chunk is
+    also passed to hasher, if given.
+    """
+    # The temp name must be unique per process and per thread: several of
+    # either may be downloading into the same cache directory.
+    tmpname = "%s.%s-%s.part" % (pathname, os.getpid(), thread.get_ident())
+    try:
+        dest = open(tmpname, 'wb')
+        try:
+            size = _copy_stream(source, dest, hasher)
+        finally:
+            dest.close()
+        # A server closing the connection early looks just like EOF, so
+        # check the length if the server told us what to expect.
+        info = getattr(source, 'info', None)
+        expected = info and info().getheader('Content-Length')
+        if expected and expected.isdigit() and int(expected) != size:
+            raise AutobuildError("truncated download: got %s of %s bytes" % (size, expected))
+        rename_into_place(tmpname, pathname)
+    except:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        raise
 
-    if members is None:
+def _extract_tar_stream(tar, install_dir, structure=None, threads=1, restore_attributes=True,
+                        index=None):
+    """
+    Generator: extract the members of a tarfile opened in stream mode one at
+    a time, yielding the name of each, then close the tarfile. Members are
+    placed and selected according to structure, a DirStructure or
+    MemberFilter, if given.
+
+    Regular files are written by up to 'threads' _FileWriters threads while
+    the next members are decompressed. Unless restore_attributes, files and
+    directories keep the modification time and owner that extracting them
+    gives them. Every member read is added to index, if given.
+    """
+    writers = _FileWriters(threads, _write_member) if threads > 1 else None
+    # Each directory is created just once, by the calling thread, so the
+    # writers never need to. Several packages may be extracting into the
+    # same install_dir at once, which ensure_directory() allows for.
+    made_dirs = set()
+    # Directories placed at the same name by several dir_structure rules
+    # are reported once.
+    placed_dirs = set()
+    directories = []
+    try:
         members = tar
+        if index is not None:
+            members = _indexed_members(members, index)
+        if structure is not None:
+            members = _remap_members(members, structure)
+        for tarinfo in members:
+            path = os.path.join(install_dir, tarinfo.name)
+            parent = os.path.normpath(os.path.dirname(path))
+            if parent not in made_dirs:
+                ensure_directory(parent)
+                made_dirs.add(parent)
+            if tarinfo.isfile():
+                source = tar.extractfile(tarinfo)
+                if writers is not None and tarinfo.size <= EXTRACT_THREAD_MAX_SIZE:
+                    writers.write(tar, tarinfo, path, source.read(), restore_attributes)
+                else:
+                    _write_member(tar, tarinfo, path, source, restore_attributes)
+            else:
+                if writers is not None:
+                    # e.g. a hard link to a file still being written
+                    writers.flush()
+                if tarinfo.isdir():
+                    # As extractall() does: set directory permissions only at the
+                    # end, in case they forbid extracting the directory's contents.
+                    directories.append(tarinfo)
+                    ensure_directory(path)
+                    made_dirs.add(os.path.normpath(path))
+                else:
+                    tar.extract(tarinfo, install_dir)
+            # In stream mode, tarfile still remembers every member it has
+            # read; we don't need them.
+            del tar.members[:]
+            if tarinfo.isdir():
+                if tarinfo.name in placed_dirs:
+                    continue
+                placed_dirs.add(tarinfo.name)
+            yield tarinfo.name
+        if writers is not None:
+            writers.close()
+            writers = None
+        for tarinfo in reversed(directories):
+            dirpath = os.path.join(install_dir, tarinfo.name)
+            if restore_attributes:
+                tar.chown(tarinfo, dirpath)
+                tar.utime(tarinfo, dirpath)
+            tar.chmod(tarinfo, dirpath)
+    finally:
+        if writers is not None:
+            # stopped early: don't leave the threads waiting for more
+            writers.close(check=False)
+        tar.close()
+
+class _FileWriters(object):
+    """
+    A bounded pool of threads writing extracted files, each by calling
+    write_file with the arguments passed to write(). write() blocks while
+    twice as many files as there are threads are waiting to be written, so
+    memory use stays bounded. An error in a writer thread is raised by the
+    next call to write(), flush() or close().
+    """
+    def __init__(self, count, write_file):
+        self._write_file = write_file
+        self._queue = Queue.Queue(count * 2)
+        self._error = None
+        self._threads = []
+        for index in xrange(count):
+            writer = threading.Thread(target=self._run, name="extract-%s" % index)
+            writer.setDaemon(True)
+            writer.start()
+            self._threads.append(writer)
+
+    def write(self, *args):
+        self._check()
+        self._queue.put(args)
+
+    def flush(self):
+        """
+        Wait for every file passed to write() so far to be written.
+        """
+        self._queue.join()
+        self._check()
 
-    for tarinfo in members:
-        if tarinfo.isdir():
-            # Extract directory with a safe mode, so that
-            # all files below can be extracted as well.
+    def close(self, check=True):
+        """
+        Wait for the pending files to be written, and stop the threads.
+        """
+        for writer in self._threads:
+            self._queue.put(None)
+        for writer in self._threads:
+            writer.join()
+        if check:
+            self._check()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
             try:
-                os.makedirs(os.path.join(path, tarinfo.name), 0777)
-            except EnvironmentError:
-                pass
-            directories.append(tarinfo)
+                if item is None:
+                    return
+                if self._error is None:
+                    self._write_file(*item)
+            except:
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+def _write_member(tar, tarinfo, path, source, restore_attributes):
+    """
+    Write the regular file member tarinfo of tar to path, from source: its
+    contents, or a file-like object to copy them from. Set its permissions
+    and, if restore_attributes, its owner and modification time.
+    """
+    # As tarfile would, replace what's there -- but don't write through it:
+    # it may be hard linked from the install cache.
+    if os.path.lexists(path) and not os.path.isdir(path):
+        os.remove(path)
+    target = open(path, 'wb')
+    try:
+        if isinstance(source, str):
+            target.write(source)
         else:
-            tar.extract(tarinfo, path)
+            shutil.copyfileobj(source, target, DOWNLOAD_CHUNK_SIZE)
+    finally:
+        target.close()
+    if restore_attributes:
+        tar.chown(tarinfo, path)
+    tar.chmod(tarinfo, path)
+    if restore_attributes:
+        tar.utime(tarinfo, path)
+
+def _extract_zip(archive, install_dir, structure=None, threads=1, restore_attributes=True):
+    """
+    Generator: extract the members of the ZipFile archive, as listed by its
+    central directory, yielding the name of each, then close it. Members are
+    placed and selected according to structure, a DirStructure or
+    MemberFilter, if given.
+
+    Regular files are decompressed and written by up to 'threads'
+    _FileWriters threads. Unless restore_attributes, files and directories
+    keep the modification time that extracting them gives them; zip
+    archives record no owner.
+    """
+    writers = _FileWriters(threads, _write_zip_member) if threads > 1 else None
+    made_dirs = set()
+    placed_dirs = set()
+    directories = []
+    try:
+        for info in archive.infolist():
+            parts = _path_parts(info.filename)
+            if not parts or ".." in parts:
+                logger.warning("not extracting %s: it is outside the install directory"
+                               % info.filename)
+                continue
+            name = "/".join(parts)
+            mode = info.external_attr >> 16
+            isdir = info.filename.endswith("/") or stat.S_ISDIR(mode)
+            if structure is not None:
+                placed = structure.remap(name, isdir)
+                if placed is None:
+                    logger.debug("not extracting %s" % name)
+                    continue
+                name = placed
+            path = os.path.join(install_dir, name)
+            parent = os.path.normpath(os.path.dirname(path))
+            if parent not in made_dirs:
+                ensure_directory(parent)
+                made_dirs.add(parent)
+            if isdir:
+                ensure_directory(path)
+                made_dirs.add(os.path.normpath(path))
+                directories.append((info, path))
+                if name in placed_dirs:
+                    continue
+                placed_dirs.add(name)
+            elif stat.S_ISLNK(mode) and hasattr(os, 'symlink'):
+                # Info-ZIP stores a symlink as a member holding its target.
+                if os.path.lexists(path) and not os.path.isdir(path):
+                    os.remove(path)
+                os.symlink(archive.read(info), path)
+            elif writers is not None:
+                writers.write(archive, info, path, restore_attributes)
+            else:
+                _write_zip_member(archive, info, path, restore_attributes)
+            yield name
+        if writers is not None:
+            writers.close()
+            writers = None
+        for info, path in reversed(directories):
+            _set_zip_attributes(info, path, restore_attributes)
+    finally:
+        if writers is not None:
+            writers.close(check=False)
+        archive.close()
+
+def _write_zip_member(archive, info, path, restore_attributes):
+    """
+    Decompress the regular file member info of the ZipFile archive to path,
+    and set its attributes. Safe to call from several threads at once: a
+    ZipFile opened by name opens the file afresh for each member it reads.
+    """
+    if os.path.lexists(path) and not os.path.isdir(path):
+        os.remove(path)
+    source = archive.open(info)
+    try:
+        target = open(path, 'wb')
+        try:
+            shutil.copyfileobj(source, target, DOWNLOAD_CHUNK_SIZE)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    _set_zip_attributes(info, path, restore_attributes)
+
+def _set_zip_attributes(info, path, restore_attributes):
+    """
+    Set the permissions of path to those recorded for zip member info, if it
+    was archived on a Unix system, and if restore_attributes, its
+    modification time.
+    """
+    # 3 is Unix, which keeps the st_mode in the high bits.
+    mode = stat.S_IMODE(info.external_attr >> 16)
+    if info.create_system == 3 and mode:
+        os.chmod(path, mode)
+    if restore_attributes:
+        try:
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+        except (OverflowError, ValueError):
+            # e.g. the all-zero date some tools write
+            return
+        os.utime(path, (mtime, mtime))
 
-    # Reverse sort directories.
-    directories.sort(lambda a, b: cmp(a.name, b.name))
-    directories.reverse()
+def _indexed_members(members, index):
+    """
+    Yield each TarInfo in members after adding it to index.
+    """
+    for tarinfo in members:
+        index.add(tarinfo)
+        yield tarinfo
 
-    # Set correct owner, mtime and filemode on directories.
-    for tarinfo in directories:
-        path = os.path.join(path, tarinfo.name)
-        try:
-            tar.chown(tarinfo, path)
-            tar.utime(tarinfo, path)
-            tar.chmod(tarinfo, path)
-        except tarfile.ExtractError, e:
-            if tar.errorlevel > 1:
-                raise
-            else:
-                tar._dbg(1, "tarfile: %s" % e)
+def _remap_members(members, structure):
+    """
+    Yield a copy of each TarInfo in members renamed to where structure (a
+    DirStructure or MemberFilter) places it, skipping members it doesn't.
+    """
+    for tarinfo in members:
+        name = structure.remap(tarinfo.name, tarinfo.isdir())
+        if name is None:
+            logger.debug("not extracting %s" % tarinfo.name)
+            continue
+        tarinfo = copy.copy(tarinfo)
+        tarinfo.name = name
+        if tarinfo.islnk():
+            # a hard link names another member, which has moved too
+            tarinfo.linkname = structure.remap(tarinfo.linkname) or tarinfo.linkname
+        yield tarinfo
+
+def _pattern_list(patterns):
+    """
+    Return a list of the glob patterns, given a list or a single pattern,
+    each relative to the top of the install directory.
+    """
+    if not patterns:
+        return []
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    return ["/".join(_path_parts(pattern)) for pattern in patterns]
+
+def _compile_patterns(patterns):
+    """
+    Return a regular expression matching any of the glob patterns, or None
+    if there are none.
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join("(?:%s)" % fnmatch.translate(os.path.normcase(pattern))
+                               for pattern in patterns))
+
+def _matches_path(regex, parts):
+    """
+    Return True if regex matches the relative path made of parts, or of
+    any leading parts of it.
+    """
+    for index in xrange(1, len(parts) + 1):
+        if regex.match(os.path.normcase("/".join(parts[:index]))):
+            return True
+    return False
+
+def _path_parts(path):
+    """
+    Return the list of components of the relative path, ignoring empty and
+    '.' components.
+    """
+    return [part for part in path.replace("\\", "/").split("/") if part not in ("", ".")]
+
+
+def _copy_stream(source, dest=None, hasher=None):
+    """
+    Read source to EOF in DOWNLOAD_CHUNK_SIZE chunks, writing each chunk to
+    dest and feeding it to hasher (either may be None). Return the number of
+    bytes read.
+    """
+    size = 0
+    while True:
+        chunk = source.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        if dest is not None:
+            dest.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+        size += len(chunk)
+    return size
 
 #
 # Dependent package bootstrapping
@@ -27,9 +27,22 @@ API to access the autobuild configuration file.
 Author : Alain Linden
 """
 
+import re
 import os
-import pprint
 import sys
+import stat
+import time
+import array
+import errno
+import hashlib
+import thread
+import urllib
+import pprint
+import uuid
+import base64
+import itertools
+import collections
+import xml.parsers.expat
 import StringIO
 import common
 from executable import Executable
@@ -45,6 +58,18 @@ AUTOBUILD_CONFIG_FILE=os.environ.get("AUTOBUILD_CONFIG_FILE","autobuild.xml")
 AUTOBUILD_CONFIG_VERSION="1.2"
 AUTOBUILD_CONFIG_TYPE="autobuild"
 INSTALLED_CONFIG_FILE="installed-packages.xml"
+# A configuration file whose name ends with this is saved as binary LLSD, with
+# the paths of each installed package's manifest packed against a table of
+# the directories they are in: e.g. --installed-manifest=installed-packages.llsd.
+# Files of either format are read whatever their names.
+BINARY_CONFIG_SUFFIX=".llsd"
+# A configuration whose installables are saved each to a file of its own
+# keeps those files in a directory named for the configuration file with this
+# suffix in place of its extension, e.g. installed-packages.d.
+RECORDS_SUFFIX=".d"
+# Set this to 0 to parse configuration files without consulting, or adding
+# to, the per-user cache of parsed configuration files.
+CONFIG_CACHE_ENV="AUTOBUILD_CONFIG_CACHE"
 
 
 # FIXME: remove when refactor is complete
@@ -65,13 +90,25 @@ class ConfigurationDescription(common.Serialized):
     """
     
     path = None
+    # The directory in which save() writes each installable to a file of its
+    # own, if it does, and whether the files there have been loaded.
+    records_path = None
+    records_loaded = False
     
-    def __init__(self, path):
+    def __init__(self, path, shard_installables=False):
+        """
+        Load the configuration at path. If shard_installables, save() will
+        write the installables each to a file of its own, as it does anyway
+        for a configuration saved that way before.
+        """
         self.version = AUTOBUILD_CONFIG_VERSION
         self.type = AUTOBUILD_CONFIG_TYPE
-        self.installables = {}
+        self.installables = _LazyPackageDict()
         self.package_description = None
         self.__load(path)
+        if shard_installables and self.records_path is None:
+            self.records_path = os.path.splitext(self.path)[0] + RECORDS_SUFFIX
+        self.installables.changed.clear()
  
     def absolute_path(self, path):
         """
@@ -167,8 +204,92 @@ class ConfigurationDescription(common.Serialized):
     def save(self):
         """
         Save the configuration state to the input file.
+
+        If records_path is set, each installable is saved to a file of its
+        own in that directory instead, and only those added, replaced or
+        removed since the configuration was loaded are written: the input
+        file is just a small index naming the directory. So processes
+        changing different installables don't undo each other's changes.
         """
-        file(self.path, 'wb').write(llsd.format_pretty_xml(_compact_to_dict(self)))
+        start = time.time()
+        if self.records_path is None:
+            saved_data = _compact_to_dict(self)
+        else:
+            self.__save_records()
+            saved_data = _compact_to_dict(dict((key, value) for (key, value) in self.iteritems()
+                                               if key != 'installables'))
+            saved_data['installable_records'] = \
+                os.path.relpath(self.records_path, os.path.dirname(self.path))
+        text = self.__format(saved_data)
+        _write_file(self.path, text)
+        logger.debug("saved %s (%s bytes) in %.3f seconds" % (self.path, len(text), time.time() - start))
+
+    def __format(self, saved_data):
+        if self.path.endswith(BINARY_CONFIG_SUFFIX):
+            _pack_manifests(saved_data)
+            return llsd.format_binary(saved_data)
+        return llsd.format_pretty_xml(saved_data)
+
+    def __save_records(self):
+        if self.records_loaded and isinstance(self.installables, _ChangeTrackingDict):
+            changed = self.installables.changed
+        else:
+            # A new records directory: anything already in it is stale.
+            changed = set(self.installables)
+            try:
+                for filename in os.listdir(self.records_path):
+                    base, ext = os.path.splitext(filename)
+                    if ext in _RECORD_EXTENSIONS:
+                        changed.add(urllib.unquote(base))
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+        common.ensure_directory(self.records_path)
+        ext = self.path.endswith(BINARY_CONFIG_SUFFIX) and BINARY_CONFIG_SUFFIX or ".xml"
+        for name in changed:
+            base = os.path.join(self.records_path, urllib.quote(name, safe=""))
+            package = self.installables.get(name)
+            if package is not None:
+                record = dict(version=self.version, type=self.type,
+                              installables={name: package})
+                _write_file(base + ext, self.__format(_compact_to_dict(record)))
+            # and no other record of the same installable
+            for other in _RECORD_EXTENSIONS:
+                if package is None or other != ext:
+                    try:
+                        os.remove(base + other)
+                    except OSError, err:
+                        if err.errno != errno.ENOENT:
+                            raise
+        if isinstance(self.installables, _ChangeTrackingDict):
+            self.installables.changed.clear()
+        self.records_loaded = True
+
+    def __load_records(self):
+        try:
+            filenames = os.listdir(self.records_path)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            filenames = []
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1] not in _RECORD_EXTENSIONS:
+                # e.g. one still being written
+                continue
+            pathname = os.path.join(self.records_path, filename)
+            try:
+                record = _parse_config(pathname)
+            except EnvironmentError, err:
+                if err.errno == errno.ENOENT:
+                    # removed by another process since we listed it
+                    continue
+                raise
+            except llsd.LLSDParseError:
+                raise AutobuildError("Config file %s is corrupt. Aborting..." % pathname)
+            _unpack_manifests(record)
+            for (name, package) in record.get('installables', {}).iteritems():
+                self.installables.load(name, package)
+        self.records_loaded = True
             
     def __load(self, path):
         if os.path.isabs(path):
@@ -181,8 +302,9 @@ class ConfigurationDescription(common.Serialized):
             else:
                 self.path = abs_path
         if os.path.isfile(self.path):
+            start = time.time()
             try:
-                saved_data = llsd.parse(file(self.path, 'rb').read())
+                saved_data = _parse_config(self.path)
             except llsd.LLSDParseError:
                 raise AutobuildError("Config file %s is corrupt. Aborting..." % self.path)
             if not saved_data.has_key('version'):
@@ -192,14 +314,20 @@ class ConfigurationDescription(common.Serialized):
             if saved_data['version'] == self.version:
                 if (not saved_data.has_key('type')) or (saved_data['type'] != 'autobuild'):
                     raise AutobuildError(self.path + ' not an autobuild configuration file')
+                _unpack_manifests(saved_data)
                 package_description = saved_data.pop('package_description', None)
                 if package_description is not None:
                     self.package_description = PackageDescription(package_description)
                 installables = saved_data.pop('installables', {})
                 for (name, package) in installables.iteritems():
-                    self.installables[name] = PackageDescription(package)
+                    self.installables.load(name, package)
+                records = saved_data.pop('installable_records', None)
+                if records is not None:
+                    self.records_path = os.path.join(os.path.dirname(self.path), records)
+                    self.__load_records()
                 self.update(saved_data)
-                logger.debug("Configuration file '%s'" % self.path)
+                logger.debug("Configuration file '%s' loaded in %.3f seconds" %
+                             (self.path, time.time() - start))
             else:
                 if saved_data['version'] in update.updaters:
                     update.updaters[saved_data['version']](saved_data, self)
@@ -230,6 +358,8 @@ class PackageDescription(common.Serialized):
         platforms**
         as_source*
         install_dir*
+        only (optional)
+        exclude (optional)
 
     *As of 2010-10-18, the as_source and install_dir attributes are only used
     in PackageDescription objects stored in INSTALLED_CONFIG_FILE. Certain
@@ -240,6 +370,10 @@ class PackageDescription(common.Serialized):
     for different runs, INSTALLED_CONFIG_FILE also records the actual base
     directory into which that package is installed.
 
+    The optional only and exclude attributes are lists of glob patterns
+    selecting which of the package's files to install; see autobuild install.
+    In INSTALLED_CONFIG_FILE they record the selection actually installed.
+
     **Usage of PackageDescription.platforms is also a little different for a
     PackageDescription in INSTALLED_CONFIG_FILE's ConfigurationDescription
     .installables. When a package isn't installed at all, it should have no
@@ -423,16 +557,598 @@ def pretty_print_string(description):
     return stream.getvalue()
 
 
+# Bump to ignore cache entries written in an older format.
+_CONFIG_CACHE_VERSION = 2
+# The cache keeps the entries for this many of the most recently used files.
+_CONFIG_CACHE_MAX_ENTRIES = 1000
+# whether this process has pruned the cache yet
+_config_cache_pruned = False
+
+def _parse_config(path):
+    """
+    Return the contents of the configuration file path as parsed by
+    llsd.parse() -- from the cache of parsed configurations, if that has an
+    entry for path that is up to date, or else parsing the file and updating
+    the entry. An entry records the file's size, modification and change
+    times and inode, and the autobuild version that wrote it: any change to
+    the file, or a different autobuild, invalidates it. Only the entries of
+    the _CONFIG_CACHE_MAX_ENTRIES files most recently parsed are kept.
+
+    Entries are binary LLSD, and only those in a directory belonging to the
+    user, in files belonging to the user, are read: anyone else able to
+    plant one could make autobuild install whatever they liked.
+    """
+    if os.environ.get(CONFIG_CACHE_ENV, "1") == "0":
+        return _read_config(path)
+    path = os.path.abspath(path)
+    info = os.stat(path)
+    key = repr((path, info.st_size, info.st_mtime, info.st_ctime, info.st_ino,
+                common.AUTOBUILD_VERSION_STRING, _CONFIG_CACHE_VERSION))
+    try:
+        cache_dir = _get_config_cache_dir()
+    except EnvironmentError, err:
+        logger.debug("not caching %s: %s" % (path, err))
+        cache_dir = None
+    if cache_dir is None:
+        return _read_config(path)
+    cachename = os.path.join(cache_dir, hashlib.md5(path).hexdigest() + BINARY_CONFIG_SUFFIX)
+    saved_data = _read_cached_config(cachename, key)
+    if saved_data is not None:
+        logger.debug("using cached parse of %s" % path)
+        try:
+            # mark the entry as recently used
+            os.utime(cachename, None)
+        except OSError:
+            pass
+        return saved_data
+    saved_data = _read_config(path)
+    try:
+        _write_file(cachename, _format_cached_config(key, saved_data))
+    except (EnvironmentError, llsd.LLSDSerializationError, AttributeError, TypeError), err:
+        # including a file too odd to pack like a saved configuration
+        logger.debug("unable to cache parse of %s: %s" % (path, err))
+    global _config_cache_pruned
+    if not _config_cache_pruned:
+        _config_cache_pruned = True
+        _prune_config_cache(cache_dir)
+    return saved_data
+
+def _prune_config_cache(cache_dir):
+    """
+    Remove all but the _CONFIG_CACHE_MAX_ENTRIES most recently used entries
+    from the cache of parsed configuration files in cache_dir -- those of
+    files since removed, for instance, or of the records of packages since
+    uninstalled.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        pathname = os.path.join(cache_dir, name)
+        try:
+            entries.append((os.lstat(pathname).st_mtime, pathname))
+        except OSError:
+            # removed by another process since we listed it
+            continue
+    entries.sort(reverse=True)
+    for mtime, pathname in entries[_CONFIG_CACHE_MAX_ENTRIES:]:
+        try:
+            os.remove(pathname)
+        except OSError, err:
+            logger.debug("unable to prune cached parse %s: %s" % (pathname, err))
+
+def _get_config_cache_dir():
+    """
+    Return the directory holding the cache of parsed configuration files, or
+    None if it isn't the user's own. So is the directory containing it, which
+    no one else may write: otherwise they could replace the cache directory
+    once it had been checked.
+    """
+    cache_dir = common.get_temp_dir("config.cache")
+    if not hasattr(os, "geteuid"):
+        # Windows: the temp directory is within the user's profile
+        return cache_dir
+    parent = os.path.dirname(cache_dir)
+    info = os.lstat(parent)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.geteuid() or \
+       info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        logger.warning("not caching parsed configuration files: %s isn't yours alone" % parent)
+        return None
+    info = os.lstat(cache_dir)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.geteuid():
+        logger.warning("not caching parsed configuration files: %s isn't yours" % cache_dir)
+        return None
+    mode = stat.S_IMODE(info.st_mode)
+    if mode & (stat.S_IWGRP | stat.S_IWOTH):
+        os.chmod(cache_dir, mode & ~(stat.S_IWGRP | stat.S_IWOTH))
+    return cache_dir
+
+def _read_cached_config(cachename, key):
+    """
+    Return the parsed configuration cached in cachename, if it is there
+    under key and the file is the user's own, or else None.
+    """
+    try:
+        stream = open(cachename, 'rb')
+    except IOError, err:
+        if err.errno != errno.ENOENT:
+            logger.debug("ignoring cached parse %s: %s" % (cachename, err))
+        return None
+    try:
+        if hasattr(os, "geteuid") and os.fstat(stream.fileno()).st_uid != os.geteuid():
+            logger.debug("ignoring cached parse %s: it isn't yours" % cachename)
+            return None
+        entry = llsd.parse(stream.read())
+        if not isinstance(entry, dict) or entry.get('key') != key:
+            return None
+        # Binary LLSD reads every string as unicode, binary data as str and
+        # a uri as a string: restore what the file itself would parse to.
+        saved_data = _from_cache(entry['data'])
+        for keys in entry.get('uris', []):
+            container = saved_data
+            for k in keys[:-1]:
+                container = container[k]
+            container[keys[-1]] = llsd.uri(container[keys[-1]])
+        if entry.get('packed'):
+            _unpack_manifests(saved_data)
+        return saved_data
+    except (EnvironmentError, llsd.LLSDParseError, KeyError, IndexError, TypeError,
+            ValueError), err:
+        # a cache file cut short, or from some other program
+        logger.debug("ignoring cached parse %s: %s" % (cachename, err))
+        return None
+    finally:
+        stream.close()
+
+def _format_cached_config(key, saved_data):
+    """
+    Return the cache entry, as binary LLSD, for saved_data parsed from the
+    configuration file whose state is key. Installed manifests are packed as
+    save() would pack them, and the position of each uri is recorded, since
+    binary LLSD would otherwise read it back as a plain string.
+    """
+    uris = []
+    data = _to_cache(saved_data, [], uris)
+    packed = 'manifest_directories' not in data
+    if packed:
+        _pack_manifests(data)
+    return llsd.format_binary(dict(key=key, data=data, uris=uris, packed=packed))
+
+def _to_cache(value, keys, uris):
+    # copy the maps and arrays of value, adding the keys of each uri to uris
+    if isinstance(value, dict):
+        return dict((k, _to_cache(v, keys + [k], uris)) for (k, v) in value.iteritems())
+    if isinstance(value, list):
+        return [_to_cache(v, keys + [i], uris) for (i, v) in enumerate(value)]
+    if isinstance(value, llsd.uri):
+        uris.append(keys)
+    return value
+
+def _from_cache(value):
+    # str for ASCII strings as the XML parsers give, binary for binary data
+    if isinstance(value, unicode):
+        return _native(value)
+    if isinstance(value, str):
+        return llsd.binary(value)
+    if isinstance(value, dict):
+        return dict((_native(k), _from_cache(v)) for (k, v) in value.iteritems())
+    if isinstance(value, list):
+        return [_from_cache(v) for v in value]
+    return value
+
+def _read_config(path):
+    """
+    Return the contents of the configuration file path as parsed by
+    llsd.parse(), except that an XML file is parsed as it is read (see
+    _parse_xml()) rather than read whole and then parsed.
+    """
+    stream = file(path, 'rb')
+    try:
+        start = stream.read(64)
+        if not start.lstrip().startswith(("<?xml", "<llsd")):
+            # binary or notation LLSD, or XML with an LLSD header
+            return llsd.parse(start + stream.read())
+        return _parse_xml(itertools.chain([start], iter(lambda: stream.read(common.DOWNLOAD_CHUNK_SIZE), "")))
+    finally:
+        stream.close()
+
+def _parse_xml(chunks):
+    """
+    Parse the LLSD XML document arriving as the strings chunks, returning
+    what llsd.parse() would, except that an array of strings that is the
+    value of a 'manifest' key is returned as a _CompactManifest. No element
+    tree is built: each value is converted as soon as its element ends.
+    """
+    handler = _XMLHandler()
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    # UTF-8 strs: far cheaper than making unicode objects of mostly ASCII
+    parser.returns_unicode = False
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.text
+    try:
+        for chunk in chunks:
+            parser.Parse(chunk, False)
+        parser.Parse("", True)
+    except xml.parsers.expat.ExpatError, err:
+        raise llsd.LLSDParseError("invalid LLSD XML: %s" % err)
+    return handler.result()
+
+_NON_ASCII = re.compile(r"[\x80-\xff]")
+
+class _XMLHandler(object):
+    """
+    Expat callbacks converting LLSD XML to Python values: see _parse_xml().
+    """
+    def __init__(self):
+        # the enclosing maps and arrays: [container, key of a map's next
+        # value, whether the container is a dict]
+        self._stack = []
+        self._text = None
+        self._attributes = None
+        self._values = []
+
+    def result(self):
+        if len(self._values) != 1:
+            raise llsd.LLSDParseError("LLSD XML holds %s values" % len(self._values))
+        return self._values[0]
+
+    def start(self, name, attributes):
+        if name == 'map':
+            self._stack.append([{}, None, True])
+        elif name == 'array':
+            if self._stack and self._stack[-1][1] == 'manifest':
+                self._stack.append([_CompactManifest(), None, False])
+            else:
+                self._stack.append([[], None, False])
+        elif name != 'llsd':
+            self._text = []
+            self._attributes = attributes
+
+    def text(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def end(self, name):
+        text = self._text
+        if text is not None:
+            self._text = None
+            text = "".join(text)
+            if _NON_ASCII.search(text):
+                # as ElementTree does: str if all ASCII, else unicode
+                text = text.decode('utf-8')
+            if name == 'string':
+                value = text
+            elif name == 'key':
+                self._stack[-1][1] = text
+                return
+            else:
+                value = self._convert(name, text)
+        elif name == 'llsd':
+            return
+        else:
+            value = self._stack.pop()[0]
+        if not self._stack:
+            self._values.append(value)
+            return
+        frame = self._stack[-1]
+        if frame[2]:
+            frame[0][frame[1] or ''] = value
+            frame[1] = None
+        else:
+            if name != 'string' and isinstance(frame[0], _CompactManifest):
+                # not a manifest after all
+                frame[0] = list(frame[0])
+            frame[0].append(value)
+
+    def _convert(self, name, text):
+        # as llsd's own XML parser does
+        if name == 'integer':
+            return int(text) if text.strip() else 0
+        if name == 'real':
+            return float(text) if text.strip() else 0.0
+        if name == 'boolean':
+            return text.lower() in ('true', '1', '1.0')
+        if name == 'undef':
+            return None
+        if name == 'uri':
+            return llsd.uri(text)
+        if name == 'uuid':
+            return uuid.UUID(hex=text) if text else uuid.UUID(int=0)
+        if name == 'binary' and self._attributes.get('encoding', 'base64') == 'base64':
+            return llsd.binary(base64.b64decode(text))
+        # Anything else is rare enough in configuration files to leave to
+        # llsd itself.
+        element = "<%s%s>%s</%s>" % (name, "".join(' %s="%s"' % item for item in
+                                                  self._attributes.iteritems()),
+                                     text, name)
+        return llsd.parse('<?xml version="1.0" ?><llsd>%s</llsd>' % element.encode('utf-8'))
+
+class _CompactManifest(collections.MutableSequence):
+    """
+    A list-like sequence of paths, stored as their UTF-8 encodings end to end
+    in one array of characters, with the offset at which each ends: far less
+    memory than a list of as many strings. Appending is cheap; other changes
+    rebuild the arrays.
+    """
+    def __init__(self, paths=()):
+        self._replace(paths)
+
+    def _replace(self, paths):
+        self._data = array.array('c')
+        self._ends = array.array('I')
+        for path in paths:
+            self.append(path)
+
+    def append(self, path):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        self._data.fromstring(path)
+        self._ends.append(len(self._data))
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("manifest index out of range")
+        start = index and self._ends[index - 1] or 0
+        return _native(self._data[start:self._ends[index]].tostring().decode('utf-8'))
+
+    def __setitem__(self, index, value):
+        paths = list(self)
+        paths[index] = value
+        self._replace(paths)
+
+    def __delitem__(self, index):
+        paths = list(self)
+        del paths[index]
+        self._replace(paths)
+
+    def insert(self, index, path):
+        if index >= len(self):
+            self.append(path)
+        else:
+            paths = list(self)
+            paths.insert(index, path)
+            self._replace(paths)
+
+    def __iter__(self):
+        data = self._data.tostring()
+        try:
+            data.decode('ascii')
+            decode = str
+        except UnicodeError:
+            decode = lambda path: _native(path.decode('utf-8'))
+        start = 0
+        for end in self._ends:
+            yield decode(data[start:end])
+            start = end
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, _CompactManifest)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        # as a list, so that the output of --export-manifest still parses
+        return repr(list(self))
+
+def _native(text):
+    """
+    Return the unicode text as a str if it's all ASCII, as ElementTree does.
+    """
+    try:
+        return text.encode('ascii')
+    except UnicodeError:
+        return text
+
+# The extensions of the files holding installables saved apart.
+_RECORD_EXTENSIONS = (".xml", BINARY_CONFIG_SUFFIX)
+
+class _ChangeTrackingDict(dict):
+    """
+    A dict that adds to its set 'changed' each key assigned or removed.
+    """
+    def __init__(self, *args, **kwds):
+        dict.__init__(self, *args, **kwds)
+        self.changed = set(self)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changed.add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changed.add(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.changed.add(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.changed.add(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwds):
+        for (key, value) in dict(*args, **kwds).iteritems():
+            self[key] = value
+
+    def clear(self):
+        self.changed.update(self)
+        dict.clear(self)
+
+class _LazyPackageDict(_ChangeTrackingDict):
+    """
+    A _ChangeTrackingDict of PackageDescriptions, each of those given to
+    load() as parsed from a configuration file being constructed only when
+    first retrieved. Until then, dict.items() sees the parsed dict itself,
+    so saving it again doesn't construct it either.
+    """
+    def __init__(self, *args, **kwds):
+        _ChangeTrackingDict.__init__(self, *args, **kwds)
+        self.unloaded = set()
+
+    def load(self, key, value):
+        """
+        Store the dict value, parsed from a configuration file, as the
+        PackageDescription to construct for key when it's asked for.
+        """
+        dict.__setitem__(self, key, value)
+        self.unloaded.add(key)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if key in self.unloaded:
+            value = PackageDescription(value)
+            dict.__setitem__(self, key, value)
+            self.unloaded.discard(key)
+        return value
+
+    def __setitem__(self, key, value):
+        _ChangeTrackingDict.__setitem__(self, key, value)
+        self.unloaded.discard(key)
+
+    def __delitem__(self, key):
+        _ChangeTrackingDict.__delitem__(self, key)
+        self.unloaded.discard(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        if not self:
+            raise KeyError("popitem(): dictionary is empty")
+        key = iter(self).next()
+        return key, self.pop(key)
+
+    def clear(self):
+        _ChangeTrackingDict.clear(self)
+        self.unloaded.clear()
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def itervalues(self):
+        return (self[key] for key in self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.keys())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+def _write_file(pathname, text):
+    """
+    Replace the file pathname with one containing text, so that another
+    process reading it sees the old contents or the new, never a mixture.
+    """
+    tmpname = "%s.%s-%s.tmp" % (pathname, os.getpid(), thread.get_ident())
+    try:
+        out = open(tmpname, 'wb')
+        try:
+            out.write(text)
+        finally:
+            out.close()
+        common.rename_into_place(tmpname, pathname)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+def _pack_manifests(saved_data):
+    """
+    In saved_data, as returned by _compact_to_dict(), replace the manifest of
+    each platform of each installable with a packed_manifest: a map holding
+    the index in the table manifest_directories of the directory of each
+    path, as a binary array of big-endian 32-bit integers, and the rest of
+    each path, all joined with NULs. The table itself, the directory names
+    (each with its trailing separator) also joined with NULs, is stored as
+    saved_data's manifest_directories.
+    """
+    directories = {}
+    for package in saved_data.get('installables', {}).itervalues():
+        for platform in package.get('platforms', {}).itervalues():
+            manifest = platform.get('manifest')
+            if not manifest:
+                continue
+            del platform['manifest']
+            indexes = array.array('I')
+            names = []
+            for path in manifest:
+                split = path.rfind("/") + 1
+                indexes.append(directories.setdefault(path[:split], len(directories)))
+                names.append(path[split:])
+            if sys.byteorder == 'little':
+                indexes.byteswap()
+            platform['packed_manifest'] = dict(directories=llsd.binary(indexes.tostring()),
+                                               names="\0".join(names))
+    if directories:
+        table = sorted(directories, key=directories.get)
+        saved_data['manifest_directories'] = "\0".join(table)
+
+def _unpack_manifests(saved_data):
+    """
+    Reverse _pack_manifests(), if it was applied to saved_data, restoring each
+    manifest as a _CompactManifest.
+    """
+    table = saved_data.pop('manifest_directories', None)
+    if table is None:
+        return
+    table = table.split("\0")
+    for package in saved_data.get('installables', {}).itervalues():
+        for platform in package.get('platforms', {}).itervalues():
+            packed = platform.pop('packed_manifest', None)
+            if packed is None:
+                continue
+            indexes = array.array('I', str(packed['directories']))
+            if sys.byteorder == 'little':
+                indexes.byteswap()
+            platform['manifest'] = _CompactManifest(table[index] + name for index, name in
+                                                    itertools.izip(indexes, packed['names'].split("\0")))
+
+
 # LLSD will only export dict objects, not objects which inherit from dict.  This function will 
 # recursively copy dict like objects into dict's in preparation for export.
 def _compact_to_dict(obj):
     if isinstance(obj, dict):
         result = {}
-        for (key,value) in obj.items():
+        # dict.items(): a _LazyPackageDict's unloaded entries as they are
+        for (key,value) in dict.items(obj):
             if value:
                 result[key] = _compact_to_dict(value)
         return result
-    elif isinstance(obj, list):
+    elif isinstance(obj, (list, _CompactManifest)):
         return [_compact_to_dict(o) for o in obj if o]
     else:
         return obj
@@ -31,8 +31,15 @@ $/LicenseInfo$
 import common
 from common import AutobuildError
 
+try:
+    from hashlib import md5      # Python 2.6
+except ImportError:
+    from md5 import new as md5   # Python 2.5 and earlier
+
 # Valid configfile.ArchiveDescription.hash_algorithm values are registered
-# here by means of the @hash_algorithm decorator.
+# here by means of the @hash_algorithm decorator. Each value is a factory
+# returning a new hasher object with the hashlib interface: update(data) and
+# hexdigest().
 REGISTERED_ALGORITHMS = {}
 
 class hash_algorithm(object):
@@ -41,8 +48,8 @@ class hash_algorithm(object):
     REGISTERED_ALGORITHMS using syntax like:
 
     @hash_algorithm("md5")
-    def _verify_md5(self, pathname, hash):
-        ...
+    def _new_md5():
+        return md5()
     """
     # called when we instantiate @hash_algorithm("md5")
     def __init__(self, key):
@@ -63,13 +70,28 @@ def verify_hash(hash_algorithm, pathname, hash):
     Primary entry point for this module
     """
     if not hash:
-        # If there's no specified hash value, what can we do? We could
-        # unconditionally fail, but that risks getting the user stuck. So
-        # -- if there's no specified hash value, unconditionally accept
-        # the download.
-        print "Warning: unable to verify %s; expected hash value not specified" % pathname
-        return True
+        return _accept_unverified(pathname)
+
+    return compute_hash(hash_algorithm, pathname) == hash
+
+
+def verify_digest(hasher, pathname, hash):
+    """
+    Like verify_hash(), but for a hasher (from new_hasher()) that has already
+    been fed the contents of pathname -- for instance while downloading it --
+    so the file needn't be read again.
+    """
+    if not hash:
+        return _accept_unverified(pathname)
+
+    return hasher.hexdigest() == hash
+
 
+def new_hasher(hash_algorithm, pathname):
+    """
+    Return a new hasher object for the specified hash_algorithm, with which
+    to hash pathname (named in the error if hash_algorithm is unsupported).
+    """
     if not hash_algorithm:
         # Historical: if there IS a hash value, but no hash_algorithm,
         # assume MD5 because that used to be the only supported hash
@@ -77,16 +99,33 @@ def verify_hash(hash_algorithm, pathname, hash):
         hash_algorithm = "md5"
 
     try:
-        function = REGISTERED_ALGORITHMS[hash_algorithm]
+        factory = REGISTERED_ALGORITHMS[hash_algorithm]
     except KeyError:
         raise AutobuildError("Unsupported hash type %s for %s" %
                              (hash_algorithm, pathname))
 
-    # Apparently we do have a function to support this hash_algorithm. Call
-    # it.
-    return function(pathname, hash)
+    return factory()
+
+
+def compute_hash(hash_algorithm, pathname, buffer_size=None):
+    """
+    Return the hex digest of the contents of pathname using hash_algorithm.
+    The file is hashed buffer_size bytes at a time (default
+    common.HASH_BUFFER_SIZE) and never read into memory all at once.
+    """
+    hasher = new_hasher(hash_algorithm, pathname)
+    return common.hash_file(hasher, pathname, buffer_size).hexdigest()
+
+
+def _accept_unverified(pathname):
+    # If there's no specified hash value, what can we do? We could
+    # unconditionally fail, but that risks getting the user stuck. So
+    # -- if there's no specified hash value, unconditionally accept
+    # the download.
+    print "Warning: unable to verify %s; expected hash value not specified" % pathname
+    return True
 
 
 @hash_algorithm("md5")
-def _verify_md5(pathname, hash):
-    return common.compute_md5(pathname) == hash
+def _new_md5():
+    return md5()
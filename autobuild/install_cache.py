@@ -0,0 +1,799 @@
+#!/usr/bin/python
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+
+"""
+Bookkeeping for the install cache of downloaded package archives.
+
+The archives themselves are fetched by common.download_package(); this module
+keeps track of what is known about them so that repeated installs can avoid
+redundant work.
+
+Archives whose hash is known are stored by content, as <algorithm>/<digest>
+under the cache directory, so that two different archives with the same
+filename don't evict each other and an archive referenced by several URLs is
+only stored once. The cache entry named for the basename of an archive's URL
+(see common.get_package_in_cache()) is kept as an alias -- a hard link -- to
+the content entry most recently fetched under that name.
+
+Each archive with a known hash is also kept unpacked, in the UNPACKED_DIR
+subdirectory of the cache, so that installing it again -- e.g. into another
+checkout's build directory -- takes only link_tree() rather than another
+decompression. Set UNPACKED_STORE_ENV to 0 to disable that.
+
+VerifiedHashIndex remembers the digest computed for each cached archive,
+keyed by the file's size, modification time and inode, so an archive that
+hasn't changed since it was last hashed needn't be read again.
+
+If the environment variable named by CACHE_MAX_BYTES_ENV is set, the cache is
+kept to that many bytes by evicting the least recently used archives. Use is
+tracked by each file's access time, which touch() sets explicitly rather than
+relying on the filesystem (often mounted noatime) to do it.
+
+Several autobuild processes may use the cache at once, possibly as different
+users sharing it through common.INSTALL_CACHE_ENV. EntryLock serializes work
+on each cache entry, so that concurrent installs wait for a single download
+of an archive rather than each fetching (and overwriting) it, and eviction
+leaves alone any archive another process is using. In a shared cache, the
+directories and lock files created are made writable by the cache
+directory's group, but archives, unpacked archives and indexes stay writable
+only by their owners, and what is recorded about any of them -- a verified
+digest, an unpacked archive's contents -- is only trusted by the user who
+owns them (see is_trusted()).
+"""
+
+import os
+import re
+import stat
+import glob
+import errno
+import shutil
+import logging
+import time
+import thread
+import threading
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+import common
+import hash_algorithms
+from llbase import llsd
+
+logger = logging.getLogger('autobuild.install_cache')
+
+# sidecar file, in the install cache directory, holding the VerifiedHashIndex
+HASH_INDEX_FILE = "verified-hashes.xml"
+
+# environment variable capping the total size of the install cache, in bytes
+CACHE_MAX_BYTES_ENV = "AUTOBUILD_CACHE_MAX_BYTES"
+
+# subdirectory of the install cache holding unpacked archives, as
+# <algorithm>/<digest> directories each with an UNPACKED_INDEX_SUFFIX file
+# beside it listing its contents
+UNPACKED_DIR = "unpacked"
+UNPACKED_INDEX_SUFFIX = ".xml"
+
+# environment variable: set to 0 to extract every install afresh
+UNPACKED_STORE_ENV = "AUTOBUILD_UNPACKED_STORE"
+
+# suffix of the file beside a cache entry on which its EntryLock is held
+LOCK_SUFFIX = ".lock"
+
+# suffix of the file beside a cached archive holding its archive_index
+TAR_INDEX_SUFFIX = ".index"
+
+# age, in seconds, after which a temporary file left in the cache by an
+# interrupted download is assumed to be abandoned
+STALE_TEMP_AGE = 24*60*60
+
+
+class VerifiedHashIndex(object):
+    """
+    Persistent record of archive digests, stored in HASH_INDEX_FILE in the
+    cache directory. Each entry maps an archive's pathname to the
+    (size, mtime, inode) of the file when it was hashed plus its digest for
+    each hash algorithm computed so far. Any change to the file's stat
+    information invalidates the entry.
+
+    Methods are safe to call from several threads. Several processes may
+    share the same index; the worst a lost update costs is a re-hash.
+    """
+    def __init__(self, cache_dir=None):
+        self.path = os.path.join(cache_dir or common.get_default_install_cache_dir(),
+                                 HASH_INDEX_FILE)
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def lookup(self, pathname, hash_algorithm):
+        """
+        Return the recorded digest of pathname for hash_algorithm, or None if
+        there is none or the file has changed since it was recorded.
+        """
+        key = _stat_key(pathname)
+        if key is None:
+            return None
+        if not is_trusted(pathname):
+            # its owner could have changed it without changing its stat key
+            logger.debug("not trusting recorded digest for %s" % pathname)
+            return None
+        self._lock.acquire()
+        try:
+            entry = self._load().get(os.path.abspath(pathname))
+            if entry is None or _entry_key(entry) != key:
+                return None
+            return entry['digests'].get(hash_algorithm or "md5")
+        finally:
+            self._lock.release()
+
+    def record(self, pathname, hash_algorithm, digest):
+        """
+        Remember that pathname, as it is now, has digest for hash_algorithm.
+        """
+        key = _stat_key(pathname)
+        if key is None:
+            return
+        self._lock.acquire()
+        try:
+            entries = self._load()
+            path = os.path.abspath(pathname)
+            entry = entries.get(path)
+            if entry is None or _entry_key(entry) != key:
+                # new file, or changed since its digests were recorded
+                entry = dict(size=key[0], mtime=key[1], inode=key[2], digests={})
+                entries[path] = entry
+            entry['digests'][hash_algorithm or "md5"] = digest
+            self._save()
+        finally:
+            self._lock.release()
+
+    def forget(self, pathname):
+        """
+        Discard whatever is recorded for pathname.
+        """
+        self._lock.acquire()
+        try:
+            if self._load().pop(os.path.abspath(pathname), None) is not None:
+                self._save()
+        finally:
+            self._lock.release()
+
+    def _load(self):
+        # caller must hold self._lock
+        if self._entries is None:
+            self._entries = {}
+            try:
+                data = open(self.path, 'rb').read()
+            except IOError:
+                # no index yet
+                return self._entries
+            try:
+                self._entries = llsd.parse(data)
+            except llsd.LLSDParseError:
+                # it's only a cache: start over
+                logger.warning("ignoring corrupt hash index %s" % self.path)
+        return self._entries
+
+    def _save(self):
+        # caller must hold self._lock
+        # Drop entries for archives that have since been removed.
+        for path in [path for path in self._entries if not os.path.exists(path)]:
+            del self._entries[path]
+        tmpname = "%s.%s.tmp" % (self.path, os.getpid())
+        try:
+            out = open(tmpname, 'wb')
+            try:
+                out.write(llsd.format_xml(self._entries))
+            finally:
+                out.close()
+            common.rename_into_place(tmpname, self.path)
+            share(self.path)
+        except EnvironmentError, err:
+            # failing to update the index only costs a re-hash next time
+            logger.warning("unable to update hash index %s: %s" % (self.path, err))
+
+
+class EntryLock(object):
+    """
+    Advisory lock on the install cache entry pathname, held on a file named
+    pathname + LOCK_SUFFIX beside it. A process fetching an entry holds its
+    lock exclusively; processes extracting it share the lock (except on
+    Windows, which only offers exclusive locks). Eviction only removes an
+    entry it can lock exclusively without waiting.
+
+    Locks exclude each other between threads as well as between processes,
+    but a single EntryLock object should only be used by one thread.
+    """
+    def __init__(self, pathname):
+        self.path = pathname + LOCK_SUFFIX
+        self._file = None
+
+    def acquire(self, shared=False, blocking=True):
+        """
+        Lock the entry, waiting if necessary, and return True. If blocking is
+        False, return False at once if someone else holds a conflicting lock.
+        """
+        while True:
+            make_directory(os.path.dirname(self.path))
+            lockfile = open(self.path, 'ab')
+            try:
+                share(self.path)
+                if not _lock_file(lockfile, shared, blocking):
+                    lockfile.close()
+                    return False
+                # Eviction may have removed the lock file between our opening
+                # and locking it, in which case a third party may now hold a
+                # lock on a new file of the same name: start over.
+                if _is_same_file(lockfile, self.path):
+                    self._file = lockfile
+                    return True
+            except:
+                lockfile.close()
+                raise
+            lockfile.close()
+
+    def release(self):
+        """
+        Release the lock, if held.
+        """
+        if self._file is not None:
+            try:
+                _unlock_file(self._file)
+            finally:
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        """
+        Remove the lock file along with the entry it guards. Only call this
+        while holding the lock exclusively, just before releasing it.
+        """
+        try:
+            os.remove(self.path)
+        except OSError:
+            # Windows won't remove an open file; leave it for next time
+            pass
+
+
+def get_hash_index():
+    """
+    Return the process-wide VerifiedHashIndex for the default install cache.
+    """
+    global _hash_index
+    _hash_index_lock.acquire()
+    try:
+        if _hash_index is None:
+            _hash_index = VerifiedHashIndex()
+        return _hash_index
+    finally:
+        _hash_index_lock.release()
+
+
+def verify_hash(hash_algorithm, pathname, hash, index=None):
+    """
+    Like hash_algorithms.verify_hash(), but consult the VerifiedHashIndex
+    (by default, get_hash_index()) first, and only hash pathname if its digest
+    isn't already known.
+    """
+    if not hash:
+        # let hash_algorithms decide what to do (and say) about that
+        return hash_algorithms.verify_hash(hash_algorithm, pathname, hash)
+    index = index or get_hash_index()
+    digest = index.lookup(pathname, hash_algorithm)
+    if digest is None:
+        digest = hash_algorithms.compute_hash(hash_algorithm, pathname)
+        index.record(pathname, hash_algorithm, digest)
+    else:
+        logger.debug("using recorded %s digest for %s" % (hash_algorithm or "md5", pathname))
+    return digest == hash
+
+
+def get_content_path(hash_algorithm, hash, cache_dir=None):
+    """
+    Return the pathname under which the archive with the specified hash is
+    stored in the install cache, or None if the hash can't be used to name it.
+    """
+    hash_algorithm = hash_algorithm or "md5"
+    if not hash or not _name_part.match(hash_algorithm) or not _name_part.match(hash):
+        return None
+    return os.path.join(cache_dir or common.get_default_install_cache_dir(),
+                        hash_algorithm, hash.lower())
+
+def get_unpacked_path(hash_algorithm, hash, cache_dir=None):
+    """
+    Return the pathname of the directory in which the archive with the
+    specified hash is kept unpacked, or None if it can't be (including when
+    the unpacked store is disabled, or when another user of a shared cache
+    has unpacked it there).
+    """
+    if os.environ.get(UNPACKED_STORE_ENV, "").strip() == "0":
+        return None
+    content_path = get_content_path(hash_algorithm, hash, cache_dir)
+    if content_path is None:
+        return None
+    algorithm_dir, digest = os.path.split(content_path)
+    cache_dir, algorithm = os.path.split(algorithm_dir)
+    unpacked_path = os.path.join(cache_dir, UNPACKED_DIR, algorithm, digest)
+    if os.path.lexists(unpacked_path) and not is_trusted(unpacked_path):
+        # we could neither rely on nor replace it
+        logger.debug("not using %s, unpacked by another user" % unpacked_path)
+        return None
+    return unpacked_path
+
+def get_unpacked_names(unpacked_path):
+    """
+    Return the list of archive member names unpacked at unpacked_path, or
+    None if the archive hasn't been (completely) unpacked there.
+    """
+    indexname = unpacked_path + UNPACKED_INDEX_SUFFIX
+    try:
+        index = open(indexname, 'rb').read()
+    except IOError:
+        return None
+    if not os.path.isdir(unpacked_path) or \
+       not is_trusted(indexname) or not is_trusted(unpacked_path):
+        return None
+    try:
+        return llsd.parse(index)['names']
+    except (llsd.LLSDParseError, KeyError, TypeError):
+        logger.warning("ignoring corrupt unpacked archive index for %s" % unpacked_path)
+        return None
+
+def add_unpacked(unpacked_path, unpack):
+    """
+    Populate unpacked_path by calling unpack(dirname), which must extract the
+    archive into the new directory dirname and return the list of member
+    names extracted, and return that list. The caller should hold
+    EntryLock(unpacked_path).
+    """
+    if os.path.lexists(unpacked_path):
+        # left incomplete, or its index was lost
+        remove_unpacked(unpacked_path)
+    make_directory(os.path.dirname(unpacked_path))
+    tmpname = "%s.%s-%s.tmp" % (unpacked_path, os.getpid(), thread.get_ident())
+    try:
+        names = unpack(tmpname)
+        size = 0
+        for name in names:
+            info = os.lstat(os.path.join(tmpname, name))
+            if stat.S_ISREG(info.st_mode):
+                size += info.st_size
+        if is_shared():
+            # Other users link from it without checking its contents: make
+            # sure nobody else can change them.
+            _protect_tree(tmpname)
+        indexname = unpacked_path + UNPACKED_INDEX_SUFFIX
+        out = open(tmpname + UNPACKED_INDEX_SUFFIX, 'wb')
+        try:
+            out.write(llsd.format_xml(dict(names=list(names), size=size)))
+        finally:
+            out.close()
+        common.rename_into_place(tmpname + UNPACKED_INDEX_SUFFIX, indexname)
+        share(indexname)
+        # only now does get_unpacked_names() see it
+        os.rename(tmpname, unpacked_path)
+    except:
+        _remove_tree(tmpname)
+        _remove_quietly(tmpname + UNPACKED_INDEX_SUFFIX)
+        raise
+    return names
+
+def link_tree(unpacked_path, names, install_dir, structure=None):
+    """
+    Recreate the specified members of the archive unpacked at unpacked_path
+    in install_dir, and return the list of names installed. Each file is
+    hard linked if possible; failing that (e.g. install_dir is on another
+    filesystem) it is copied. It is never symlinked: the unpacked archive may
+    be evicted while install_dir still uses it.
+
+    If structure, as returned by common.get_member_map(), is given, each
+    member is placed where it says, and those it doesn't place are skipped.
+    """
+    touch(unpacked_path + UNPACKED_INDEX_SUFFIX)
+    link = getattr(os, "link", None)
+    symlink = getattr(os, "symlink", None)
+    installed = []
+    placed_dirs = set()
+    for name in names:
+        source = os.path.join(unpacked_path, name)
+        isdir = os.path.isdir(source) and not os.path.islink(source)
+        if structure is not None:
+            name = structure.remap(name, isdir)
+            if name is None or (isdir and name in placed_dirs):
+                # not placed, or several directories placed at one
+                continue
+            if isdir:
+                placed_dirs.add(name)
+        installed.append(name)
+        target = os.path.join(install_dir, name)
+        if isdir:
+            common.ensure_directory(target)
+            continue
+        common.ensure_directory(os.path.dirname(target))
+        if os.path.lexists(target) and not os.path.isdir(target):
+            # as tarfile would, replace what's there
+            os.remove(target)
+        if os.path.islink(source):
+            symlink(os.readlink(source), target)
+            continue
+        if link is not None:
+            try:
+                link(source, target)
+                continue
+            except OSError, err:
+                if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                logger.debug("unable to hard link %s: %s" % (target, err))
+                # don't keep trying for the rest of this tree
+                link = None
+        shutil.copy2(source, target)
+    return installed
+
+def remove_unpacked(unpacked_path):
+    """
+    Remove the unpacked archive at unpacked_path from the install cache.
+    """
+    # index first, so that nobody mistakes a half-removed tree for complete
+    _remove_quietly(unpacked_path + UNPACKED_INDEX_SUFFIX)
+    _remove_tree(unpacked_path)
+
+def link_entry(source, pathname):
+    """
+    Make pathname a hard link to the cached file source, replacing whatever
+    pathname was before. Return False (leaving pathname alone) if the
+    platform or filesystem can't do that.
+    """
+    if os.path.abspath(source) == os.path.abspath(pathname):
+        return True
+    link = getattr(os, "link", None)
+    if link is None:
+        # Windows, under Python 2
+        return False
+    tmpname = "%s.%s-%s.tmp" % (pathname, os.getpid(), thread.get_ident())
+    try:
+        make_directory(os.path.dirname(pathname))
+        link(source, tmpname)
+        common.rename_into_place(tmpname, pathname)
+    except OSError, err:
+        logger.debug("unable to link %s to %s: %s" % (pathname, source, err))
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        return False
+    return True
+
+def remove_entry(pathname, index=None):
+    """
+    Remove pathname from the install cache, along with anything recorded
+    about it in index (by default, get_hash_index()) and its archive index.
+    """
+    try:
+        os.remove(pathname)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+    _remove_quietly(pathname + TAR_INDEX_SUFFIX)
+    (index or get_hash_index()).forget(pathname)
+
+
+def is_shared():
+    """
+    Return True if the install cache is shared between users, i.e. if it was
+    configured with common.INSTALL_CACHE_ENV.
+    """
+    return bool(os.environ.get(common.INSTALL_CACHE_ENV))
+
+def share(pathname):
+    """
+    If the install cache is shared, make the file or directory pathname, just
+    created in it, usable by the cache directory's group. Directories and
+    lock files are made writable by the group, so that others can add,
+    remove and lock entries; anything else only readable, so that nobody but
+    its owner can change an archive or index that others rely on.
+    """
+    if not is_shared():
+        return
+    try:
+        if os.path.isdir(pathname):
+            os.chmod(pathname, 02775)
+        elif pathname.endswith(LOCK_SUFFIX):
+            os.chmod(pathname, 0664)
+        else:
+            os.chmod(pathname, 0644)
+    except OSError, err:
+        # only the owner may chmod; whoever created it has done so already
+        logger.debug("unable to share %s: %s" % (pathname, err))
+
+def is_trusted(pathname):
+    """
+    Return True if what is recorded about the cache entry pathname can be
+    relied on without checking it again. In a shared cache, that is only so
+    for entries owned by the current user and writable by nobody else: any
+    other user able to write one could have changed it.
+    """
+    if not is_shared() or not hasattr(os, "geteuid"):
+        # Windows: no owners to speak of
+        return True
+    try:
+        info = os.lstat(pathname)
+    except OSError:
+        return False
+    return info.st_uid == os.geteuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def make_directory(path):
+    """
+    Create the directory path within the install cache, if need be, sharing
+    it if the cache is shared.
+    """
+    if not os.path.isdir(path):
+        common.ensure_directory(path)
+        share(path)
+
+def get_archive_paths(archive):
+    """
+    Return the list of install cache pathnames at which the specified
+    ArchiveDescription may be stored: its content-addressed entry and its
+    unpacked directory, if it has them, and its filename alias.
+    """
+    paths = [common.get_package_in_cache(archive.url)]
+    for path in (get_content_path(archive.hash_algorithm, archive.hash),
+                 get_unpacked_path(archive.hash_algorithm, archive.hash)):
+        if path:
+            paths.insert(0, path)
+    return paths
+
+def touch(pathname):
+    """
+    Mark the cached file pathname as just used. Only its access time is
+    updated: changing its modification time would invalidate its entry in the
+    VerifiedHashIndex.
+    """
+    try:
+        os.utime(pathname, (time.time(), os.stat(pathname).st_mtime))
+    except OSError, err:
+        logger.debug("unable to touch %s: %s" % (pathname, err))
+
+def get_cache_max_bytes():
+    """
+    Return the size limit for the install cache given by CACHE_MAX_BYTES_ENV,
+    or None if the cache is unlimited.
+    """
+    value = os.environ.get(CACHE_MAX_BYTES_ENV, "").strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning("ignoring %s=%r: not a number of bytes" % (CACHE_MAX_BYTES_ENV, value))
+        return None
+
+def evict(max_bytes, pinned=(), since=None, cache_dir=None):
+    """
+    Remove the least recently used archives from the install cache until it
+    holds no more than max_bytes, and return the number of bytes freed.
+    Archives at any of the pathnames in pinned, or used at or after the time
+    since, are never removed. Names that are hard links to the same file are
+    counted and removed together, as is each unpacked archive. Temporary files
+    abandoned by interrupted downloads are removed once they are older than
+    STALE_TEMP_AGE.
+    """
+    index = cache_dir and VerifiedHashIndex(cache_dir) or get_hash_index()
+    cache_dir = cache_dir or common.get_default_install_cache_dir()
+    pinned = set(os.path.abspath(path) for path in pinned)
+    now = time.time()
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(cache_dir):
+        if dirpath == cache_dir and UNPACKED_DIR in dirnames:
+            # unpacked archives are accounted for whole, below
+            dirnames.remove(UNPACKED_DIR)
+        for filename in filenames:
+            if filename.endswith(LOCK_SUFFIX) or filename.endswith(TAR_INDEX_SUFFIX):
+                # removed along with their entries
+                continue
+            path = os.path.abspath(os.path.join(dirpath, filename))
+            try:
+                info = os.stat(path)
+            except OSError:
+                # removed since we listed it
+                continue
+            if _is_temp_file(filename):
+                if now - info.st_mtime > STALE_TEMP_AGE:
+                    logger.info("removing abandoned temporary file %s" % path)
+                    _remove_quietly(path)
+                continue
+            if filename == HASH_INDEX_FILE:
+                continue
+            entry = entries.setdefault((info.st_dev, info.st_ino),
+                                       dict(size=info.st_size, atime=info.st_atime, paths=[]))
+            entry['paths'].append(path)
+    for indexname in glob.glob(os.path.join(cache_dir, UNPACKED_DIR, "*", "*" + UNPACKED_INDEX_SUFFIX)):
+        try:
+            size = llsd.parse(open(indexname, 'rb').read())['size']
+            atime = os.stat(indexname).st_atime
+        except (EnvironmentError, llsd.LLSDParseError, KeyError, TypeError):
+            continue
+        path = os.path.abspath(indexname[:-len(UNPACKED_INDEX_SUFFIX)])
+        entries[path] = dict(size=size, atime=atime, paths=[path], unpacked=True,
+                             owned=is_trusted(path))
+
+    total = sum(entry['size'] for entry in entries.itervalues())
+    if total <= max_bytes:
+        logger.debug("install cache holds %s bytes, limit %s" % (total, max_bytes))
+        return 0
+    freed = 0
+    for entry in sorted(entries.itervalues(), key=lambda entry: entry['atime']):
+        if total - freed <= max_bytes:
+            break
+        if since is not None and entry['atime'] >= since:
+            # everything else was used even more recently
+            break
+        if pinned.intersection(entry['paths']):
+            continue
+        if not entry.get('owned', True):
+            # only its owner can remove what's in it
+            logger.debug("not evicting %s: unpacked by another user" % entry['paths'][0])
+            continue
+        # Don't evict what another install is fetching or extracting.
+        locks = []
+        try:
+            for path in entry['paths']:
+                lock = EntryLock(path)
+                if not lock.acquire(blocking=False):
+                    logger.debug("not evicting %s: in use" % path)
+                    break
+                locks.append(lock)
+            else:
+                for path, lock in zip(entry['paths'], locks):
+                    logger.info("evicting %s from install cache" % path)
+                    if entry.get('unpacked'):
+                        remove_unpacked(path)
+                    else:
+                        remove_entry(path, index)
+                    lock.remove()
+                freed += entry['size']
+        finally:
+            for lock in locks:
+                lock.release()
+    if total - freed > max_bytes:
+        logger.warning("install cache holds %s bytes, over its limit of %s, "
+                       "but the rest is in use" % (total - freed, max_bytes))
+    return freed
+
+
+class CacheEvictor(threading.Thread):
+    """
+    Thread running evict() in the background. Construct it with the same
+    arguments as evict(), start() it, then call wait() before exiting.
+    """
+    def __init__(self, max_bytes, pinned=(), since=None, cache_dir=None):
+        super(CacheEvictor, self).__init__(name="install-cache-evictor")
+        # Interrupting an eviction leaves nothing worse than a larger cache.
+        self.setDaemon(True)
+        self.max_bytes = max_bytes
+        self.pinned = pinned
+        self.since = since
+        self.cache_dir = cache_dir
+
+    def run(self):
+        try:
+            evict(self.max_bytes, self.pinned, self.since, self.cache_dir)
+        except Exception, err:
+            # the install itself needn't care
+            logger.warning("install cache eviction failed: %s" % err)
+
+    def wait(self):
+        # join() with a timeout so the main thread still sees KeyboardInterrupt
+        while self.isAlive():
+            self.join(0.5)
+
+
+#
+# Private module classes and functions below here.
+#
+# what may appear in either component of a content path
+_name_part = re.compile(r"^[A-Za-z0-9_-]+$")
+
+_hash_index = None
+_hash_index_lock = threading.Lock()
+
+def _is_temp_file(filename):
+    # see common._stream_to_file(), link_entry() and VerifiedHashIndex._save()
+    return filename.endswith(".part") or filename.endswith(".tmp")
+
+def _remove_quietly(pathname):
+    try:
+        os.remove(pathname)
+    except OSError, err:
+        logger.debug("unable to remove %s: %s" % (pathname, err))
+
+def _protect_tree(path):
+    # take away group and other write permission throughout the tree at path
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in [dirpath] + [os.path.join(dirpath, f) for f in filenames]:
+            info = os.lstat(name)
+            if not stat.S_ISLNK(info.st_mode) and info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                os.chmod(name, stat.S_IMODE(info.st_mode) & ~(stat.S_IWGRP | stat.S_IWOTH))
+
+def _remove_tree(path):
+    def make_writable(function, path, exc_info):
+        # an archive may well have unpacked read-only directories
+        try:
+            os.chmod(os.path.dirname(path), 0755)
+            function(path)
+        except OSError, err:
+            logger.debug("unable to remove %s: %s" % (path, err))
+    if os.path.isdir(path):
+        shutil.rmtree(path, onerror=make_writable)
+
+def _lock_file(lockfile, shared, blocking):
+    if fcntl is not None:
+        # flock() rather than lockf(): its locks belong to the open file, so
+        # threads of one process exclude each other too
+        flags = shared and fcntl.LOCK_SH or fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lockfile.fileno(), flags)
+        except IOError, err:
+            if blocking or err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+    # msvcrt.locking() locks bytes from the current position; LK_LOCK would
+    # give up after 10 seconds, so do our own waiting.
+    lockfile.seek(0)
+    while True:
+        try:
+            msvcrt.locking(lockfile.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except IOError:
+            if not blocking:
+                return False
+            time.sleep(0.1)
+
+def _unlock_file(lockfile):
+    if fcntl is not None:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+    else:
+        lockfile.seek(0)
+        msvcrt.locking(lockfile.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _is_same_file(lockfile, pathname):
+    try:
+        return os.fstat(lockfile.fileno()).st_ino == os.stat(pathname).st_ino
+    except OSError:
+        return False
+
+def _stat_key(pathname):
+    try:
+        info = os.stat(pathname)
+    except OSError:
+        return None
+    # LLSD doesn't round-trip a float's full precision: keep mtime as a string
+    return (info.st_size, repr(info.st_mtime), info.st_ino)
+
+def _entry_key(entry):
+    return (entry.get('size'), entry.get('mtime'), entry.get('inode'))
@@ -0,0 +1,334 @@
+#!/usr/bin/python
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+
+"""
+Decompress bzip2 files on several processors at once.
+
+A bzip2 stream is a sequence of independently compressed blocks, each of
+which starts with a 48-bit magic number -- though not necessarily on a byte
+boundary. open_tar_stream() finds those boundaries, rewraps each block as a
+bzip2 stream of its own, and decompresses the blocks in a pool of worker
+processes, returning a file-like object that reads their output in stream
+order. Anything it can't handle is left for the caller to decompress the
+usual way.
+"""
+
+import os
+import re
+import bz2
+import mmap
+import time
+import bisect
+import logging
+import binascii
+import threading
+import collections
+
+import common
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5
+    multiprocessing = None
+
+logger = logging.getLogger('autobuild.parallel_bzip2')
+
+# magic numbers starting each compressed block, and ending each stream
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+
+# Files smaller than this many bytes aren't worth starting worker processes
+# for: at most a couple of blocks.
+MIN_PARALLEL_SIZE = 1024 * 1024
+
+# Number of worker processes to use; override with the
+# AUTOBUILD_DECOMPRESS_PROCESSES environment variable. 1 disables parallel
+# decompression.
+PROCESSES_ENV = 'AUTOBUILD_DECOMPRESS_PROCESSES'
+
+
+class DecompressionError(common.AutobuildError):
+    pass
+
+
+def get_process_count():
+    """
+    Return the number of worker processes to decompress with.
+    """
+    try:
+        return int(os.environ[PROCESSES_ENV])
+    except (KeyError, ValueError):
+        pass
+    try:
+        return multiprocessing.cpu_count()
+    except (AttributeError, NotImplementedError):
+        return 1
+
+def find_blocks(data):
+    """
+    Return a list of (start, end) bit offsets of the compressed blocks in
+    the bzip2 data (a string or mmap), in stream order. Concatenated streams
+    are handled. Raise DecompressionError if data isn't a complete bzip2
+    stream.
+    """
+    if not _header.match(data[:4]):
+        raise DecompressionError("not a bzip2 stream")
+    starts = _find_magic(data, BLOCK_MAGIC)
+    boundaries = sorted(starts + _find_magic(data, EOS_MAGIC))
+    blocks = []
+    for start in starts:
+        # a block ends where the next block or the end of its stream begins
+        index = bisect.bisect_right(boundaries, start)
+        if index == len(boundaries):
+            raise DecompressionError("truncated bzip2 stream")
+        blocks.append((start, boundaries[index]))
+    return blocks
+
+def decompress_block(data, start, end):
+    """
+    Decompress and return the block at bit offsets (start, end) of the
+    bzip2 data, as found by find_blocks(), in this process.
+    """
+    return _decompress_block(_block_task(data, start, end))[0]
+
+def open_tar_stream(pathname, processes=None):
+    """
+    If pathname is a bzip2 file worth decompressing in parallel, and worker
+    processes are available to do it, return a BlockStream reading its
+    decompressed contents. Otherwise return None: the caller should
+    decompress the file the usual way.
+    """
+    processes = processes or get_process_count()
+    if multiprocessing is None or processes < 2:
+        return None
+    if os.path.getsize(pathname) < MIN_PARALLEL_SIZE:
+        return None
+    compressed = open(pathname, 'rb')
+    try:
+        if not _header.match(compressed.read(4)):
+            compressed.close()
+            return None
+        data = mmap.mmap(compressed.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            blocks = find_blocks(data)
+            if len(blocks) < 2:
+                data.close()
+                compressed.close()
+                return None
+            return BlockStream(pathname, compressed, data, blocks, processes)
+        except:
+            data.close()
+            raise
+    except DecompressionError, err:
+        logger.debug("not decompressing %s in parallel: %s" % (pathname, err))
+    except (OSError, ImportError), err:
+        # e.g. no working multiprocessing semaphores on this system
+        logger.debug("unable to start decompression workers: %s" % err)
+    compressed.close()
+    return None
+
+
+class BlockStream(object):
+    """
+    Read-only file-like object yielding the decompressed contents of a
+    bzip2 file whose blocks, as located by find_blocks(), are decompressed
+    by a pool of worker processes. Only a few blocks more than there are
+    workers are decompressed ahead of the reader. Every stream shares the
+    same pool, so that extracting several archives at once doesn't start
+    processes for each: forking from a process running other threads risks
+    the child inheriting a lock that one of them held.
+
+    read() raises DecompressionError if a block can't be decompressed, which
+    may mean find_blocks() mistook compressed data for a block boundary;
+    the caller should start over with serial decompression. Once the whole
+    stream has been read, the speedup achieved is logged.
+
+    The blocks attribute holds the (start, end) bit offsets of the blocks;
+    offsets, the offset in the decompressed data at which each of the blocks
+    read so far starts.
+    """
+    def __init__(self, pathname, compressed, data, blocks, processes):
+        self.name = pathname
+        self.blocks = blocks
+        self.offsets = []
+        self._compressed = compressed
+        self._data = data
+        self._blocks = blocks
+        self._processes = processes
+        self._pool = _get_pool(processes)
+        self._pending = collections.deque()
+        self._chunks = self._decompressed_blocks()
+        self._chunk = ""
+        self._offset = 0
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                self._chunk = next(self._chunks, None)
+                self._offset = 0
+                if self._chunk is None:
+                    self._chunk = ""
+                    break
+            if size < 0:
+                piece = self._chunk[self._offset:]
+            else:
+                piece = self._chunk[self._offset:self._offset + size]
+                size -= len(piece)
+            self._offset += len(piece)
+            pieces.append(piece)
+        return "".join(pieces)
+
+    def close(self):
+        if self._pool is not None:
+            # Let any blocks still being decompressed finish, discarding
+            # them: terminating the pool -- as multiprocessing does at exit
+            # -- while a worker is sending a result can deadlock it.
+            for result in self._pending:
+                while not result.ready():
+                    result.wait(0.5)
+            self._pool = None
+            self._data.close()
+            self._compressed.close()
+
+    def _decompressed_blocks(self):
+        started = time.time()
+        work_time = 0.0
+        position = 0
+        pending = self._pending
+        for start, end in self._blocks:
+            # Each worker gets just the bytes spanning its block.
+            task = _block_task(self._data, start, end)
+            pending.append(self._pool.apply_async(_decompress_block, (task,)))
+            if len(pending) > self._processes * 2:
+                chunk, elapsed = self._wait(pending.popleft())
+                work_time += elapsed
+                self.offsets.append(position)
+                position += len(chunk)
+                yield chunk
+        while pending:
+            chunk, elapsed = self._wait(pending.popleft())
+            work_time += elapsed
+            self.offsets.append(position)
+            position += len(chunk)
+            yield chunk
+        # work_time is about what decompressing serially would have taken
+        wall_time = time.time() - started
+        logger.info("decompressed %s (%s blocks) with %s processes in %.2fs: %.1fx speedup" %
+                    (self.name, len(self._blocks), self._processes, wall_time,
+                     work_time / max(wall_time, 0.001)))
+
+    def _wait(self, result):
+        # wait() with a timeout so the main thread still sees KeyboardInterrupt
+        while not result.ready():
+            result.wait(0.5)
+        try:
+            return result.get()
+        except (IOError, EOFError, ValueError), err:
+            raise DecompressionError("unable to decompress block of %s: %s" % (self.name, err))
+
+
+#
+# Private module classes and functions below here.
+#
+_header = re.compile(r"BZh[1-9]$")
+
+# the worker pool for each number of processes, as started by _get_pool()
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(processes):
+    # Return the pool of that many worker processes, starting it the first
+    # time it's needed.
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(processes)
+        if pool is None:
+            pool = _pools[processes] = multiprocessing.Pool(processes)
+        return pool
+    finally:
+        _pools_lock.release()
+
+def _find_magic(data, magic):
+    """
+    Return the sorted bit offsets of every occurrence of the 48-bit magic in
+    data. Only the bytes wholly covered by the magic at each of the 8
+    possible bit alignments are searched for, at the speed of find(); the
+    partial bytes at either end are then checked by hand.
+    """
+    offsets = []
+    for shift in xrange(8):
+        # the 7 bytes spanned by magic starting 'shift' bits into the first
+        window = [ord(c) for c in binascii.unhexlify("%014x" % (magic << (8 - shift)))]
+        if shift == 0:
+            needle = "".join(chr(b) for b in window[:6])
+            lead = 0
+        else:
+            needle = "".join(chr(b) for b in window[1:6])
+            lead = 1
+        head_mask = (1 << (8 - shift)) - 1
+        tail_mask = (0xff << (8 - shift)) & 0xff
+        pos = data.find(needle, lead)
+        while pos >= 0:
+            first = pos - lead
+            if shift == 0 or \
+               ((ord(data[first]) & head_mask) == window[0] and
+                first + 6 < len(data) and
+                (ord(data[first + 6]) & tail_mask) == (window[6] & tail_mask)):
+                offsets.append(first * 8 + shift)
+            pos = data.find(needle, pos + 1)
+    offsets.sort()
+    return offsets
+
+def _block_task(data, start, end):
+    """
+    Return the _decompress_block() task for the block at bit offsets
+    (start, end) of data.
+    """
+    first = start // 8
+    return (data[first:(end + 7) // 8], start - first * 8, end - start)
+
+def _decompress_block(task):
+    """
+    Worker process function: given (chunk, lead, nbits), where the block
+    occupies nbits bits of the string chunk after the first lead bits,
+    decompress that block and return (data, CPU seconds taken).
+    """
+    started = _cpu_time()
+    chunk, lead, nbits = task
+    block = int(binascii.hexlify(chunk), 16)
+    block = (block >> (len(chunk) * 8 - lead - nbits)) & ((1 << nbits) - 1)
+    # The block's CRC follows its magic number. A stream consisting of that
+    # block alone ends with the end-of-stream magic and a stream CRC equal to
+    # the block's CRC.
+    crc = (block >> (nbits - 48 - 32)) & 0xffffffff
+    stream = (((block << 48) | EOS_MAGIC) << 32) | crc
+    nbits += 48 + 32
+    padding = -nbits % 8
+    stream <<= padding
+    stream = "BZh9" + binascii.unhexlify("%0*x" % ((nbits + padding) // 4, stream))
+    return bz2.decompress(stream), _cpu_time() - started
+
+def _cpu_time():
+    user, system = os.times()[:2]
+    return user + system
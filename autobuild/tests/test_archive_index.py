@@ -0,0 +1,128 @@
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+#
+# Unit tests for the install cache's archive indexes
+#
+
+import os
+import time
+import shutil
+import tarfile
+import tempfile
+import unittest
+from hashlib import md5
+from autobuild import common, install_cache, archive_index, parallel_bzip2
+
+# incompressible, so that the files span several 900k bzip2 blocks
+FILES = dict(("lib/%s.a" % index,
+              "".join(md5("%s-%s" % (index, i)).digest() for i in xrange(40000)))
+             for index in xrange(5))
+FILES["include/foo.h"] = "fake header file"
+
+
+class TestArchiveIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        source = os.path.join(self.tempdir, "source")
+        for name, contents in FILES.iteritems():
+            path = os.path.join(source, *name.split("/"))
+            common.ensure_directory(os.path.dirname(path))
+            open(path, 'wb').write(contents)
+        self.source = source
+        self.min_parallel_size = parallel_bzip2.MIN_PARALLEL_SIZE
+        parallel_bzip2.MIN_PARALLEL_SIZE = 0
+
+    def make_archive(self, mode):
+        tarname = os.path.join(self.tempdir, "test-1.0-linux-20101101.tar." + mode)
+        tar = tarfile.open(tarname, 'w:' + mode)
+        for name in sorted(FILES):
+            tar.add(os.path.join(self.source, *name.split("/")), name)
+        tar.close()
+        return tarname
+
+    def extract(self, tarname, stream=None):
+        builder = archive_index.IndexBuilder()
+        install_dir = tempfile.mkdtemp(dir=self.tempdir)
+        files = common.extract_package(tarname, install_dir, tarname, stream, index=builder)
+        assert sorted(files) == sorted(FILES)
+        if stream is None:
+            builder.save(tarname)
+        else:
+            builder.save(tarname, stream.blocks, stream.offsets)
+        return archive_index.get_index(tarname)
+
+    def check_random_access(self, index):
+        assert index.random_access
+        assert sorted(index.names) == sorted(FILES)
+        # a tar stream of some of the members extracts just those
+        install_dir = tempfile.mkdtemp(dir=self.tempdir)
+        stream = index.open_stream(["lib/1.a", "lib/4.a"])
+        try:
+            files = common.extract_package(index.cachefile, install_dir, index.cachefile, stream)
+        finally:
+            stream.close()
+        assert sorted(files) == ["lib/1.a", "lib/4.a"]
+        for name in ("lib/1.a", "lib/4.a"):
+            assert open(os.path.join(install_dir, *name.split("/")), 'rb').read() == FILES[name]
+        self.assertRaises(archive_index.ArchiveIndexError, index.open_stream, ["lib/5.a"])
+
+    def test_uncompressed(self):
+        self.check_random_access(self.extract(self.make_archive("")))
+
+    def test_bzip2_blocks(self):
+        tarname = self.make_archive("bz2")
+        stream = parallel_bzip2.open_tar_stream(tarname, 2)
+        assert stream is not None
+        try:
+            index = self.extract(tarname, stream)
+        finally:
+            stream.close()
+        self.check_random_access(index)
+
+    def test_list_only(self):
+        # Compressed serially, there are no block offsets: the index can
+        # only list members.
+        tarname = self.make_archive("gz")
+        index = self.extract(tarname)
+        assert not index.random_access
+        assert sorted(archive_index.get_index(tarname).names) == sorted(FILES)
+        stream = index.open_stream(["include/foo.h"])
+        self.assertRaises(archive_index.ArchiveIndexError, stream.read)
+
+    def test_stale(self):
+        tarname = self.make_archive("")
+        self.extract(tarname)
+        assert archive_index.get_index(tarname) is not None
+        # an archive replaced since it was indexed
+        os.utime(tarname, (time.time(), time.time() + 10))
+        assert archive_index.get_index(tarname) is None
+        # removed along with its archive
+        install_cache.remove_entry(tarname, install_cache.VerifiedHashIndex(self.tempdir))
+        assert not os.path.exists(tarname + install_cache.TAR_INDEX_SUFFIX)
+
+    def tearDown(self):
+        parallel_bzip2.MIN_PARALLEL_SIZE = self.min_parallel_size
+        shutil.rmtree(self.tempdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,6 +21,15 @@
 # $/LicenseInfo$
 #!/usr/bin/python
 
+import os
+import bz2
+import shutil
+import struct
+import time
+import tarfile
+import urllib
+import zipfile
+import tempfile
 import unittest
 from autobuild import common
 
@@ -36,9 +45,314 @@ class TestCommon(unittest.TestCase):
         exe_path = common.find_executable(shell)
         assert exe_path != None
 
+    def test_hash_file(self):
+        from hashlib import md5
+        data = "0123456789" * 1000
+        handle, path = tempfile.mkstemp()
+        os.write(handle, data)
+        os.close(handle)
+        try:
+            expected = md5(data).hexdigest()
+            assert common.compute_md5(path) == expected
+            # buffer sizes that do and don't evenly divide the file
+            for size in (1000, 4096, len(data) * 2):
+                assert common.hash_file(md5(), path, size).hexdigest() == expected
+        finally:
+            os.remove(path)
+        # an empty file can't be memory-mapped
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            assert common.compute_md5(path) == md5().hexdigest()
+        finally:
+            os.remove(path)
+
+    def test_get_env_count(self):
+        name = "AUTOBUILD_TEST_COUNT"
+        try:
+            for value, expected in ((None, 7), ("", 7), ("3", 3), ("auto", 7), ("0", 1), ("-2", 1)):
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+                assert common.get_env_count(name, 7) == expected
+        finally:
+            os.environ.pop(name, None)
+
+    def test_download_package(self):
+        # larger than one chunk, so the copy has to loop
+        data = "autobuild" * (common.DOWNLOAD_CHUNK_SIZE / 4)
+        handle, source = tempfile.mkstemp(suffix=".tar.bz2")
+        os.write(handle, data)
+        os.close(handle)
+        url = "file://" + urllib.pathname2url(source)
+        cachename = common.get_package_in_cache(url)
+        try:
+            assert common.download_package(url)
+            assert open(cachename, 'rb').read() == data
+            # no temp file left beside the finished download
+            leftovers = [f for f in os.listdir(os.path.dirname(cachename))
+                         if f.startswith(os.path.basename(cachename) + ".")]
+            assert leftovers == [], leftovers
+        finally:
+            os.remove(source)
+            common.remove_package(url)
+
+    def test_sanitize_symlinks(self):
+        install_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(install_dir, "lib"))
+            files = ["lib"]
+            for name, soname in (("libfoo.so.1.2", "libfoo.so.1"), ("libbar.so.3", None)):
+                f = open(os.path.join(install_dir, "lib", name), 'wb')
+                f.write(make_elf(2, "<", soname))
+                f.close()
+                files.append("lib/" + name)
+            open(os.path.join(install_dir, "lib", "libfoo.so.1"), 'w').close()
+            files.append("lib/libfoo.so.1")
+            result = common.sanitize_symlinks(list(files), install_dir, "foo")
+            # each missing link added exactly once
+            assert sorted(result) == sorted(files + ["lib/libfoo.so", "lib/libbar.so"]), result
+            assert os.readlink(os.path.join(install_dir, "lib", "libfoo.so")) == "libfoo.so.1"
+            assert os.readlink(os.path.join(install_dir, "lib", "libbar.so")) == "libbar.so.3"
+        finally:
+            shutil.rmtree(install_dir)
+
+    def test_read_elf_soname(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            for elf_class in (1, 2):
+                for order in ("<", ">"):
+                    open(path, 'wb').write(make_elf(elf_class, order, "libfoo.so.1"))
+                    assert common._read_elf_soname(path) == "libfoo.so.1"
+                    open(path, 'wb').write(make_elf(elf_class, order, None))
+                    assert common._read_elf_soname(path) == ""
+            # not ELF, or cut short
+            open(path, 'wb').write("not an ELF file")
+            assert common._read_elf_soname(path) == ""
+            open(path, 'wb').write(make_elf(2, "<", "libfoo.so.1")[:100])
+            assert common._read_elf_soname(path) == ""
+        finally:
+            os.remove(path)
+        assert common._read_elf_soname(path) == ""
+
+    def test_dir_structure(self):
+        structure = common.DirStructure({"libraries/include": "include",
+                                         "libraries/i686-linux/include": "include",
+                                         "libraries/i686-linux/lib_release_client": "lib/release",
+                                         "libraries": "other",
+                                         "LICENSES": "LICENSES"})
+        remap = structure.remap
+        assert remap("libraries/include/foo.h") == "include/foo.h"
+        assert remap("./libraries/include/sub/foo.h") == "include/sub/foo.h"
+        # the longest matching rule wins
+        assert remap("libraries/i686-linux/include/bar.h") == "include/bar.h"
+        assert remap("libraries/i686-linux/lib_release_client/libbar.a") == "lib/release/libbar.a"
+        assert remap("libraries/i686-linux/lib_debug/libbar.a") == "other/i686-linux/lib_debug/libbar.a"
+        # rules match whole components
+        assert remap("LICENSES-extra/foo.txt") is None
+        assert remap("LICENSES/foo.txt") == "LICENSES/foo.txt"
+        # a file is placed by its directory, a directory by its own name
+        assert remap("LICENSES") is None
+        assert remap("LICENSES", isdir=True) == "LICENSES"
+        assert remap("libraries/include/", isdir=True) == "include"
+        assert remap("README") is None
+        assert common.get_dir_structure(None) is None
+        assert common.get_dir_structure("None") is None
+
+    def test_member_filter(self):
+        remap = common.MemberFilter(only=["include", "lib/release/*.a"], exclude=["*/internal"]).remap
+        assert remap("include/foo.h") == "include/foo.h"
+        assert remap("./include/sub/foo.h") == "./include/sub/foo.h"
+        assert remap("include/internal/foo.h") is None
+        assert remap("lib/release/libfoo.a") == "lib/release/libfoo.a"
+        assert remap("lib/debug/libfoo.a") is None
+        assert remap("docs/README") is None
+        # directories that may hold selected files are kept
+        assert remap("lib", isdir=True) == "lib"
+        assert remap("lib/release", isdir=True) == "lib/release"
+        assert remap("lib/debug", isdir=True) is None
+        assert remap(".", isdir=True) == "."
+        # a single pattern, and dir_structure applied first
+        remap = common.MemberFilter(exclude="docs/",
+                                    structure=common.DirStructure({"libraries": "lib"})).remap
+        assert remap("libraries/foo.a") == "lib/foo.a"
+        assert remap("libraries/docs/README") == "lib/docs/README"
+        assert remap("docs/README") is None
+        assert common.get_member_map(None, [], None) is None
+
+    def test_extract_dir_structure(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tempdir, "source")
+            for d in (("libraries", "include"), ("libraries", "i686-linux", "include"), ("docs",)):
+                os.makedirs(os.path.join(source, *d))
+            for f in (("libraries", "include", "a.h"), ("libraries", "i686-linux", "include", "b.h"),
+                      ("docs", "README")):
+                open(os.path.join(source, *f), 'w').write("/".join(f))
+            tarname = os.path.join(tempdir, "test-1.0-linux-20101101.tar.bz2")
+            tar = tarfile.open(tarname, 'w:bz2')
+            tar.add(source, ".")
+            tar.close()
+            install_dir = os.path.join(tempdir, "packages")
+            structure = {"libraries/include": "include", "libraries/i686-linux/include": "include"}
+            files = common.extract_package(tarname, install_dir, tarname, structure=structure)
+            assert sorted(files) == ["include", "include/a.h", "include/b.h"], files
+            assert open(os.path.join(install_dir, "include", "b.h")).read() == \
+                   "libraries/i686-linux/include/b.h"
+            # nothing extracted that no rule places
+            assert sorted(os.listdir(install_dir)) == ["include"]
+            # the same, reading a stream
+            shutil.rmtree(install_dir)
+            stream = bz2.BZ2File(tarname)
+            try:
+                files = common.extract_package(tarname, install_dir, tarname, stream, structure)
+            finally:
+                stream.close()
+            assert sorted(files) == ["include", "include/a.h", "include/b.h"], files
+            assert sorted(os.listdir(install_dir)) == ["include"]
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_iter_extract_package(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            tarname = os.path.join(tempdir, "test-1.0-linux-20101101.tar.gz")
+            tar = tarfile.open(tarname, 'w:gz')
+            for name in ("a.txt", "b.txt", "c.txt"):
+                source = os.path.join(tempdir, name)
+                open(source, 'w').write(name)
+                tar.add(source, "data/" + name)
+            tar.close()
+            install_dir = os.path.join(tempdir, "packages")
+            names = common.iter_extract_package(tarname, install_dir, tarname, threads=1)
+            # members are extracted only as the caller asks for them
+            assert names.next() == "data/a.txt"
+            assert os.path.exists(os.path.join(install_dir, "data", "a.txt"))
+            assert not os.path.exists(os.path.join(install_dir, "data", "c.txt"))
+            assert list(names) == ["data/b.txt", "data/c.txt"]
+            assert open(os.path.join(install_dir, "data", "c.txt")).read() == "c.txt"
+            assert common.iter_extract_package(tarname, install_dir,
+                                               os.path.join(tempdir, "missing.tar.gz")) is None
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_extract_threads(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tempdir, "source")
+            names = []
+            for d in xrange(5):
+                os.makedirs(os.path.join(source, "include", str(d)))
+                for f in xrange(20):
+                    name = "include/%s/%s.h" % (d, f)
+                    open(os.path.join(source, name), 'w').write(name)
+                    os.utime(os.path.join(source, name), (1000000000, 1000000000))
+                    names.append(name)
+            os.chmod(os.path.join(source, "include", "0", "0.h"), 0750)
+            tarname = os.path.join(tempdir, "test-1.0-linux-20101101.tar.bz2")
+            tar = tarfile.open(tarname, 'w:bz2')
+            tar.add(os.path.join(source, "include"), "include")
+            tar.close()
+            for restore_attributes in (True, False):
+                install_dir = os.path.join(tempdir, "packages-%s" % restore_attributes)
+                files = common.extract_package(tarname, install_dir, tarname, threads=4,
+                                               restore_attributes=restore_attributes)
+                assert sorted(f for f in files if f.endswith(".h")) == sorted(names)
+                for name in names:
+                    path = os.path.join(install_dir, name)
+                    assert open(path).read() == name
+                    assert (os.stat(path).st_mtime == 1000000000) == restore_attributes
+                # permissions are always set
+                assert os.stat(os.path.join(install_dir, "include", "0", "0.h")).st_mode & 0777 == 0750
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_extract_zip(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            zipname = os.path.join(tempdir, "test-1.0-linux-20101101.zip")
+            archive = zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED)
+            archive.writestr(zipfile.ZipInfo("include/"), "")
+            names = []
+            for f in xrange(20):
+                name = "include/%s.h" % f
+                info = zipfile.ZipInfo(name, (2001, 9, 9, 1, 46, 40))
+                info.create_system = 3
+                info.external_attr = (0100640 if f == 0 else 0100644) << 16
+                archive.writestr(info, name * 1000, zipfile.ZIP_DEFLATED)
+                names.append(name)
+            link = zipfile.ZipInfo("lib/libfoo.so")
+            link.create_system = 3
+            link.external_attr = 0120777 << 16
+            archive.writestr(link, "libfoo.so.1")
+            archive.writestr("lib/libfoo.so.1", "fake shared library")
+            archive.writestr("../outside.h", "not to be extracted")
+            archive.close()
+            assert common.is_zip_archive(zipname)
+            for threads in (1, 4):
+                install_dir = os.path.join(tempdir, "packages-%s" % threads)
+                files = common.extract_package(zipname, install_dir, zipname, threads=threads)
+                assert sorted(files) == \
+                       sorted(["include"] + names + ["lib/libfoo.so", "lib/libfoo.so.1"])
+                for name in names:
+                    assert open(os.path.join(install_dir, name)).read() == name * 1000
+                path = os.path.join(install_dir, "include", "0.h")
+                assert os.stat(path).st_mode & 0777 == 0640
+                assert os.stat(path).st_mtime == time.mktime((2001, 9, 9, 1, 46, 40, 0, 0, -1))
+                assert os.readlink(os.path.join(install_dir, "lib", "libfoo.so")) == "libfoo.so.1"
+                assert not os.path.exists(os.path.join(tempdir, "outside.h"))
+            # dir_structure and selection apply as for a tarball
+            install_dir = os.path.join(tempdir, "structured")
+            files = common.extract_package(zipname, install_dir, zipname,
+                                           structure={"include": "include/test"},
+                                           exclude=["include/test/1*.h"])
+            assert sorted(files) == \
+                   sorted(["include/test"] + ["include/test/%s.h" % f for f in [0] + range(2, 10)])
+        finally:
+            shutil.rmtree(tempdir)
+
     def tearDown(self):
         pass
 
+def make_elf(elf_class, order, soname):
+    """
+    Return the bytes of a minimal ELF shared library of the specified class
+    (1 = 32-bit, 2 = 64-bit) and byte order ("<" or ">"), whose dynamic
+    section records soname, if given. Its one loadable segment is placed at
+    a virtual address unlike its file offset.
+    """
+    if elf_class == 1:
+        header, phdr, dyn = "HHIIIIIHHHHHH", "IIIIIIII", "iI"
+    else:
+        header, phdr, dyn = "HHIQQQIHHHHHH", "IIQQQQQQ", "qQ"
+    header_size = 16 + struct.calcsize(order + header)
+    phdr_size = struct.calcsize(order + phdr)
+    vaddr = 0x10000
+    strtab = "\0libc.so.6\0" + (soname or "") + "\0"
+    strtab_offset = header_size + 2 * phdr_size
+    dynamic_offset = strtab_offset + len(strtab)
+    entries = [(1, 1), (5, vaddr + strtab_offset)]  # DT_NEEDED, DT_STRTAB
+    if soname:
+        entries.append((14, 11))                      # DT_SONAME
+    entries.append((0, 0))                            # DT_NULL
+    dynamic = "".join(struct.pack(order + dyn, *entry) for entry in entries)
+    size = dynamic_offset + len(dynamic)
+
+    def program_header(p_type, offset, address, filesz):
+        if elf_class == 1:
+            return struct.pack(order + phdr, p_type, offset, address, address, filesz, filesz, 6, 4)
+        return struct.pack(order + phdr, p_type, 6, offset, address, address, filesz, filesz, 8)
+
+    ident = "\x7fELF" + chr(elf_class) + chr({"<": 1, ">": 2}[order]) + "\x01" + "\0" * 9
+    return (ident +
+            struct.pack(order + header, 3, 62, 1, 0, header_size, 0, 0,
+                        header_size, phdr_size, 2, 0, 0, 0) +
+            program_header(1, 0, vaddr, size) +                         # PT_LOAD
+            program_header(2, dynamic_offset, vaddr + dynamic_offset, len(dynamic)) +  # PT_DYNAMIC
+            strtab + dynamic)
+
 if __name__ == '__main__':
     unittest.main()
 
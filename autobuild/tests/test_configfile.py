@@ -26,6 +26,9 @@
 import unittest
 import os
 import sys
+import shutil
+import hashlib
+import tempfile
 from baseline_compare import AutobuildBaselineCompare
 from autobuild import configfile
 from autobuild.executable import Executable
@@ -54,6 +57,215 @@ class TestConfigFile(unittest.TestCase, AutobuildBaselineCompare):
         assert reloaded.package_description.platforms['common'].build_directory == '.'
         assert reloaded.package_description.platforms['common'].configurations['common'].build.get_command() == 'gcc'
 
+    def test_binary_installed(self):
+        manifests = dict(bogus=["lib", "lib/bogus.lib", "include/", "include/bogus.h", "README"],
+                         extra=["lib/extra.lib", "include/extra/extra.h"])
+        for suffix in (configfile.BINARY_CONFIG_SUFFIX, ".xml"):
+            handle, tmp_file = tempfile.mkstemp(suffix=suffix)
+            os.close(handle)
+            os.remove(tmp_file)
+            try:
+                config = configfile.ConfigurationDescription(tmp_file)
+                for name, manifest in manifests.iteritems():
+                    package = configfile.PackageDescription(name)
+                    package.install_dir = "/tmp/packages"
+                    platform = configfile.PlatformDescription()
+                    platform.manifest = manifest
+                    package.platforms['linux'] = platform
+                    config.installables[name] = package
+                config.save()
+                data = open(tmp_file, 'rb').read()
+                assert data.startswith("<?llsd/binary?>") == (suffix == configfile.BINARY_CONFIG_SUFFIX)
+                reloaded = configfile.ConfigurationDescription(tmp_file)
+                assert sorted(reloaded.installables) == sorted(manifests)
+                for name, manifest in manifests.iteritems():
+                    package = reloaded.installables[name]
+                    assert package.install_dir == "/tmp/packages"
+                    assert package.platforms['linux'].manifest == manifest
+                assert 'manifest_directories' not in reloaded
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+    def test_sharded_installables(self):
+        def add_package(config, name, version):
+            package = configfile.PackageDescription(name)
+            package.version = version
+            package.platforms['linux'] = configfile.PlatformDescription()
+            package.platforms['linux'].manifest = ["include/%s.h" % name]
+            config.installables[name] = package
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for suffix in (".xml", configfile.BINARY_CONFIG_SUFFIX):
+                tmp_file = os.path.join(tmp_dir, "installed" + suffix)
+                records = os.path.join(tmp_dir, "installed" + configfile.RECORDS_SUFFIX)
+                # an existing monolithic file is split up when next saved
+                config = configfile.ConfigurationDescription(tmp_file)
+                for name in "a", "b":
+                    add_package(config, name, "1.0")
+                config.save()
+                config = configfile.ConfigurationDescription(tmp_file, shard_installables=True)
+                assert sorted(config.installables) == ["a", "b"]
+                config.save()
+                assert sorted(os.listdir(records)) == ["a" + suffix, "b" + suffix]
+                # Two processes changing different installables: each writes
+                # only its own.
+                first = configfile.ConfigurationDescription(tmp_file, shard_installables=True)
+                second = configfile.ConfigurationDescription(tmp_file, shard_installables=True)
+                del first.installables["a"]
+                add_package(first, "c", "1.0")
+                add_package(second, "b", "2.0")
+                first.save()
+                second.save()
+                # readable without asking for sharding
+                reloaded = configfile.ConfigurationDescription(tmp_file)
+                assert sorted(reloaded.installables) == ["b", "c"]
+                assert reloaded.installables["b"].version == "2.0"
+                assert 'installable_records' not in reloaded
+                # records are parsed, and cached, as the file itself is: the
+                # manifests come back compact, whether parsed or cached
+                for attempt in range(2):
+                    reloaded = configfile.ConfigurationDescription(tmp_file, shard_installables=True)
+                    manifest = reloaded.installables["b"].platforms['linux'].manifest
+                    assert isinstance(manifest, configfile._CompactManifest)
+                    assert manifest == ["include/b.h"]
+                os.remove(tmp_file)
+                shutil.rmtree(records)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_parse_cache(self):
+        tmp_file = self.get_tmp_file(5)
+        config = configfile.ConfigurationDescription(tmp_file)
+        config.package_description = configfile.PackageDescription('cached')
+        package = configfile.PackageDescription('foo')
+        platform = configfile.PlatformDescription()
+        platform.archive = configfile.ArchiveDescription()
+        platform.archive.url = configfile.llsd.uri("http://localhost/foo.tar.bz2")
+        platform.manifest = ["include/foo.h", u"lib/\xe9t\xe9.a"]
+        package.platforms['linux'] = platform
+        config.installables['foo'] = package
+        config.save()
+        expected = configfile._read_config(tmp_file)
+        reads = []
+        read_config = configfile._read_config
+        def counting_read(path):
+            reads.append(path)
+            return read_config(path)
+        configfile._read_config = counting_read
+        try:
+            assert configfile._parse_config(tmp_file) == expected
+            # Loaded again, the file isn't parsed, and its uri is still one.
+            cached = configfile._parse_config(tmp_file)
+            reloaded = configfile.ConfigurationDescription(tmp_file)
+            assert len(reads) == 1
+            assert cached == expected
+            assert isinstance(cached['installables']['foo']['platforms']['linux']['archive']['url'],
+                              configfile.llsd.uri)
+            assert reloaded.package_description.name == 'cached'
+            assert reloaded.installables['foo'].platforms['linux'].manifest == platform.manifest
+            # The cache is the user's alone.
+            cache_dir = configfile._get_config_cache_dir()
+            os.chmod(cache_dir, 0777)
+            assert configfile._get_config_cache_dir() == cache_dir
+            assert not os.stat(cache_dir).st_mode & 022
+            if hasattr(os, "geteuid") and os.geteuid() == 0:
+                # an entry belonging to someone else is ignored
+                entry = os.path.join(cache_dir, hashlib.md5(os.path.abspath(tmp_file)).hexdigest() +
+                                     configfile.BINARY_CONFIG_SUFFIX)
+                os.chown(entry, 12345, -1)
+                assert configfile._parse_config(tmp_file) == expected
+                assert len(reads) == 2
+        finally:
+            configfile._read_config = read_config
+        # but a changed file is
+        reloaded.package_description.name = 'changed'
+        reloaded.save()
+        assert configfile.ConfigurationDescription(tmp_file).package_description.name == 'changed'
+
+    def test_parse_cache_bounds(self):
+        tmp_dir = tempfile.mkdtemp()
+        cache_dir = os.path.join(tmp_dir, "config.cache")
+        os.mkdir(cache_dir)
+        get_temp_dir = configfile.common.get_temp_dir
+        max_entries = configfile._CONFIG_CACHE_MAX_ENTRIES
+        configfile.common.get_temp_dir = lambda basename: cache_dir
+        configfile._CONFIG_CACHE_MAX_ENTRIES = 2
+        try:
+            # only the entries most recently used are kept
+            for age, name in enumerate("abc"):
+                entry = os.path.join(cache_dir, name + configfile.BINARY_CONFIG_SUFFIX)
+                open(entry, 'wb').close()
+                os.utime(entry, (1000000000 - age, 1000000000 - age))
+            configfile._prune_config_cache(cache_dir)
+            assert sorted(os.listdir(cache_dir)) == ["a.llsd", "b.llsd"]
+            if hasattr(os, "geteuid"):
+                assert configfile._get_config_cache_dir() == cache_dir
+                # nor is the cache used if anyone else could replace it
+                os.chmod(tmp_dir, 0777)
+                assert configfile._get_config_cache_dir() is None
+        finally:
+            configfile.common.get_temp_dir = get_temp_dir
+            configfile._CONFIG_CACHE_MAX_ENTRIES = max_entries
+            shutil.rmtree(tmp_dir)
+
+    def test_lazy_installables(self):
+        tmp_file = self.get_tmp_file(6)
+        config = configfile.ConfigurationDescription(tmp_file)
+        for name in "a", "b", "c":
+            package = configfile.PackageDescription(name)
+            platform = configfile.PlatformDescription()
+            platform.archive = configfile.ArchiveDescription()
+            platform.archive.url = "http://localhost/%s.tar.bz2" % name
+            package.platforms['linux'] = platform
+            config.installables[name] = package
+        config.save()
+        reloaded = configfile.ConfigurationDescription(tmp_file)
+        assert reloaded.installables.unloaded == set(["a", "b", "c"])
+        # only what's asked for is constructed
+        assert reloaded.installables["b"].platforms['linux'].archive.url == "http://localhost/b.tar.bz2"
+        assert reloaded.installables.unloaded == set(["a", "c"])
+        reloaded.installables.pop("c")
+        reloaded.save()
+        again = configfile.ConfigurationDescription(tmp_file)
+        assert sorted(again.installables) == ["a", "b"]
+        for package in again.installables.itervalues():
+            assert isinstance(package, configfile.PackageDescription)
+            assert isinstance(package.platforms['linux'].archive, configfile.ArchiveDescription)
+        assert again.installables["a"].platforms['linux'].archive.url == "http://localhost/a.tar.bz2"
+
+    def test_streaming_parse(self):
+        manifest = ["lib", "lib/libfoo.a", u"include/\xe9t\xe9.h", "include/a&b.h"]
+        tmp_file = self.get_tmp_file(7)
+        config = configfile.ConfigurationDescription(tmp_file)
+        package = configfile.PackageDescription('foo')
+        package.version = "1.0"
+        platform = configfile.PlatformDescription()
+        platform.manifest = list(manifest)
+        platform.configurations['common'] = configfile.BuildConfigurationDescription()
+        platform.configurations['common'].default = True
+        package.platforms['linux'] = platform
+        config.installables['foo'] = package
+        config.save()
+        parsed = configfile._read_config(tmp_file)
+        expected = configfile.llsd.parse(open(tmp_file, 'rb').read())
+        stored = parsed['installables']['foo']['platforms']['linux'].pop('manifest')
+        assert expected['installables']['foo']['platforms']['linux'].pop('manifest') == manifest
+        assert parsed == expected
+        # the manifest is stored compactly, but acts as a list
+        assert isinstance(stored, configfile._CompactManifest)
+        assert stored == manifest and list(reversed(stored)) == manifest[::-1]
+        assert stored[2] == manifest[2] and stored[-1] == "include/a&b.h"
+        stored.append("include/new.h")
+        stored.remove("lib/libfoo.a")
+        assert stored == ["lib", manifest[2], "include/a&b.h", "include/new.h"]
+        reloaded = configfile.ConfigurationDescription(tmp_file)
+        reloaded.installables['foo'].platforms['linux'].manifest.append("bin/foo")
+        reloaded.save()
+        assert configfile.ConfigurationDescription(tmp_file).installables['foo'] \
+               .platforms['linux'].manifest == manifest + ["bin/foo"]
+
     def tearDown(self):
         self.cleanup_tmp_file()
 
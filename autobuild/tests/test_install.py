@@ -38,11 +38,13 @@ import urllib
 import urlparse
 import posixpath
 import subprocess
+import zipfile
 from cStringIO import StringIO
-from threading import Thread
+from threading import Thread, Event
 from BaseHTTPServer import HTTPServer
 from SimpleHTTPServer import SimpleHTTPRequestHandler
-from autobuild import autobuild_tool_install, autobuild_tool_uninstall, configfile, common
+from autobuild import autobuild_tool_install, autobuild_tool_uninstall, configfile, common, \
+     install_cache
 
 mydir = os.path.dirname(__file__)
 HOST = '127.0.0.1'                      # localhost server
@@ -212,7 +214,7 @@ def setup():
 
     # Capture initial state of the autobuild download cache. Use a set so we
     # can take set difference with subsequent snapshot.
-    INIT_CACHE = set(os.listdir(common.get_default_install_cache_dir()))
+    INIT_CACHE = cache_inventory()
 
     # For the duration of this script, run a server thread from which to
     # direct autobuild to "download" test archives. Various tests will
@@ -267,6 +269,9 @@ def setup():
                      list_licenses=False,
                      export_manifest=False,
                      as_source=[],
+                     jobs=1,
+                     only=[],
+                     exclude=[],
                      verbose=False,
                      ):
             # Take all constructor params and assign as object attributes.
@@ -327,6 +332,16 @@ def setup():
              include={"bogus.h": "fake header file 0.2"}),
         license="N/A")
     # Note intentional omission: "bogus-0.2" tarball has no LICENSES file.
+    FIXTURES["extra-0.3"] = ArchiveFixture("extra-0.3-darwin-20101027.tar.bz2",
+        dict(lib={"extra.lib": "another fake object library"},
+             include={"extra.h": "another fake header file"},
+             LICENSES={"extra.txt": "another fake license file"}),
+        license="N/A")
+    FIXTURES["zipped-0.4"] = ArchiveFixture("zipped-0.4-darwin-20101101.zip",
+        dict(lib={"zipped.lib": "zipped object library"},
+             include={"zipped.h": "zipped header file"},
+             LICENSES={"zipped.txt": "zipped license file"}),
+        license="N/A")
 
     FIXTURES["sourcepkg"] = RepositoryFixture("sourcepkg",
         dict(indra=dict(newview={"something.cpp": "fake C++ source file",
@@ -380,8 +395,27 @@ def clean_cache():
     # Okay, we believe INIT_CACHE is valid. Inventory cache directory again
     # to discover what we've added since we started.
     cachedir = common.get_default_install_cache_dir()
-    for f in set(os.listdir(cachedir)) - INIT_CACHE:
-        clean_file(os.path.join(cachedir, f))
+    # deepest first, so that directories are empty by the time we get to them
+    for f in sorted(cache_inventory() - INIT_CACHE, reverse=True):
+        if f.endswith(os.sep):
+            clean_dir(os.path.join(cachedir, f))
+        else:
+            clean_file(os.path.join(cachedir, f))
+
+def cache_inventory():
+    """
+    Return the set of files and directories (the latter with a trailing
+    os.sep) in the autobuild cache directory, including everything in the
+    subdirectories of its content-addressed and unpacked stores, as pathnames
+    relative to the cache directory.
+    """
+    cachedir = common.get_default_install_cache_dir()
+    inventory = set()
+    for dirpath, dirnames, filenames in os.walk(cachedir):
+        reldir = dirpath[len(cachedir):].lstrip(os.sep)
+        inventory.update(os.path.join(reldir, f) for f in filenames)
+        inventory.update(os.path.join(reldir, d, "") for d in dirnames)
+    return inventory
 
 # ****************************************************************************
 #   Local server machinery
@@ -504,6 +538,15 @@ class TestInstallArchive(BaseTest):
         assert os.path.exists(os.path.join(INSTALL_DIR, "include", "bogus.h"))
         assert_in(self.pkg, query_manifest(self.options))
 
+    def test_export_manifest(self):
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        # the installed manifest is held compactly, but exported as a list
+        manifest = query_manifest(self.options)[self.pkg]["platforms"]["darwin"]["manifest"]
+        assert isinstance(manifest, list)
+        assert_equals(sorted(os.path.normpath(f) for f in manifest),
+                      [".", "LICENSES", "LICENSES/bogus.txt", "include", "include/bogus.h",
+                       "lib", "lib/bogus.lib"])
+
     def test_dry_run(self):
         dry_opts = self.options.copy()
         dry_opts.dry_run = True
@@ -547,6 +590,124 @@ class TestInstallArchive(BaseTest):
         # verify that the update actually updated a file still in package
         assert_in("0.2", open(os.path.join(INSTALL_DIR, "include", "bogus.h")).read())
 
+    def test_update_incremental(self):
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        self.check_update_incremental()
+
+    def test_update_incremental_unstored(self):
+        os.environ[install_cache.UNPACKED_STORE_ENV] = "0"
+        try:
+            autobuild_tool_install.install_packages(self.options, [self.pkg])
+            self.check_update_incremental()
+        finally:
+            del os.environ[install_cache.UNPACKED_STORE_ENV]
+
+    def check_update_incremental(self):
+        lib = os.path.join(INSTALL_DIR, "lib", "bogus.lib")
+        header = os.path.join(INSTALL_DIR, "include", "bogus.h")
+        # back-date what's installed, to see which files the update rewrites
+        for f in lib, header:
+            os.utime(f, (1000000000, 1000000000))
+        lib_inode = os.stat(lib).st_ino
+        fixture = FIXTURES[self.pkg + "-0.2"]
+        self.copyto(fixture.pathname, SERVER_DIR)
+        self.set_package(fixture.package)
+        self.options.check_license = False
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        # bogus.lib is the same in 0.2: left alone
+        assert_equals(os.stat(lib).st_mtime, 1000000000)
+        assert_equals(os.stat(lib).st_ino, lib_inode)
+        # bogus.h changed
+        assert os.stat(header).st_mtime != 1000000000
+        assert_in("0.2", open(header).read())
+        # LICENSES/bogus.txt is gone from 0.2
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "LICENSES", "bogus.txt"))
+        installed = configfile.ConfigurationDescription(self.options.installed_filename)
+        platform = installed.installables[self.pkg].platforms["darwin"]
+        assert_equals(platform.archive.hash, fixture.package.platforms["darwin"].archive.hash)
+        assert_equals(sorted(os.path.normpath(f) for f in platform.manifest),
+                      [".", "include", "include/bogus.h", "lib", "lib/bogus.lib"])
+
+    def test_dir_structure(self):
+        self.check_dir_structure()
+
+    def test_dir_structure_unstored(self):
+        os.environ[install_cache.UNPACKED_STORE_ENV] = "0"
+        try:
+            self.check_dir_structure()
+        finally:
+            del os.environ[install_cache.UNPACKED_STORE_ENV]
+
+    def check_dir_structure(self):
+        structure = {"lib": "lib/release", "include": "include/bogus"}
+        package = FIXTURES[self.pkg + "-0.1"].package.copy()
+        package.platforms["darwin"].archive.dir_structure = structure
+        self.set_package(package)
+        self.options.check_license = False
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "release", "bogus.lib"))
+        assert os.path.exists(os.path.join(INSTALL_DIR, "include", "bogus", "bogus.h"))
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        # no rule places LICENSES
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "LICENSES"))
+        installed = configfile.ConfigurationDescription(self.options.installed_filename)
+        assert_equals(sorted(installed.installables[self.pkg].platforms["darwin"].manifest),
+                      ["include/bogus", "include/bogus/bogus.h", "lib/release", "lib/release/bogus.lib"])
+        # upgrade to 0.2 in place, under the same rules
+        fixture = FIXTURES[self.pkg + "-0.2"]
+        self.copyto(fixture.pathname, SERVER_DIR)
+        package = fixture.package.copy()
+        package.platforms["darwin"].archive.dir_structure = structure
+        self.set_package(package)
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        assert_in("0.2", open(os.path.join(INSTALL_DIR, "include", "bogus", "bogus.h")).read())
+        autobuild_tool_uninstall.uninstall_packages(self.options, [self.pkg])
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "lib", "release", "bogus.lib"))
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "include", "bogus"))
+
+    def test_zip(self):
+        fixture = FIXTURES["zipped-0.4"]
+        self.copyto(fixture.pathname, SERVER_DIR)
+        self.new_package(fixture.package)
+        autobuild_tool_install.install_packages(self.options, ["zipped"])
+        assert_equals(open(os.path.join(INSTALL_DIR, "include", "zipped.h")).read(),
+                      "zipped header file")
+        installed = configfile.ConfigurationDescription(self.options.installed_filename)
+        assert_equals(sorted(installed.installables["zipped"].platforms["darwin"].manifest),
+                      ["LICENSES", "LICENSES/zipped.txt", "include", "include/zipped.h",
+                       "lib", "lib/zipped.lib"])
+        autobuild_tool_uninstall.uninstall_packages(self.options, ["zipped"])
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "lib", "zipped.lib"))
+
+    def test_only_exclude(self):
+        self.options.check_license = False
+        self.options.exclude = ["LICENSES"]
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "LICENSES"))
+        # a new selection on the command line is installed even though the
+        # archive hasn't changed
+        self.options.exclude = []
+        self.options.only = ["include/*.h"]
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        assert os.path.exists(os.path.join(INSTALL_DIR, "include", "bogus.h"))
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "lib"))
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "LICENSES"))
+        installed = configfile.ConfigurationDescription(self.options.installed_filename)
+        package = installed.installables[self.pkg]
+        assert_equals(package.only, ["include/*.h"])
+        assert_not_in("exclude", package)
+        assert_equals(sorted(os.path.normpath(f) for f in package.platforms["darwin"].manifest),
+                      [".", "include", "include/bogus.h"])
+        # patterns in autobuild.xml apply when the command line has none
+        self.options.only = []
+        package = FIXTURES[self.pkg + "-0.1"].package.copy()
+        package.exclude = ["include"]
+        self.set_package(package)
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "include"))
+
     def test_update_move(self):
         # test_success() establishes that this first one should work
         autobuild_tool_install.install_packages(self.options, [self.pkg])
@@ -627,6 +788,128 @@ class TestInstallArchive(BaseTest):
             autobuild_tool_install.install_packages(self.options, [])
         assert_equals(set_from_stream(stream), set(("Apache", "tut", "N/A")))
 
+# -------------------------------------  -------------------------------------
+class TestInstallParallel(BaseTest):
+    def setup(self):
+        BaseTest.setup(self)
+        self.pkgs = ["bogus", "extra"]
+        self.copyto(FIXTURES["bogus-0.1"].pathname, SERVER_DIR)
+        self.new_package(FIXTURES["bogus-0.1"].package)
+        self.new_package(FIXTURES["extra-0.3"].package)
+        self.options.jobs = 4
+
+    def test_success(self):
+        self.copyto(FIXTURES["extra-0.3"].pathname, SERVER_DIR)
+        autobuild_tool_install.install_packages(self.options, self.pkgs)
+        for f in ("bogus.lib", "extra.lib"):
+            assert os.path.exists(os.path.join(INSTALL_DIR, "lib", f))
+        for f in ("bogus.h", "extra.h"):
+            assert os.path.exists(os.path.join(INSTALL_DIR, "include", f))
+        # query_manifest() can only parse a single installed package
+        installed = configfile.ConfigurationDescription(self.options.installed_filename)
+        assert_equals(sorted(installed.installables.keys()), self.pkgs)
+        assert_in("lib/extra.lib", [os.path.normpath(f) for f in
+                                    installed.installables["extra"].platforms["darwin"].manifest])
+
+    def test_one_failure(self):
+        # extra-0.3 isn't on the server: its failure should be reported by
+        # name without preventing bogus from being installed.
+        with ExpectError("extra", "expected InstallError naming the failed package"):
+            autobuild_tool_install.install_packages(self.options, self.pkgs)
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "lib", "extra.lib"))
+        # and what was installed is recorded, so that it can be uninstalled
+        installed = configfile.ConfigurationDescription(self.options.installed_filename)
+        assert_equals(installed.installables.keys(), ["bogus"])
+
+    def test_corrupt_archive(self):
+        # extra-0.3 cut short: whatever extracting it raises should be
+        # reported by name without preventing bogus from being installed.
+        fixture = FIXTURES["extra-0.3"]
+        corrupt = os.path.join(SERVER_DIR, os.path.basename(fixture.pathname))
+        with open(corrupt, "wb") as f:
+            f.write(open(fixture.pathname, "rb").read()[:200])
+        self.tempfiles.append(corrupt)
+        package = fixture.package.copy()
+        package.platforms["darwin"].archive.hash = common.compute_md5(corrupt)
+        self.set_package(package)
+        with ExpectError("extra", "expected InstallError naming the corrupt package"):
+            autobuild_tool_install.install_packages(self.options, self.pkgs)
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        installed = configfile.ConfigurationDescription(self.options.installed_filename)
+        assert_equals(installed.installables.keys(), ["bogus"])
+
+    def test_pipeline(self):
+        # Even with a single job, extra should be fetched while bogus is
+        # being extracted.
+        self.options.jobs = 1
+        self.copyto(FIXTURES["extra-0.3"].pathname, SERVER_DIR)
+        fetched_extra = Event()
+        overlapped = []
+        real_fetch = autobuild_tool_install._fetch_archive
+        real_extract = autobuild_tool_install._extract_archive
+        def fetch(package, archive):
+            result = real_fetch(package, archive)
+            if package.name == "extra":
+                fetched_extra.set()
+            return result
+        def extract(package, *args):
+            if package.name == "bogus":
+                fetched_extra.wait(10)
+                overlapped.append(fetched_extra.isSet())
+            return real_extract(package, *args)
+        autobuild_tool_install._fetch_archive = fetch
+        autobuild_tool_install._extract_archive = extract
+        try:
+            autobuild_tool_install.install_packages(self.options, self.pkgs)
+        finally:
+            autobuild_tool_install._fetch_archive = real_fetch
+            autobuild_tool_install._extract_archive = real_extract
+        assert_equals(overlapped, [True])
+        for f in ("bogus.lib", "extra.lib"):
+            assert os.path.exists(os.path.join(INSTALL_DIR, "lib", f))
+
+    def test_concurrent_extraction(self):
+        # With several jobs, bogus and extra should be extracted at once,
+        # and still recorded in the order requested.
+        self.copyto(FIXTURES["extra-0.3"].pathname, SERVER_DIR)
+        started_extra = Event()
+        overlapped = []
+        real_extract = autobuild_tool_install._extract_archive
+        def extract(package, *args):
+            if package.name == "extra":
+                started_extra.set()
+            else:
+                started_extra.wait(10)
+                overlapped.append(started_extra.isSet())
+            return real_extract(package, *args)
+        autobuild_tool_install._extract_archive = extract
+        try:
+            packages = autobuild_tool_install.do_install(
+                self.pkgs, configfile.ConfigurationDescription(self.options.install_filename),
+                configfile.ConfigurationDescription(self.options.installed_filename),
+                self.options.platform, INSTALL_DIR, False, jobs=self.options.jobs)
+        finally:
+            autobuild_tool_install._extract_archive = real_extract
+        assert_equals(overlapped, [True])
+        assert_equals(packages, self.pkgs)
+        for f in ("bogus.lib", "extra.lib"):
+            assert os.path.exists(os.path.join(INSTALL_DIR, "lib", f))
+
+    def test_upgrade(self):
+        # an installed package is replaced once the others are extracted
+        self.copyto(FIXTURES["extra-0.3"].pathname, SERVER_DIR)
+        autobuild_tool_install.install_packages(self.options, self.pkgs)
+        self.copyto(FIXTURES["bogus-0.2"].pathname, SERVER_DIR)
+        self.set_package(FIXTURES["bogus-0.2"].package)
+        self.options.check_license = False
+        autobuild_tool_install.install_packages(self.options, self.pkgs)
+        assert_equals(open(os.path.join(INSTALL_DIR, "include", "bogus.h")).read(),
+                      "fake header file 0.2")
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "extra.lib"))
+        installed = configfile.ConfigurationDescription(self.options.installed_filename)
+        assert_equals(installed.installables["bogus"].version, "0.2")
+
 # -------------------------------------  -------------------------------------
 class TestInstallCachedArchive(BaseTest):
     def setup(self):
@@ -646,6 +929,68 @@ class TestInstallCachedArchive(BaseTest):
         assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
         assert os.path.exists(os.path.join(INSTALL_DIR, "include", "bogus.h"))
 
+# -------------------------------------  -------------------------------------
+class TestContentAddressedCache(BaseTest):
+    def setup(self):
+        BaseTest.setup(self)
+        self.pkg = "bogus"
+        self.fixture = FIXTURES[self.pkg + "-0.1"]
+        self.server_name = self.copyto(self.fixture.pathname, SERVER_DIR)
+        self.new_package(self.fixture.package)
+
+    def test_download_once(self):
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        archive = self.fixture.package.platforms["darwin"].archive
+        content_name = install_cache.get_content_path(archive.hash_algorithm, archive.hash)
+        alias_name = in_dir(common.get_default_install_cache_dir(), self.fixture.pathname)
+        assert os.path.exists(content_name)
+        assert os.path.samefile(content_name, alias_name)
+        # Take the archive off the server and out from under its filename,
+        # then ask for the same content under a different URL: it must come
+        # from the content-addressed cache.
+        clean_file(self.server_name)
+        clean_file(alias_name)
+        moved = self.fixture.package.copy()
+        moved.platforms["darwin"].archive.url = url_for("moved-" + os.path.basename(self.fixture.pathname))
+        self.set_package(moved)
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+
+    def test_index_unstored(self):
+        # Only installing without the unpacked store can use an archive's
+        # index, so only that writes one.
+        archive = self.fixture.package.platforms["darwin"].archive
+        index_name = install_cache.get_content_path(archive.hash_algorithm, archive.hash) + \
+                     install_cache.TAR_INDEX_SUFFIX
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        assert not os.path.exists(index_name)
+        clean_dir(INSTALL_DIR)
+        os.environ[install_cache.UNPACKED_STORE_ENV] = "0"
+        try:
+            autobuild_tool_install.install_packages(self.options, [self.pkg])
+        finally:
+            del os.environ[install_cache.UNPACKED_STORE_ENV]
+        assert os.path.exists(index_name)
+
+    def test_unpacked_once(self):
+        if not hasattr(os, "link"):
+            return
+        autobuild_tool_install.install_packages(self.options, [self.pkg])
+        # A second install directory, e.g. for another checkout, gets links
+        # to the same unpacked files.
+        other_dir = tempfile.mkdtemp()
+        self.tempdirs.append(other_dir)
+        options = self.options.copy()
+        options.install_dir = other_dir
+        options.installed_filename = os.path.join(other_dir, "packages-installed.xml")
+        autobuild_tool_install.install_packages(options, [self.pkg])
+        for f in (("lib", "bogus.lib"), ("include", "bogus.h")):
+            assert os.path.samefile(os.path.join(INSTALL_DIR, *f), os.path.join(other_dir, *f))
+        # Uninstalling from one leaves the other alone.
+        autobuild_tool_uninstall.uninstall_packages(options, [self.pkg])
+        assert not os.path.exists(os.path.join(other_dir, "lib", "bogus.lib"))
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+
 # -------------------------------------  -------------------------------------
 class TestDownloadFail(BaseTest):
     def setup(self):
@@ -664,6 +1009,8 @@ class TestDownloadFail(BaseTest):
         with ExpectError("download", "expected InstallError for download failure"):
             autobuild_tool_install.install_packages(self.options, [self.pkg])
         assert not os.path.exists(self.cache_name)
+        # nor any partial download under a temporary name
+        assert_equals([f for f in cache_inventory() - INIT_CACHE if f.endswith(".part")], [])
 
 # -------------------------------------  -------------------------------------
 class TestGarbledDownload(BaseTest):
@@ -857,6 +1204,38 @@ class TestUninstallArchive(BaseTest):
         # Trying to uninstall a not-installed package is a no-op.
         autobuild_tool_uninstall.uninstall_packages(self.options, [self.pkg])
 
+    def test_shared(self):
+        fixture = FIXTURES["extra-0.3"]
+        self.copyto(fixture.pathname, SERVER_DIR)
+        self.new_package(fixture.package)
+        autobuild_tool_install.install_packages(self.options, ["extra"])
+        autobuild_tool_uninstall.uninstall_packages(self.options, [self.pkg])
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "LICENSES", "bogus.txt"))
+        # the directories extra shares are left with its files
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "extra.lib"))
+        assert os.path.exists(os.path.join(INSTALL_DIR, "include", "extra.h"))
+        assert os.path.exists(os.path.join(INSTALL_DIR, "LICENSES", "extra.txt"))
+        threads = autobuild_tool_install.UNINSTALL_THREADS
+        autobuild_tool_install.UNINSTALL_THREADS = 4
+        try:
+            autobuild_tool_uninstall.uninstall_packages(self.options, ["extra"])
+        finally:
+            autobuild_tool_install.UNINSTALL_THREADS = threads
+        for d in "lib", "include", "LICENSES":
+            assert not os.path.exists(os.path.join(INSTALL_DIR, d))
+
+    def test_unlisted(self):
+        # files in bogus's directories that no manifest names, e.g. added
+        # by the user or by another install since, must be left alone
+        added = os.path.join(INSTALL_DIR, "lib", "local", "mine.lib")
+        os.makedirs(os.path.dirname(added))
+        open(added, 'w').write("not bogus")
+        autobuild_tool_uninstall.uninstall_packages(self.options, [self.pkg])
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        assert_equals(open(added).read(), "not bogus")
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "include"))
+
     def test_unknown(self):
         # Trying to uninstall an unknown package is a no-op. uninstall() only
         # checks installed-packages.xml; it doesn't even use autobuild.xml.
@@ -992,11 +1371,20 @@ def make_tarball_from_dict(pathname, tree):
     degenerate case in which the top-level 'tree' is simply a string. That
     would imply that the desired 'tarball' is simply a compressed file. If
     that's really what you want, do it yourself.
+    A pathname ending in .zip gets a zip archive instead.
     """
     tempdir = tempfile.mkdtemp()
     try:
         # Construct the desired subdirectory tree in tempdir.
         make_dir_from_dict(tempdir, tree)
+        if pathname.endswith(".zip"):
+            archive = zipfile.ZipFile(pathname, "w", zipfile.ZIP_DEFLATED)
+            for dirpath, dirnames, filenames in os.walk(tempdir):
+                for name in sorted(dirnames) + sorted(filenames):
+                    path = os.path.join(dirpath, name)
+                    archive.write(path, os.path.relpath(path, tempdir))
+            archive.close()
+            return pathname
         # Now make a tarball at pathname from tempdir.
         tarball = tarfile.open(pathname, "w:bz2")
         # Add the directory found at 'tempdir', but do not embed its full
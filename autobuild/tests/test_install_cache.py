@@ -0,0 +1,369 @@
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+#
+# Unit tests for install cache bookkeeping
+#
+
+import os
+import stat
+import errno
+import time
+import shutil
+import tempfile
+import unittest
+from autobuild import install_cache, hash_algorithms, common
+
+
+class TestVerifiedHashIndex(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.cache_dir, "test-1.0-linux-20101101.tar.bz2")
+        self.write_archive("archive contents")
+        self.digest = hash_algorithms.compute_hash("md5", self.archive)
+        # count calls to compute_hash() to see when the index saves one
+        self.computed = []
+        self.real_compute_hash = hash_algorithms.compute_hash
+        def counting_compute_hash(hash_algorithm, pathname, buffer_size=None):
+            self.computed.append(pathname)
+            return self.real_compute_hash(hash_algorithm, pathname, buffer_size)
+        hash_algorithms.compute_hash = counting_compute_hash
+
+    def write_archive(self, contents):
+        f = open(self.archive, 'wb')
+        f.write(contents)
+        f.close()
+
+    def test_record_lookup(self):
+        index = install_cache.VerifiedHashIndex(self.cache_dir)
+        assert index.lookup(self.archive, "md5") is None
+        index.record(self.archive, "md5", self.digest)
+        assert index.lookup(self.archive, "md5") == self.digest
+        # no hash_algorithm means md5
+        assert index.lookup(self.archive, None) == self.digest
+        assert index.lookup(self.archive, "sha-1") is None
+        # persists for another process's index
+        assert install_cache.VerifiedHashIndex(self.cache_dir).lookup(self.archive, "md5") == self.digest
+        index.forget(self.archive)
+        assert install_cache.VerifiedHashIndex(self.cache_dir).lookup(self.archive, "md5") is None
+
+    def test_verify_skips_rehash(self):
+        index = install_cache.VerifiedHashIndex(self.cache_dir)
+        assert install_cache.verify_hash("md5", self.archive, self.digest, index)
+        assert len(self.computed) == 1
+        assert install_cache.verify_hash("md5", self.archive, self.digest, index)
+        assert not install_cache.verify_hash("md5", self.archive, "BAADBAAD", index)
+        assert len(self.computed) == 1
+
+    def test_change_invalidates(self):
+        index = install_cache.VerifiedHashIndex(self.cache_dir)
+        assert install_cache.verify_hash("md5", self.archive, self.digest, index)
+        # same size, different content and mtime
+        self.write_archive("ARCHIVE CONTENTS")
+        os.utime(self.archive, (time.time() + 10, time.time() + 10))
+        assert index.lookup(self.archive, "md5") is None
+        assert not install_cache.verify_hash("md5", self.archive, self.digest, index)
+        assert len(self.computed) == 2
+
+    def test_unsupported_algorithm(self):
+        index = install_cache.VerifiedHashIndex(self.cache_dir)
+        try:
+            install_cache.verify_hash("sha-0", self.archive, self.digest, index)
+        except common.AutobuildError, err:
+            assert self.archive in str(err), str(err)
+        else:
+            self.fail("verified with an unsupported hash type")
+
+    def tearDown(self):
+        hash_algorithms.compute_hash = self.real_compute_hash
+        shutil.rmtree(self.cache_dir)
+
+
+class TestContentStore(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def test_content_path(self):
+        assert install_cache.get_content_path("md5", "ABCDEF", self.cache_dir) == \
+               os.path.join(self.cache_dir, "md5", "abcdef")
+        # no hash_algorithm means md5
+        assert install_cache.get_content_path(None, "abcdef", self.cache_dir) == \
+               os.path.join(self.cache_dir, "md5", "abcdef")
+        # nothing to go on, or a hash that won't make a safe filename
+        assert install_cache.get_content_path("md5", None, self.cache_dir) is None
+        assert install_cache.get_content_path("md5", "../../etc", self.cache_dir) is None
+
+    def test_link_entry(self):
+        if not hasattr(os, "link"):
+            return
+        content = install_cache.get_content_path("md5", "abcdef", self.cache_dir)
+        alias = os.path.join(self.cache_dir, "test-1.0-linux-20101101.tar.bz2")
+        open(alias, 'wb').write("old contents")
+        assert install_cache.link_entry(alias, content)
+        assert os.path.samefile(alias, content)
+        # replaces whatever was there
+        other = os.path.join(self.cache_dir, "other")
+        open(other, 'wb').write("new contents")
+        assert install_cache.link_entry(other, alias)
+        assert open(alias, 'rb').read() == "new contents"
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+
+class TestEviction(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.now = time.time()
+
+    def add_file(self, name, size, age):
+        path = os.path.join(self.cache_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'wb')
+        f.write("x" * size)
+        f.close()
+        os.utime(path, (self.now - age, self.now - age))
+        return path
+
+    def test_least_recently_used(self):
+        old = self.add_file("old-1.0-linux-20101101.tar.bz2", 100, 300)
+        older = self.add_file("older-1.0-linux-20101101.tar.bz2", 100, 400)
+        new = self.add_file("new-1.0-linux-20101101.tar.bz2", 100, 100)
+        assert install_cache.evict(1000, cache_dir=self.cache_dir) == 0
+        assert install_cache.evict(150, cache_dir=self.cache_dir) == 200
+        assert os.path.exists(new)
+        assert not os.path.exists(old)
+        assert not os.path.exists(older)
+
+    def test_spares_current_run(self):
+        pinned = self.add_file("pinned-1.0-linux-20101101.tar.bz2", 100, 400)
+        used = self.add_file("used-1.0-linux-20101101.tar.bz2", 100, 300)
+        install_cache.touch(used)
+        unused = self.add_file("unused-1.0-linux-20101101.tar.bz2", 100, 200)
+        assert install_cache.evict(0, [pinned], since=self.now - 10, cache_dir=self.cache_dir) == 100
+        assert os.path.exists(pinned)
+        assert os.path.exists(used)
+        assert not os.path.exists(unused)
+
+    def test_links_evicted_together(self):
+        if not hasattr(os, "link"):
+            return
+        content = self.add_file(os.path.join("md5", "abcdef"), 100, 300)
+        alias = os.path.join(self.cache_dir, "test-1.0-linux-20101101.tar.bz2")
+        os.link(content, alias)
+        new = self.add_file("new-1.0-linux-20101101.tar.bz2", 100, 100)
+        # the two names count once
+        assert install_cache.evict(200, cache_dir=self.cache_dir) == 0
+        assert install_cache.evict(100, cache_dir=self.cache_dir) == 100
+        assert not os.path.exists(content)
+        assert not os.path.exists(alias)
+        assert os.path.exists(new)
+
+    def test_abandoned_downloads(self):
+        stale = self.add_file("test-1.0-linux-20101101.tar.bz2.123-456.part", 100,
+                              install_cache.STALE_TEMP_AGE + 60)
+        active = self.add_file("test-1.0-linux-20101101.tar.bz2.789-456.part", 100, 10)
+        install_cache.evict(1000, cache_dir=self.cache_dir)
+        assert not os.path.exists(stale)
+        assert os.path.exists(active)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+
+class TestUnpackedStore(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.unpacked = install_cache.get_unpacked_path("md5", "abcdef", self.cache_dir)
+
+    def unpack(self, dest):
+        os.makedirs(os.path.join(dest, "lib"))
+        open(os.path.join(dest, "lib", "test.lib"), 'wb').write("x" * 100)
+        return ["lib", "lib/test.lib"]
+
+    def test_add_link(self):
+        assert self.unpacked == os.path.join(self.cache_dir, install_cache.UNPACKED_DIR, "md5", "abcdef")
+        assert install_cache.get_unpacked_names(self.unpacked) is None
+        names = install_cache.add_unpacked(self.unpacked, self.unpack)
+        assert install_cache.get_unpacked_names(self.unpacked) == names
+        install_dir = os.path.join(self.cache_dir, "packages")
+        assert install_cache.link_tree(self.unpacked, names, install_dir) == names
+        installed = os.path.join(install_dir, "lib", "test.lib")
+        assert open(installed, 'rb').read() == "x" * 100
+        if hasattr(os, "link"):
+            assert os.path.samefile(installed, os.path.join(self.unpacked, "lib", "test.lib"))
+
+    def test_copy_across_filesystems(self):
+        names = install_cache.add_unpacked(self.unpacked, self.unpack)
+        install_dir = os.path.join(self.cache_dir, "packages")
+        real_link = getattr(os, "link", None)
+        def link(source, target):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        os.link = link
+        try:
+            assert install_cache.link_tree(self.unpacked, names, install_dir) == names
+        finally:
+            if real_link is None:
+                del os.link
+            else:
+                os.link = real_link
+        # a copy, which outlives the unpacked archive
+        installed = os.path.join(install_dir, "lib", "test.lib")
+        assert not os.path.islink(installed)
+        install_cache.remove_unpacked(self.unpacked)
+        assert open(installed, 'rb').read() == "x" * 100
+
+    def test_evict(self):
+        install_cache.add_unpacked(self.unpacked, self.unpack)
+        indexname = self.unpacked + install_cache.UNPACKED_INDEX_SUFFIX
+        os.utime(indexname, (time.time() - 300, time.time() - 300))
+        # evicted whole
+        assert install_cache.evict(100, cache_dir=self.cache_dir) == 0
+        assert install_cache.evict(99, cache_dir=self.cache_dir) == 100
+        assert not os.path.exists(self.unpacked)
+        assert install_cache.get_unpacked_names(self.unpacked) is None
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+
+class TestEntryLock(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.cache_dir, "md5"))
+        self.archive = os.path.join(self.cache_dir, "md5", "abcdef")
+
+    def test_exclusive(self):
+        first = install_cache.EntryLock(self.archive)
+        second = install_cache.EntryLock(self.archive)
+        assert first.acquire()
+        try:
+            assert not second.acquire(blocking=False)
+            assert not second.acquire(shared=True, blocking=False)
+        finally:
+            first.release()
+        assert second.acquire(blocking=False)
+        second.release()
+
+    def test_shared(self):
+        if install_cache.fcntl is None:
+            # Windows only has exclusive locks
+            return
+        first = install_cache.EntryLock(self.archive)
+        second = install_cache.EntryLock(self.archive)
+        assert first.acquire(shared=True)
+        try:
+            assert second.acquire(shared=True, blocking=False)
+            second.release()
+            assert not second.acquire(blocking=False)
+        finally:
+            first.release()
+
+    def test_eviction_spares_locked(self):
+        open(self.archive, 'wb').write("x" * 100)
+        os.utime(self.archive, (time.time() - 300, time.time() - 300))
+        lock = install_cache.EntryLock(self.archive)
+        assert lock.acquire(shared=True)
+        try:
+            assert install_cache.evict(0, cache_dir=self.cache_dir) == 0
+            assert os.path.exists(self.archive)
+        finally:
+            lock.release()
+        assert install_cache.evict(0, cache_dir=self.cache_dir) == 100
+        assert not os.path.exists(self.archive)
+        assert not os.path.exists(lock.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.shared_dir = os.path.join(tempfile.mkdtemp(), "install.cache")
+        self.saved_env = os.environ.get(common.INSTALL_CACHE_ENV)
+        os.environ[common.INSTALL_CACHE_ENV] = self.shared_dir
+
+    def test_shared(self):
+        assert install_cache.is_shared()
+        assert common.get_default_install_cache_dir() == self.shared_dir
+        assert os.path.isdir(self.shared_dir)
+        if install_cache.fcntl is None:
+            # no group permissions to speak of on Windows
+            return
+        assert stat.S_IMODE(os.stat(self.shared_dir).st_mode) == 02775
+        subdir = os.path.join(self.shared_dir, "md5")
+        install_cache.make_directory(subdir)
+        assert stat.S_IMODE(os.stat(subdir).st_mode) == 02775
+        lock = install_cache.EntryLock(os.path.join(subdir, "abcdef"))
+        lock.acquire()
+        lock.release()
+        assert stat.S_IMODE(os.stat(lock.path).st_mode) == 0664
+
+    def test_trust(self):
+        if install_cache.fcntl is None:
+            return
+        subdir = os.path.join(self.shared_dir, "md5")
+        install_cache.make_directory(subdir)
+        archive = os.path.join(subdir, "abcdef")
+        open(archive, 'wb').write("archive contents")
+        # only the owner may change an archive others rely on
+        install_cache.share(archive)
+        assert stat.S_IMODE(os.stat(archive).st_mode) == 0644
+        digest = hash_algorithms.compute_hash("md5", archive)
+        index = install_cache.VerifiedHashIndex(self.shared_dir)
+        index.record(archive, "md5", digest)
+        assert index.lookup(archive, "md5") == digest
+        # but one that others could have changed must be hashed again
+        os.chmod(archive, 0664)
+        assert not install_cache.is_trusted(archive)
+        assert index.lookup(archive, "md5") is None
+
+        # an unpacked archive's contents can't be changed by others either
+        unpacked = install_cache.get_unpacked_path("md5", "abcdef")
+        def unpack(dirname):
+            common.ensure_directory(os.path.join(dirname, "lib"))
+            os.chmod(os.path.join(dirname, "lib"), 0777)
+            open(os.path.join(dirname, "lib", "libfoo.a"), 'wb').write("library")
+            os.chmod(os.path.join(dirname, "lib", "libfoo.a"), 0666)
+            return ["lib", "lib/libfoo.a"]
+        install_cache.add_unpacked(unpacked, unpack)
+        for path in (unpacked, os.path.join(unpacked, "lib"),
+                     os.path.join(unpacked, "lib", "libfoo.a"),
+                     unpacked + install_cache.UNPACKED_INDEX_SUFFIX):
+            assert install_cache.is_trusted(path), path
+        assert install_cache.get_unpacked_names(unpacked) == ["lib", "lib/libfoo.a"]
+        # nor used if they could have been
+        os.chmod(unpacked + install_cache.UNPACKED_INDEX_SUFFIX, 0664)
+        assert install_cache.get_unpacked_names(unpacked) is None
+        os.chmod(unpacked, 0777)
+        assert install_cache.get_unpacked_path("md5", "abcdef") is None
+
+    def tearDown(self):
+        if self.saved_env is None:
+            del os.environ[common.INSTALL_CACHE_ENV]
+        else:
+            os.environ[common.INSTALL_CACHE_ENV] = self.saved_env
+        shutil.rmtree(os.path.dirname(self.shared_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
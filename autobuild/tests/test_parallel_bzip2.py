@@ -0,0 +1,125 @@
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+#
+# Unit tests for parallel bzip2 decompression
+#
+
+import os
+import bz2
+import shutil
+import tarfile
+import tempfile
+import unittest
+from hashlib import md5
+from autobuild import common, parallel_bzip2
+
+# incompressible, so that it takes several 900k bzip2 blocks
+DATA = "".join(md5(str(i)).digest() for i in xrange(150000))
+
+
+class TestParallelBzip2(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.min_parallel_size = parallel_bzip2.MIN_PARALLEL_SIZE
+        parallel_bzip2.MIN_PARALLEL_SIZE = 0
+
+    def write(self, name, contents):
+        path = os.path.join(self.tempdir, name)
+        f = open(path, 'wb')
+        f.write(contents)
+        f.close()
+        return path
+
+    def test_find_blocks(self):
+        blocks = parallel_bzip2.find_blocks(bz2.compress(DATA))
+        assert len(blocks) == 3
+        # first block follows the 4-byte stream header
+        assert blocks[0][0] == 32
+        for (start, end), (next_start, next_end) in zip(blocks, blocks[1:]):
+            assert end == next_start
+        self.assertRaises(parallel_bzip2.DecompressionError, parallel_bzip2.find_blocks, "not bzip2")
+
+    def test_read(self):
+        # two streams, as written by parallel compressors
+        path = self.write("data.bz2", bz2.compress(DATA) + bz2.compress(DATA[:100000]))
+        stream = parallel_bzip2.open_tar_stream(path, 2)
+        assert stream is not None
+        try:
+            pieces = []
+            while True:
+                piece = stream.read(10240)
+                if not piece:
+                    break
+                pieces.append(piece)
+        finally:
+            stream.close()
+        assert "".join(pieces) == DATA + DATA[:100000]
+
+    def test_shared_pool(self):
+        # streams read at once, as by concurrent extractions, share workers
+        paths = [self.write("data%s.bz2" % n, bz2.compress(DATA)) for n in xrange(2)]
+        streams = [parallel_bzip2.open_tar_stream(path, 2) for path in paths]
+        try:
+            assert streams[0]._pool is streams[1]._pool
+            pieces = [[], []]
+            while True:
+                read = [stream.read(10240) for stream in streams]
+                if not any(read):
+                    break
+                for piece, stream_pieces in zip(read, pieces):
+                    stream_pieces.append(piece)
+        finally:
+            for stream in streams:
+                stream.close()
+        assert ["".join(stream_pieces) for stream_pieces in pieces] == [DATA, DATA]
+
+    def test_extract(self):
+        source = self.write("data.bin", DATA)
+        tarname = os.path.join(self.tempdir, "test-1.0-linux-20101101.tar.bz2")
+        tar = tarfile.open(tarname, 'w:bz2')
+        tar.add(source, "lib/data.bin")
+        tar.close()
+        install_dir = os.path.join(self.tempdir, "packages")
+        stream = parallel_bzip2.open_tar_stream(tarname, 2)
+        assert stream is not None
+        try:
+            files = common.extract_package(tarname, install_dir, tarname, stream)
+        finally:
+            stream.close()
+        assert files == ["lib/data.bin"]
+        assert open(os.path.join(install_dir, "lib", "data.bin"), 'rb').read() == DATA
+
+    def test_fallback(self):
+        # not bzip2
+        assert parallel_bzip2.open_tar_stream(self.write("data.bin", DATA), 2) is None
+        # a single block
+        assert parallel_bzip2.open_tar_stream(self.write("data.bz2", bz2.compress(DATA[:1000])), 2) is None
+        # no processes to spare
+        assert parallel_bzip2.open_tar_stream(self.write("data.bz2", bz2.compress(DATA)), 1) is None
+
+    def tearDown(self):
+        parallel_bzip2.MIN_PARALLEL_SIZE = self.min_parallel_size
+        shutil.rmtree(self.tempdir)
+
+
+if __name__ == '__main__':
+    unittest.main()